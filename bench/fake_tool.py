@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# Stand-in for gcloud, terraform, docker and ssh used by bench.py, which links this file into a bin directory under
+# each tool's name. Each call sleeps for BENCH_LATENCY_<TOOL> seconds, answers the way the real tool does for the
+# commands CloudTailor runs, and appends {"tool", "args", "start", "end"} to the JSONL file in BENCH_TOOL_LOG.
+# gcloud keeps the images it creates as files in BENCH_GCLOUD_IMAGE_DIR (none exist when it is unset), and its image
+# builder VMs power off without finishing when BENCH_GCLOUD_BUILD_FAILS is set. ssh refuses connections when
+# BENCH_SSH_FAILS is set. terraform apply replays the recorded -json output in BENCH_TERRAFORM_APPLY_EVENTS if set.
+import hashlib
+import glob
+import json
+import os
+import re
+import sys
+import time
+
+# Address every fake static IP and Terraform output reports
+FAKE_IP = "203.0.113.10"
+
+# Written by a fake apply with a hash of the Terraform files, so the next plan reports no changes until they change
+APPLIED_MARKER = ".bench-applied"
+
+# Provider "downloaded" by a fake init, relative to .terraform/providers or the plugin cache, and the lock file init writes
+PROVIDER_PATH = "registry.terraform.io/hashicorp/google/5.0.0/linux_amd64/terraform-provider-google"
+LOCK_FILE = ".terraform.lock.hcl"
+
+# Printed to a builder VM's serial console after a successful install, the same as provisioning.GOLDEN_IMAGE_BUILD_MARKER
+BUILD_MARKER = "CLOUDTAILOR_IMAGE_BUILD_OK"
+
+def latency(name, default=0.0):
+    return float(os.environ.get(f"BENCH_LATENCY_{name.upper()}", default))
+
+def gcloud(args):
+    time.sleep(latency("gcloud"))
+    if args[:3] == ["config", "get-value", "project"]:
+        print("bench-project")
+    elif args[:3] == ["iam", "service-accounts", "list"]:
+        print(json.dumps([{"displayName": "Compute Engine default service account", "email": "1234-compute@developer.gserviceaccount.com"}]))
+    elif args[:4] == ["iam", "service-accounts", "keys", "create"]:
+        with open(args[4], "w") as file:
+            json.dump({"type": "service_account", "project_id": "bench-project", "client_email": "1234-compute@developer.gserviceaccount.com"}, file)
+    elif args[:3] == ["compute", "addresses", "describe"]:
+        print(json.dumps({"name": args[3], "address": FAKE_IP}))
+    elif args[:2] == ["compute", "images"]:
+        return gcloud_images(args[2], args[3])
+    elif args[:3] == ["compute", "instances", "describe"]:
+        print("TERMINATED")
+    elif args[:3] == ["compute", "instances", "get-serial-port-output"]:
+        print("Starting image build...")
+        if not os.environ.get("BENCH_GCLOUD_BUILD_FAILS"):
+            print(BUILD_MARKER)
+    elif "delete" in args[:3] and "--async" in args:
+        print(f"operation-{os.getpid()}-{args[1]}")
+    elif "list" in args[:3]:
+        print("[]")
+    return 0
+
+# Describe, create or delete an image kept as a file in BENCH_GCLOUD_IMAGE_DIR
+def gcloud_images(command, name):
+    image_dir = os.environ.get("BENCH_GCLOUD_IMAGE_DIR")
+    path = os.path.join(image_dir, name) if image_dir else None
+    if command == "create" and path:
+        open(path, "w").close()
+        return 0
+    if not (path and os.path.exists(path)):
+        print(f"ERROR: (gcloud.compute.images.{command}) Could not fetch resource:\n - The resource 'projects/bench-project/global/images/{name}' was not found", file=sys.stderr)
+        return 1
+    if command == "delete":
+        os.remove(path)
+    elif command == "describe":
+        print(json.dumps({"name": name, "selfLink": f"https://www.googleapis.com/compute/v1/projects/bench-project/global/images/{name}"}))
+    return 0
+
+def terraform_files_hash():
+    digest = hashlib.sha256()
+    for path in sorted(glob.glob("*.tf")):
+        with open(path, "rb") as file:
+            digest.update(file.read())
+    return digest.hexdigest()
+
+def terraform_applied():
+    try:
+        with open(APPLIED_MARKER) as file:
+            return file.read() == terraform_files_hash()
+    except FileNotFoundError:
+        return False
+
+# Emit `terraform apply -json` events for every resource in the Terraform files, taking
+# BENCH_LATENCY_TERRAFORM_RESOURCE seconds per resource
+def terraform_apply():
+    def event(event_type, message, **fields):
+        print(json.dumps({"@level": "info", "@message": message, "type": event_type, **fields}), flush=True)
+
+    event("version", "Terraform 1.7.0")
+    for path in sorted(glob.glob("*.tf")):
+        with open(path) as file:
+            addresses = [f"{kind}.{name}" for kind, name in re.findall(r'^resource "([^"]+)" "([^"]+)"', file.read(), re.M)]
+        for address in addresses:
+            seconds = latency("terraform_resource", 0.2)
+            event("apply_start", f"{address}: Creating...", hook={"resource": {"addr": address}, "action": "create"})
+            time.sleep(seconds)
+            event("apply_complete", f"{address}: Creation complete after {seconds:.0f}s", hook={"resource": {"addr": address}, "action": "create", "elapsed_seconds": seconds})
+    with open(APPLIED_MARKER, "w") as file:
+        file.write(terraform_files_hash())
+    event("change_summary", "Apply complete!")
+    return 0
+
+# Install the google provider into .terraform, taking BENCH_LATENCY_TERRAFORM_PROVIDER seconds to download it unless
+# it is in TF_PLUGIN_CACHE_DIR and the lock file already lists it, and write the lock file if there is none
+def terraform_init():
+    cache_dir = os.environ.get("TF_PLUGIN_CACHE_DIR")
+    cached_path = os.path.join(cache_dir, PROVIDER_PATH) if cache_dir else None
+    if not (cached_path and os.path.exists(cached_path) and os.path.exists(LOCK_FILE)):
+        time.sleep(latency("terraform_provider", 1.0))
+        if cached_path:
+            os.makedirs(os.path.dirname(cached_path), exist_ok=True)
+            open(cached_path, "w").close()
+    os.makedirs(os.path.join(".terraform", "providers", os.path.dirname(PROVIDER_PATH)), exist_ok=True)
+    open(os.path.join(".terraform", "providers", PROVIDER_PATH), "w").close()
+    if not os.path.exists(LOCK_FILE):
+        with open(LOCK_FILE, "w") as file:
+            file.write(f'provider "registry.terraform.io/hashicorp/google" {{\n  version = "5.0.0"\n  hashes = ["h1:bench"]\n}}\n')
+
+# Print the recorded `terraform apply -json` lines in path, exiting 1 like Terraform if any is an error diagnostic
+def terraform_replay(path):
+    returncode = 0
+    with open(path) as file:
+        for line in file:
+            print(line, end="", flush=True)
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            if event.get("type") == "diagnostic" and event.get("diagnostic", {}).get("severity") == "error":
+                returncode = 1
+    return returncode
+
+def terraform(args):
+    time.sleep(latency("terraform"))
+    command = args[0] if args else ""
+    if command == "init":
+        terraform_init()
+    elif command == "plan":
+        open("tfplan", "w").close()
+        return 0 if terraform_applied() else 2
+    elif command == "apply" and os.environ.get("BENCH_TERRAFORM_APPLY_EVENTS"):
+        return terraform_replay(os.environ["BENCH_TERRAFORM_APPLY_EVENTS"])
+    elif command == "apply":
+        return terraform_apply()
+    elif command == "output":
+        print(json.dumps({"instance_ip": {"sensitive": False, "type": "string", "value": FAKE_IP}} if os.path.exists(APPLIED_MARKER) else {}))
+    return 0
+
+def docker(args):
+    time.sleep(latency("docker"))
+    if args[:1] == ["info"]:
+        print("27.0.0")
+    return 0
+
+def ssh(args):
+    time.sleep(latency("ssh"))
+    if os.environ.get("BENCH_SSH_FAILS"):
+        print(f"ssh: connect to host {args[-2] if len(args) > 1 else 'localhost'} port 22: Connection refused", file=sys.stderr)
+        return 255
+    return 0
+
+if __name__ == "__main__":
+    tool = os.path.basename(sys.argv[0])
+    start = time.time()
+    returncode = {"gcloud": gcloud, "terraform": terraform, "docker": docker, "ssh": ssh}[tool](sys.argv[1:])
+    if os.environ.get("BENCH_TOOL_LOG"):
+        with open(os.environ["BENCH_TOOL_LOG"], "a") as log_file:
+            log_file.write(json.dumps({"tool": tool, "args": sys.argv[1:], "start": start, "end": time.time()}) + "\n")
+    sys.exit(returncode)
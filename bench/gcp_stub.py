@@ -0,0 +1,126 @@
+import argparse
+import base64
+import itertools
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Address every created static IP gets, the same one fake_tool.py's gcloud reports
+FAKE_IP = "203.0.113.10"
+
+# Service accounts of every project; IAM pages them one at a time so callers have to follow nextPageToken
+SERVICE_ACCOUNTS = [
+    {"displayName": "App Engine default service account", "email": "bench-project@appspot.gserviceaccount.com"},
+    {"displayName": "Compute Engine default service account", "email": "1234-compute@developer.gserviceaccount.com"},
+]
+
+# Fake Compute Engine and IAM REST API for the endpoints gcp_rest.py calls, served under /compute/v1 and /v1 the way
+# CLOUDTAILOR_GCP_API_ENDPOINT expects. Every call waits `latency` seconds and is appended to the tool log as
+# {"tool": "gcp", ...}. Addresses are kept in memory; deleting a resource succeeds once and then answers 404 like
+# the real API, and operations finish when they are waited on.
+def handler_class(latency, log_path, state):
+    log_lock = threading.Lock()
+    operation_ids = itertools.count(1)
+
+    def error(status, message):
+        return status, {"error": {"code": status, "message": message}}
+
+    def start_operation(base_url, project, scope, target):
+        name = f"operation-{next(operation_ids)}"
+        operation = {"name": name, "status": "RUNNING", "targetLink": target, "selfLink": f"{base_url}/compute/v1/projects/{project}/{scope}/operations/{name}"}
+        state["operations"][name] = operation
+        return 200, dict(operation)
+
+    def route(method, path, body, base_url):
+        if match := re.fullmatch(r"/v1/projects/([^/]+)/serviceAccounts", path):
+            index = int(body.get("pageToken") or 0)
+            page = {"accounts": SERVICE_ACCOUNTS[index:index + 1]}
+            if index + 1 < len(SERVICE_ACCOUNTS):
+                page["nextPageToken"] = str(index + 1)
+            return 200, page
+        if match := re.fullmatch(r"/v1/projects/([^/]+)/serviceAccounts/([^/]+)/keys", path):
+            key = {"type": "service_account", "project_id": match[1], "client_email": match[2]}
+            return 200, {"name": f"projects/{match[1]}/serviceAccounts/{match[2]}/keys/1", "privateKeyData": base64.b64encode(json.dumps(key).encode()).decode()}
+        if match := re.fullmatch(r"/compute/v1/projects/([^/]+)/regions/([^/]+)/addresses", path):
+            project, region = match[1], match[2]
+            state["addresses"][(project, region, body["name"])] = {"name": body["name"], "address": FAKE_IP, "networkTier": body.get("networkTier", "PREMIUM"), "status": "RESERVED"}
+            return start_operation(base_url, project, f"regions/{region}", f"{path}/{body['name']}")
+        if match := re.fullmatch(r"/compute/v1/projects/([^/]+)/(?:zones|regions|global)/(?:[^/]+/)?operations/([^/]+)/wait", path):
+            operation = state["operations"].get(match[2])
+            if operation is None:
+                return error(404, f"The resource 'operations/{match[2]}' was not found")
+            operation["status"] = "DONE"
+            return 200, dict(operation)
+        if match := re.fullmatch(r"/compute/v1/projects/([^/]+)/((?:zones|regions)/[^/]+|global)/(instances|addresses|disks|firewalls)/([^/]+)", path):
+            project, scope, kind, name = match.groups()
+            key = (project, scope.split("/")[-1], name)
+            if method == "GET":
+                address = state["addresses"].get(key) if kind == "addresses" else None
+                return (200, address) if address else error(404, f"The resource '{path}' was not found")
+            if (kind, key) in state["deleted"]:
+                return error(404, f"The resource 'projects/{project}/{scope}/{kind}/{name}' was not found")
+            state["deleted"].add((kind, key))
+            if kind == "addresses":
+                state["addresses"].pop(key, None)
+            return start_operation(base_url, project, scope, path)
+        return error(404, f"Unknown path {path}")
+
+    class Handler(BaseHTTPRequestHandler):
+        def handle_request(self, method):
+            start = time.time()
+            path, _, query = self.path.partition("?")
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+            body.update(pair.split("=", 1) for pair in query.split("&") if "=" in pair)
+            time.sleep(latency)
+            with state["lock"]:
+                status, response = route(method, path, body, f"http://{self.headers['Host']}")
+            data = json.dumps(response).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            with log_lock:
+                state["calls"].append((method, path))
+                if log_path:
+                    with open(log_path, "a") as log_file:
+                        log_file.write(json.dumps({"tool": "gcp", "args": [method, path], "start": start, "end": time.time()}) + "\n")
+
+        def do_GET(self):
+            self.handle_request("GET")
+
+        def do_POST(self):
+            self.handle_request("POST")
+
+        def do_DELETE(self):
+            self.handle_request("DELETE")
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+# Start the fake API on a background thread and return (server, base URL for CLOUDTAILOR_GCP_API_ENDPOINT).
+# server.state holds the addresses, deleted resources and (method, path) of every call so far.
+def start(latency=0.0, log_path=None, port=0):
+    state = {"addresses": {}, "deleted": set(), "operations": {}, "calls": [], "lock": threading.Lock()}
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler_class(latency, log_path, state))
+    server.state = state
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+# Main execution
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a local fake of the Compute Engine and IAM endpoints CloudTailor calls.")
+    parser.add_argument("--port", type=int, default=8791, help="port to listen on (default: 8791)")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds to wait before answering (default: 0)")
+    args = parser.parse_args()
+
+    server, url = start(args.latency, port=args.port)
+    print(f"GCP API stub listening on {url} (set CLOUDTAILOR_GCP_API_ENDPOINT to it and GOOGLE_CLOUD_PROJECT to a project ID)")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
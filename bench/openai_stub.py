@@ -0,0 +1,79 @@
+import argparse
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Compose file the stub answers with: one service per image named in the prompt, the first one published on port 8080.
+# Like the real model it usually answers with, the file is wrapped in a markdown code fence after a short sentence.
+def compose_for_prompt(prompt):
+    match = re.search(r"Docker images: (.+?)\. Ensure", prompt)
+    images = [image.strip() for image in match[1].split(",")] if match else ["nginx:latest"]
+    lines = ["version: '3'", "services:"]
+    for index, image in enumerate(images):
+        name = re.sub(r"[^a-z0-9]+", "-", image.split("/")[-1].split(":")[0].lower()).strip("-") or f"service{index}"
+        lines += [f"  {name}:", f"    image: {image}", "    restart: unless-stopped"]
+        if index == 0:
+            lines += ["    ports:", "      - \"8080:80\""]
+    return "Here is the Docker Compose configuration:\n\n```yaml\n" + "\n".join(lines) + "\n```\n"
+
+# OpenAI-compatible chat completions endpoint that waits `latency` seconds before answering and appends each request
+# to the tool log as {"tool": "openai", ...}
+def handler_class(latency, log_path):
+    log_lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            start = time.time()
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+            if not self.path.rstrip("/").endswith("/chat/completions"):
+                self.send_error(404)
+                return
+            time.sleep(latency)
+            prompt = " ".join(message.get("content", "") for message in request.get("messages", []) if message.get("role") == "user")
+            choices = [
+                {"index": index, "finish_reason": "stop", "message": {"role": "assistant", "content": compose_for_prompt(prompt)}}
+                for index in range(request.get("n") or 1)
+            ]
+            body = json.dumps({
+                "id": f"chatcmpl-bench-{int(start * 1000)}",
+                "object": "chat.completion",
+                "created": int(start),
+                "model": request.get("model", "bench"),
+                "choices": choices,
+                "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+            }).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            if log_path:
+                with log_lock, open(log_path, "a") as log_file:
+                    log_file.write(json.dumps({"tool": "openai", "args": [self.path], "start": start, "end": time.time()}) + "\n")
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+# Start the stub on a background thread and return (server, base URL ending in /v1)
+def start(latency=0.0, log_path=None, port=0):
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler_class(latency, log_path))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+# Main execution
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a local OpenAI-compatible chat completions stub.")
+    parser.add_argument("--port", type=int, default=8790, help="port to listen on (default: 8790)")
+    parser.add_argument("--latency", type=float, default=1.0, help="seconds to wait before answering (default: 1.0)")
+    args = parser.parse_args()
+
+    server, url = start(args.latency, port=args.port)
+    print(f"OpenAI stub listening on {url} (set OPENAI_API_BASE and OPENAI_BASE_URL to it)")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,154 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import gcp_cache
+import setup
+import sizing
+import tracing
+from gcp import fetch_project_id
+from provisioning import GOLDEN_IMAGE_FAMILY, GOLDEN_IMAGE_BUILD_MARKER, stack_images, golden_image_name, golden_image_builder_script, record_golden_image
+
+# Give up on a builder VM that has not powered itself off after this many seconds
+BUILD_TIMEOUT = 30 * 60
+
+# gcloud flags selecting the source image for an os_type in any of the forms Terraform accepts:
+# a full image path, "image-project/image-family", or a bare Ubuntu image family
+def source_image_flags(os_type):
+    if os_type.startswith("projects/") or os_type.startswith("https://"):
+        return ["--image", os_type]
+    if "/" in os_type:
+        image_project, image_family = os_type.split("/", 1)
+        return ["--image-project", image_project, "--image-family", image_family]
+    return ["--image-project", "ubuntu-os-cloud", "--image-family", os_type]
+
+# Describe an existing image, returning its JSON or None if it does not exist
+def describe_image(name, project_id):
+    result = tracing.run(["gcloud", "compute", "images", "describe", name, "--project", project_id, "--format=json"], capture_output=True, text=True)
+    if result.returncode != 0:
+        return None
+    return json.loads(result.stdout)
+
+# Wait for the builder VM to power itself off; returns False on timeout
+def wait_for_builder(builder_name, zone, project_id):
+    deadline = time.monotonic() + BUILD_TIMEOUT
+    delay = 5
+    while time.monotonic() < deadline:
+        result = tracing.run(["gcloud", "compute", "instances", "describe", builder_name, "--zone", zone, "--project", project_id, "--format=value(status)"], capture_output=True, text=True)
+        status = result.stdout.strip()
+        if status == "TERMINATED":
+            return True
+        print(f"Builder is {status or 'starting'}; checking again in {delay}s...")
+        time.sleep(delay)
+        delay = min(delay * 2, 30)
+    return False
+
+# Check the builder's serial console for the marker its startup script prints after a successful install
+def builder_succeeded(builder_name, zone, project_id):
+    result = tracing.run(["gcloud", "compute", "instances", "get-serial-port-output", builder_name, "--zone", zone, "--project", project_id], capture_output=True, text=True)
+    return GOLDEN_IMAGE_BUILD_MARKER in result.stdout
+
+# Build a golden image on a temporary VM and return its self link, or None on failure.
+# With replace, an existing image of the same name is deleted only once the builder has finished successfully, so a
+# failed rebuild leaves it in place.
+def build_image(name, os_type, prepull_images, zone, machine_type, project_id, replace=False):
+    builder_name = f"{name}-builder"
+    with tempfile.NamedTemporaryFile("w", suffix=".sh", delete=False) as script_file:
+        script_file.write(golden_image_builder_script(prepull_images))
+
+    try:
+        print(f"Creating builder VM {builder_name}...")
+        create_result = tracing.run(
+            ["gcloud", "compute", "instances", "create", builder_name, "--zone", zone, "--project", project_id,
+             "--machine-type", machine_type, *source_image_flags(os_type), "--boot-disk-size", "20GB",
+             "--metadata-from-file", f"startup-script={script_file.name}"],
+            capture_output=True, text=True
+        )
+        if create_result.returncode != 0:
+            print("Error creating builder VM:", create_result.stderr)
+            return None
+
+        if not wait_for_builder(builder_name, zone, project_id):
+            print(f"Error: Builder VM did not finish within {BUILD_TIMEOUT // 60} minutes.")
+            return None
+        if not builder_succeeded(builder_name, zone, project_id):
+            print(f"Error: Builder VM stopped before finishing. Check its serial console output: gcloud compute instances get-serial-port-output {builder_name} --zone {zone}")
+            return None
+
+        if replace and describe_image(name, project_id):
+            print(f"Replacing image {name}...")
+            delete_result = tracing.run(["gcloud", "compute", "images", "delete", name, "--project", project_id, "--quiet"], capture_output=True, text=True)
+            if delete_result.returncode != 0:
+                print("Error deleting the existing image:", delete_result.stderr)
+                return None
+
+        print(f"Creating image {name} from the builder disk...")
+        image_result = tracing.run(
+            ["gcloud", "compute", "images", "create", name, "--project", project_id, "--family", GOLDEN_IMAGE_FAMILY,
+             "--source-disk", builder_name, "--source-disk-zone", zone],
+            capture_output=True, text=True
+        )
+        if image_result.returncode != 0:
+            print("Error creating image:", image_result.stderr)
+            return None
+    finally:
+        os.remove(script_file.name)
+        tracing.run(["gcloud", "compute", "instances", "delete", builder_name, "--zone", zone, "--project", project_id, "--quiet"], capture_output=True, text=True)
+
+    image = describe_image(name, project_id)
+    return image["selfLink"] if image else None
+
+# Main execution
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a reusable GCP image with Docker and cloudflared preinstalled.")
+    parser.add_argument("--variables", default="variables.txt", help="path to the variables file (default: variables.txt)")
+    parser.add_argument("--machine-type", help="machine type of the temporary builder VM (default: t2a-standard-1 for arm64 images, otherwise e2-medium)")
+    parser.add_argument("--force", action="store_true", help="rebuild even if an image for the current inputs already exists")
+    parser.add_argument("--trace-dir", help="write trace.jsonl and trace.json here (default: only print the trace summary)")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.variables):
+        print(f"{args.variables} file is required to run this script.")
+        sys.exit(1)
+    vars = setup.load_variables(args.variables)
+    # Setting default values if not found in variables.txt
+    vars["os_type"] = vars.get("os_type") or "ubuntu-2204-lts-arm64"
+    if vars.get("gcloud_cache", "on").lower() == "off":
+        gcp_cache.enabled = False
+
+    # Trace gcloud calls unless trace="off", printing a summary at exit
+    if vars.get("trace") == "off":
+        tracing.enabled = False
+    else:
+        tracing.configure(args.trace_dir)
+    tracing.start_phase("preflight")
+
+    project_id = vars.get("project_id") or fetch_project_id()
+    if not project_id:
+        print("Error: Unable to determine the GCP project ID. Run `gcloud config set project <PROJECT_ID>`.")
+        sys.exit(1)
+
+    os_type = vars["os_type"]
+    # The builder has to match the image's architecture
+    machine_type = args.machine_type or ("t2a-standard-1" if sizing.is_arm(os_type) else "e2-medium")
+    prepull_images = stack_images(vars.get("docker_images", "").split(), vars.get("compose_file_path")) if vars.get("golden_image_prepull") == "yes" else []
+    name = golden_image_name(os_type, prepull_images)
+    inputs = {"os_type": os_type, "prepull_images": prepull_images}
+
+    # The image name is derived from its inputs, so an existing image with this name is already up to date
+    existing_image = None if args.force else describe_image(name, project_id)
+    if existing_image:
+        print(f"Golden image {name} is up to date.")
+        self_link = existing_image["selfLink"]
+    else:
+        tracing.start_phase("build")
+        start = time.monotonic()
+        self_link = build_image(name, os_type, prepull_images, f"{vars.get('region')}-a", machine_type, project_id, replace=args.force)
+        if self_link is None:
+            sys.exit(1)
+        print(f"Built golden image {name} in {time.monotonic() - start:.0f}s.")
+
+    record_golden_image(name, self_link, inputs)
+    print(f'Set golden_image="auto" in {args.variables} to deploy from this image.')
@@ -0,0 +1,203 @@
+import re
+import yaml
+import compose_model
+
+# cloudflared reads its configuration from here once installed as a service
+CONFIG_PATH = "/etc/cloudflared/config.yml"
+
+# The tunnel ID is only known on the server after `cloudflared tunnel create`, so the rendered config carries this
+# placeholder and setup_cloudflare.sh substitutes the real ID before installing it
+TUNNEL_ID_PLACEHOLDER = "__TUNNEL_ID__"
+
+# cloudflared writes its log here; setup_cloudflare.sh installs a logrotate policy for it
+LOG_PATH = "/var/log/cloudflared.log"
+
+# Performance profiles selected with cloudflare_profile. Each sets cloudflared's log levels, how the log file is
+# rotated (logrotate frequency, size and generations kept) and the originRequest settings for connections from
+# cloudflared to the services; "performance" also keeps edge compression off to save CPU on small VMs and speaks
+# HTTP/2 to origins of the schemes in http2-origin-schemes (HTTPS origins negotiate it, so HTTP/1.1 ones still work).
+# "debug" keeps the verbose logging used before profiles existed.
+PROFILES = {
+    "debug": {
+        "loglevel": "debug",
+        "transport-loglevel": "info",
+        "logrotate": {"frequency": "daily", "maxsize": "50M", "rotate": 3},
+        "originRequest": {},
+    },
+    "balanced": {
+        "loglevel": "info",
+        "transport-loglevel": "warn",
+        "logrotate": {"frequency": "daily", "maxsize": "10M", "rotate": 3},
+        "originRequest": {"connectTimeout": "10s", "tcpKeepAlive": "30s", "keepAliveConnections": 100, "keepAliveTimeout": "90s"},
+    },
+    "performance": {
+        "loglevel": "warn",
+        "transport-loglevel": "error",
+        "logrotate": {"frequency": "weekly", "maxsize": "5M", "rotate": 2},
+        "originRequest": {"connectTimeout": "5s", "tcpKeepAlive": "15s", "keepAliveConnections": 256, "keepAliveTimeout": "120s"},
+        "compression-quality": 0,
+        "http2-origin-schemes": ["https"],
+    },
+}
+DEFAULT_PROFILE = "balanced"
+
+# Compose service labels starting with this prefix override originRequest settings for that service's ingress rules,
+# e.g. cloudtailor.origin.http2Origin: "true" or cloudtailor.origin.connectTimeout: "30s"
+ORIGIN_LABEL_PREFIX = "cloudtailor.origin."
+
+# Return the named profile. Raises ValueError listing the valid names for an unknown one.
+def profile_settings(profile_name):
+    profile_name = profile_name or DEFAULT_PROFILE
+    if profile_name not in PROFILES:
+        raise ValueError(f"Unknown cloudflare_profile \"{profile_name}\". Choose one of: {', '.join(PROFILES)}.")
+    return PROFILES[profile_name]
+
+# Compose labels as a dict, whether written as a mapping or as a list of key=value strings
+def service_labels(service_details):
+    labels = service_details.get("labels") or {}
+    if isinstance(labels, list):
+        labels = dict(label.split("=", 1) if "=" in label else (label, "") for label in labels)
+    return labels
+
+# Convert a label string to the YAML type cloudflared expects for the setting
+def label_value(value):
+    value = str(value)
+    if value.lower() in ("true", "false"):
+        return value.lower() == "true"
+    return int(value) if value.isdigit() else value
+
+# originRequest overrides for a service from its cloudtailor.origin.* labels
+def origin_overrides(service_details):
+    return {key[len(ORIGIN_LABEL_PREFIX):]: label_value(value) for key, value in service_labels(service_details).items() if key.startswith(ORIGIN_LABEL_PREFIX)}
+
+# How services share the tunnel, selected with ingress_routing. The first published port of the first service is
+# always served at app_hostname. With "hostname" every other port gets its own hostname, <service>-<app_hostname>
+# (one label deep, so Cloudflare's universal certificate still covers it). With "path" every other port is served
+# at app_hostname under /<service>. Ports after a service's first one add the host port: <service>-<port>.
+ROUTING_MODES = ("hostname", "path")
+DEFAULT_ROUTING = "hostname"
+
+# Compose labels that set a service's hostname or path prefix explicitly,
+# e.g. cloudtailor.ingress.hostname: "api.example.com" or cloudtailor.ingress.path: "/api", and the origin's scheme
+# (cloudtailor.ingress.scheme: "https", or "h2c" for HTTP/2 without TLS)
+INGRESS_LABEL_PREFIX = "cloudtailor.ingress."
+
+# Container ports assumed to serve TLS when a service sets no scheme label. cloudflared reaches them at localhost,
+# which their certificates do not name, so certificate checks are skipped for them unless the service's
+# cloudtailor.origin.noTLSVerify label says otherwise.
+TLS_PORTS = (443, 8443)
+
+# Ingress rules routing each service's published TCP ports to their host ports, ordered so that path rules come
+# before the catch-all rule for app_hostname. Raises ValueError for an unknown routing mode.
+def ingress_rules(compose_data, app_hostname, routing=None):
+    routing = routing or DEFAULT_ROUTING
+    if routing not in ROUTING_MODES:
+        raise ValueError(f"Unknown ingress_routing \"{routing}\". Choose one of: {', '.join(ROUTING_MODES)}.")
+
+    rules = []
+    primary_rules = []
+    for service_name, mappings in compose_model.service_ports(compose_data).items():
+        service_details = compose_data["services"][service_name] or {}
+        labels = service_labels(service_details)
+        overrides = origin_overrides(service_details)
+
+        routable = []
+        for mapping in mappings:
+            if mapping["protocol"] != "tcp":
+                print(f"Warning: {service_name} port {mapping['target']}/{mapping['protocol']} cannot be routed through the tunnel.")
+            elif mapping["published"] is None:
+                print(f"Warning: {service_name} port {mapping['target']} is published on a random host port; give it a host port (e.g. \"8080:{mapping['target']}\") to route it through the tunnel.")
+            else:
+                routable.append(mapping)
+
+        for index, mapping in enumerate(routable):
+            name = service_name if index == 0 else f"{service_name}-{mapping['published']}"
+            rule = {"hostname": app_hostname}
+            primary = not rules and not primary_rules
+            if index == 0 and labels.get(f"{INGRESS_LABEL_PREFIX}hostname"):
+                rule["hostname"] = labels[f"{INGRESS_LABEL_PREFIX}hostname"]
+            elif routing == "hostname" and not primary:
+                rule["hostname"] = f"{name}-{app_hostname}"
+            if index == 0 and labels.get(f"{INGRESS_LABEL_PREFIX}path"):
+                rule["path"] = path_pattern(labels[f"{INGRESS_LABEL_PREFIX}path"])
+            elif routing == "path" and not primary and rule["hostname"] == app_hostname:
+                rule["path"] = path_pattern(f"/{name}")
+            scheme_label = labels.get(f"{INGRESS_LABEL_PREFIX}scheme")
+            scheme = scheme_label or ("https" if mapping["target"] in TLS_PORTS else "http")
+            origin_request = {"noTLSVerify": True} if scheme == "https" and not scheme_label else {}
+            if scheme == "h2c":
+                scheme = "http"
+                origin_request["http2Origin"] = True
+            rule["service"] = f"{scheme}://{compose_model.local_address(mapping)}:{mapping['published']}"
+            origin_request.update(overrides)
+            if origin_request:
+                rule["originRequest"] = origin_request
+            (rules if "path" in rule or not primary else primary_rules).append(rule)
+    return rules + primary_rules
+
+# cloudflared matches paths with a regular expression; match the prefix itself and anything below it
+def path_pattern(prefix):
+    return "^" + re.sub(r"([.^$*+?()\[\]{}|\\])", r"\\\1", prefix.rstrip("/")) + "(/|$)"
+
+# Hostnames other than app_hostname that need a DNS route to the tunnel
+def extra_hostnames(rules, app_hostname):
+    return sorted({rule["hostname"] for rule in rules if rule.get("hostname") not in (None, app_hostname)})
+
+# Render the complete cloudflared config as YAML, ending with the catch-all 404 rule cloudflared requires
+def render_config(rules, profile_name=None):
+    profile = profile_settings(profile_name)
+    config = {
+        "tunnel": TUNNEL_ID_PLACEHOLDER,
+        "credentials-file": f"/root/.cloudflared/{TUNNEL_ID_PLACEHOLDER}.json",
+        "protocol": "quic",
+        "logfile": LOG_PATH,
+        "loglevel": profile["loglevel"],
+        "transport-loglevel": profile["transport-loglevel"],
+    }
+    if "compression-quality" in profile:
+        config["compression-quality"] = profile["compression-quality"]
+    if profile["originRequest"]:
+        config["originRequest"] = profile["originRequest"]
+    http2_schemes = profile.get("http2-origin-schemes", [])
+    rules = [
+        {**rule, "originRequest": {"http2Origin": True, **rule.get("originRequest", {})}} if rule["service"].split("://")[0] in http2_schemes else rule
+        for rule in rules
+    ]
+    config["ingress"] = rules + [{"service": "http_status:404"}]
+    return yaml.safe_dump(config, sort_keys=False, default_flow_style=False)
+
+# logrotate policy for the cloudflared log file. copytruncate lets cloudflared keep writing to its open file.
+def logrotate_config(profile_name=None):
+    rotation = profile_settings(profile_name)["logrotate"]
+    return f"""{LOG_PATH} {{
+    {rotation["frequency"]}
+    maxsize {rotation["maxsize"]}
+    rotate {rotation["rotate"]}
+    compress
+    missingok
+    notifempty
+    copytruncate
+}}
+"""
+
+# Shell commands that fill in $tunnel_id, validate the config with cloudflared and install it with a single rename,
+# so a rejected or half-written config never replaces the one in use
+def install_config_script(config_yaml):
+    return f"""sudo mkdir -p /etc/cloudflared
+config_tmp=$(sudo mktemp {CONFIG_PATH}.XXXXXX)
+sed "s/{TUNNEL_ID_PLACEHOLDER}/$tunnel_id/g" <<'CLOUDFLARED_CONFIG' | sudo tee "$config_tmp" > /dev/null
+{config_yaml}CLOUDFLARED_CONFIG
+if ! sudo cloudflared tunnel --config "$config_tmp" ingress validate; then
+    sudo rm -f "$config_tmp"
+    echo "cloudflared rejected the generated config; {CONFIG_PATH} was not changed."
+    exit 1
+fi
+sudo chmod 644 "$config_tmp"
+sudo mv "$config_tmp" {CONFIG_PATH}
+"""
+
+# Shell commands that install the logrotate policy for the cloudflared log
+def install_logrotate_script(profile_name=None):
+    return f"""sudo tee /etc/logrotate.d/cloudflared > /dev/null <<'LOGROTATE_CONFIG'
+{logrotate_config(profile_name)}LOGROTATE_CONFIG
+"""
@@ -0,0 +1,129 @@
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+
+# Generated Docker Compose files are stored as <sha256>.yml under this directory alongside an index.json
+CACHE_DIR = os.environ.get("CLOUDTAILOR_COMPOSE_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "cloudtailor", "compose"))
+
+# Least recently used, unpinned entries are evicted once either limit is exceeded
+MAX_ENTRIES = int(os.environ.get("CLOUDTAILOR_COMPOSE_CACHE_MAX_ENTRIES", "50"))
+MAX_BYTES = int(os.environ.get("CLOUDTAILOR_COMPOSE_CACHE_MAX_BYTES", str(5 * 1024 * 1024)))
+
+_lock = threading.Lock()
+
+# Normalize a Docker image list so the same stack always hashes the same way:
+# surrounding whitespace is dropped, duplicates are removed and images without a tag get ":latest"
+def normalize_images(docker_images):
+    normalized = set()
+    for image in docker_images:
+        image = image.strip()
+        if not image:
+            continue
+        if "@" not in image and ":" not in image.rsplit("/", 1)[-1]:
+            image += ":latest"
+        normalized.add(image)
+    return sorted(normalized)
+
+# Content address of a chat completion request: a hash of the model, messages and parameters
+def request_key(request):
+    canonical = json.dumps(request, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+def _index_path():
+    return os.path.join(CACHE_DIR, "index.json")
+
+def _entry_path(key):
+    return os.path.join(CACHE_DIR, f"{key}.yml")
+
+def _load_index():
+    try:
+        with open(_index_path(), "r") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+def _save_index(index):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    temp_path = f"{_index_path()}.{os.getpid()}.tmp"
+    with open(temp_path, "w") as file:
+        json.dump(index, file, indent=2, sort_keys=True)
+    os.replace(temp_path, _index_path())
+
+# Return the cached compose YAML for key, or None, and mark the entry as recently used
+def get(key):
+    with _lock:
+        index = _load_index()
+        if key not in index or not os.path.exists(_entry_path(key)):
+            return None
+        with open(_entry_path(key), "r") as file:
+            content = file.read()
+        index[key]["last_used"] = time.time()
+        _save_index(index)
+        return content
+
+# Store compose YAML under key, then evict least recently used entries beyond the size limits
+def put(key, content, description=""):
+    with _lock:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        temp_path = f"{_entry_path(key)}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as file:
+            file.write(content)
+        os.replace(temp_path, _entry_path(key))
+
+        index = _load_index()
+        pinned = index.get(key, {}).get("pinned", False)
+        index[key] = {"last_used": time.time(), "size": len(content.encode("utf-8")), "pinned": pinned, "description": description}
+        _evict(index)
+        _save_index(index)
+
+# Drop unpinned entries, oldest first, until the cache fits within MAX_ENTRIES and MAX_BYTES
+def _evict(index):
+    candidates = sorted((entry["last_used"], key) for key, entry in index.items() if not entry.get("pinned"))
+    while candidates and (len(index) > MAX_ENTRIES or sum(entry["size"] for entry in index.values()) > MAX_BYTES):
+        _, key = candidates.pop(0)
+        del index[key]
+        if os.path.exists(_entry_path(key)):
+            os.remove(_entry_path(key))
+
+# Pin or unpin an entry; pinned entries are never evicted
+def set_pinned(key, pinned):
+    with _lock:
+        index = _load_index()
+        if key not in index:
+            return False
+        index[key]["pinned"] = pinned
+        _save_index(index)
+        return True
+
+# Remove one entry, or every entry when key is None
+def clear(key=None):
+    with _lock:
+        index = _load_index()
+        for cached_key in [key] if key else list(index):
+            index.pop(cached_key, None)
+            if os.path.exists(_entry_path(cached_key)):
+                os.remove(_entry_path(cached_key))
+        _save_index(index)
+
+# Command line entry point: python compose_cache.py list|pin|unpin|clear [key]
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    key = sys.argv[2] if len(sys.argv) > 2 else None
+    if command == "list":
+        for cached_key, entry in sorted(_load_index().items(), key=lambda item: -item[1]["last_used"]):
+            pin_marker = " (pinned)" if entry.get("pinned") else ""
+            print(f"{cached_key}{pin_marker} {entry['size']} bytes, last used {time.ctime(entry['last_used'])}: {entry.get('description', '')}")
+    elif command in ("pin", "unpin") and key:
+        if not set_pinned(key, command == "pin"):
+            print(f"No cached Docker Compose file with key {key}.")
+            sys.exit(1)
+        print(f"{command.capitalize()}ned {key}.")
+    elif command == "clear":
+        clear(key)
+        print("Cleared cached Docker Compose files." if key is None else f"Cleared {key}.")
+    else:
+        print("Usage: python compose_cache.py list | pin <key> | unpin <key> | clear [key]")
+        sys.exit(1)
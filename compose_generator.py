@@ -0,0 +1,249 @@
+import queue
+import re
+import threading
+import time
+from concurrent.futures import Future
+import yaml
+import compose_cache
+import compose_model
+import tracing
+
+# Most requests sent in each round; the first answer that validates is used. A round starts with one request and
+# sends another (a hedge) only when no answer has arrived for DEFAULT_HEDGE_DELAY seconds or an answer was not usable.
+DEFAULT_CANDIDATES = 2
+DEFAULT_HEDGE_DELAY = 20
+
+# Give up on generation after this many seconds, across all rounds
+DEFAULT_DEADLINE = 120
+
+# Rounds of candidates to try before giving up. Rounds after the first only run when no candidate of the previous one
+# was valid, after waiting INITIAL_BACKOFF seconds, doubling each round up to MAX_BACKOFF.
+DEFAULT_ATTEMPTS = 3
+INITIAL_BACKOFF = 2
+MAX_BACKOFF = 16
+
+# Seconds allowed for one chat completion request
+REQUEST_TIMEOUT = 60
+
+# Markdown code fence around the YAML, which models tend to add along with a sentence or two of prose
+FENCE = re.compile(r"```[ \t]*(?:ya?ml|docker-compose)?[ \t]*\n(.*?)(?:\n[ \t]*```|\Z)", re.S | re.I)
+
+# Keys the Compose file format (v3 and the Compose Specification docker compose implements) allows at the top level
+# and in a service. docker compose refuses files with other keys, except extensions starting with "x-".
+TOP_LEVEL_KEYS = {"version", "name", "services", "networks", "volumes", "configs", "secrets"}
+SERVICE_KEYS = {
+    "annotations", "attach", "blkio_config", "build", "cap_add", "cap_drop", "cgroup", "cgroup_parent", "command",
+    "configs", "container_name", "cpu_count", "cpu_percent", "cpu_period", "cpu_quota", "cpu_rt_period",
+    "cpu_rt_runtime", "cpu_shares", "cpus", "cpuset", "credential_spec", "depends_on", "deploy", "develop",
+    "device_cgroup_rules", "devices", "dns", "dns_opt", "dns_search", "domainname", "entrypoint", "env_file",
+    "environment", "expose", "extends", "external_links", "extra_hosts", "group_add", "healthcheck", "hostname",
+    "image", "init", "ipc", "isolation", "labels", "links", "logging", "mac_address", "mem_limit", "mem_reservation",
+    "mem_swappiness", "memswap_limit", "network_mode", "networks", "oom_kill_disable", "oom_score_adj", "pid",
+    "pids_limit", "platform", "ports", "privileged", "profiles", "pull_policy", "read_only", "restart", "runtime",
+    "scale", "secrets", "security_opt", "shm_size", "stdin_open", "stop_grace_period", "stop_signal", "storage_opt",
+    "sysctls", "tmpfs", "tty", "ulimits", "user", "userns_mode", "uts", "volumes", "volumes_from", "working_dir",
+}
+
+# Expected YAML types of service keys that are commonly gotten wrong
+SERVICE_KEY_TYPES = {
+    "image": (str,),
+    "ports": (list,),
+    "expose": (list,),
+    "volumes": (list,),
+    "environment": (list, dict),
+    "depends_on": (list, dict),
+    "labels": (list, dict),
+    "networks": (list, dict),
+}
+RESTART_POLICIES = re.compile(r"^(no|always|unless-stopped|on-failure(:\d+)?)$")
+PROTOCOLS = {"tcp", "udp", "sctp"}
+
+class GenerationError(Exception):
+    pass
+
+# Generations in progress as {compose_cache.request_key(): Future}. A caller asking for a request that is already
+# being generated (another fleet host with the same stack) waits for that result instead of sending its own.
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+# The YAML in a model's answer: the contents of its first fenced code block if it has one, otherwise the whole answer
+def strip_fences(text):
+    match = FENCE.search(text)
+    return (match[1] if match else text).strip() + "\n"
+
+# Repository of an image reference without its tag, digest or Docker Hub prefix, e.g. "redis" for "docker.io/library/redis:alpine"
+def image_repository(image):
+    image = image.split("@", 1)[0]
+    name, _, tag = image.rpartition(":")
+    if name and "/" not in tag:
+        image = name
+    for prefix in ("docker.io/library/", "docker.io/", "library/"):
+        if image.startswith(prefix):
+            return image[len(prefix):]
+    return image
+
+# Problems docker compose or the server would run into with a service's ports: entries that do not parse, ports out
+# of range, unknown protocols and host ports published twice (by this or an earlier service, tracked in published)
+def port_problems(service_name, entries, published):
+    problems = []
+    for entry in entries:
+        try:
+            mappings = compose_model.parse_port(entry)
+        except (ValueError, KeyError, TypeError) as error:
+            problems.append(f"service {service_name}: {error}")
+            continue
+        for mapping in mappings:
+            if mapping["protocol"] not in PROTOCOLS:
+                problems.append(f"service {service_name}: unknown protocol {mapping['protocol']!r} in port {entry!r}")
+            for port in (mapping["target"], mapping["published"]):
+                if port is not None and not 1 <= port <= 65535:
+                    problems.append(f"service {service_name}: port {port} is out of range in {entry!r}")
+            if mapping["published"] is None:
+                continue
+            # A port published on all interfaces conflicts with the same port on any address
+            host_ip = None if mapping["host_ip"] in (None, "0.0.0.0", "::") else mapping["host_ip"]
+            for (other_ip, port, protocol), owner in published.items():
+                if (port, protocol) == (mapping["published"], mapping["protocol"]) and (host_ip == other_ip or None in (host_ip, other_ip)):
+                    problems.append(f"service {service_name}: host port {port}/{protocol} is already published by {owner}")
+                    break
+            published[(host_ip, mapping["published"], mapping["protocol"])] = service_name
+    return problems
+
+# Check a compose file the way docker compose and the server would see it: it must parse as YAML, follow the Compose
+# file schema (v3 when a version is given), publish sane, non-conflicting ports and run every image in
+# expected_images. Returns (compose data, list of problems); the file is usable when there are no problems.
+def validate(text, expected_images=()):
+    try:
+        compose_data = compose_model.load(text)
+    except yaml.YAMLError as error:
+        return None, [f"not valid YAML: {str(error).splitlines()[0]}"]
+    if not isinstance(compose_data, dict):
+        return None, ["not a YAML mapping"]
+
+    problems = [f"unknown top-level key {key!r}" for key in compose_data if key not in TOP_LEVEL_KEYS and not str(key).startswith("x-")]
+    version = compose_data.get("version")
+    if version is not None and not str(version).startswith("3"):
+        problems.append(f"version {version!r} is not a Compose v3 file")
+    services = compose_data.get("services")
+    if not isinstance(services, dict) or not services:
+        return compose_data, problems + ["no services"]
+
+    published = {}
+    for service_name, service in services.items():
+        if not isinstance(service, dict):
+            problems.append(f"service {service_name} is not a mapping")
+            continue
+        problems += [f"service {service_name}: unknown key {key!r}" for key in service if key not in SERVICE_KEYS and not str(key).startswith("x-")]
+        if "image" not in service and "build" not in service:
+            problems.append(f"service {service_name} has neither image nor build")
+        for key, types in SERVICE_KEY_TYPES.items():
+            if key in service and not isinstance(service[key], types):
+                problems.append(f"service {service_name}: {key} should be a {' or '.join(t.__name__ for t in types)}")
+        if "restart" in service and not RESTART_POLICIES.match(str(service["restart"])):
+            problems.append(f"service {service_name}: unknown restart policy {service['restart']!r}")
+        if isinstance(service.get("ports"), list):
+            problems += port_problems(service_name, service["ports"], published)
+
+    repositories = {image_repository(service["image"]) for service in services.values() if isinstance(service, dict) and isinstance(service.get("image"), str)}
+    problems += [f"image {image} is not used by any service" for image in expected_images if image_repository(image) not in repositories]
+    return compose_data, problems
+
+# Ask for one chat completion and return the text of its answer
+def request_candidate(client, request, timeout):
+    with tracing.span("openai chat completion", "api", model=request["model"]) as attributes:
+        response = client.chat.completions.create(**request, timeout=timeout)
+        content = response.choices[0].message.content or ""
+        attributes["output_bytes"] = len(content.encode())
+    return content
+
+# Generate a compose file for a chat completion request. Each round sends the request once, hedges with another copy
+# after `hedge_delay` seconds without an answer or as soon as an answer fails, up to `candidates` requests, and returns
+# the first answer that validates (see validate()) without waiting for the rest; a round in which no answer validates
+# is followed by another after a backoff, up to `attempts` rounds or `deadline` seconds in total. Identical requests
+# made while one is in progress share its result. Returns the YAML with any markdown fences removed. Raises
+# GenerationError with each answer's problems otherwise.
+def generate(request, api_key, expected_images=(), candidates=DEFAULT_CANDIDATES, deadline=DEFAULT_DEADLINE, attempts=DEFAULT_ATTEMPTS, hedge_delay=DEFAULT_HEDGE_DELAY):
+    key = compose_cache.request_key(request)
+    with _in_flight_lock:
+        pending = _in_flight.get(key)
+        if pending is None:
+            pending = _in_flight[key] = Future()
+            leader = True
+        else:
+            leader = False
+    if not leader:
+        print(f"Waiting for the Docker Compose file {key[:12]} already being generated.")
+        return pending.result()
+
+    try:
+        pending.set_result(run_rounds(request, api_key, expected_images, candidates, deadline, attempts, hedge_delay))
+    except BaseException as error:
+        pending.set_exception(error)
+    finally:
+        with _in_flight_lock:
+            del _in_flight[key]
+    return pending.result()
+
+# The rounds of hedged requests behind generate()
+def run_rounds(request, api_key, expected_images, candidates, deadline, attempts, hedge_delay):
+    # Imported here so runs that do not call the API do not pay for importing the client
+    from openai import OpenAI
+    # Retries are done here, across requests, rather than by the client
+    client = OpenAI(api_key=api_key, max_retries=0)
+    give_up_at = time.monotonic() + deadline
+    failures = []
+    backoff = INITIAL_BACKOFF
+
+    for attempt in range(1, attempts + 1):
+        if give_up_at - time.monotonic() <= 0:
+            break
+        # Daemon threads, so requests still in flight once an answer has been picked never hold up the program
+        answers = queue.Queue()
+        def ask(index, timeout):
+            try:
+                answers.put((index, request_candidate(client, request, timeout), None))
+            except Exception as error:
+                answers.put((index, None, f"{type(error).__name__}: {error}"))
+        launched = 0
+        def launch():
+            nonlocal launched
+            threading.Thread(target=ask, args=(launched, min(REQUEST_TIMEOUT, give_up_at - time.monotonic())), daemon=True).start()
+            launched += 1
+
+        launch()
+        answered = 0
+        while answered < launched:
+            remaining = give_up_at - time.monotonic()
+            hedge = launched < candidates and remaining > hedge_delay
+            try:
+                index, content, error = answers.get(timeout=max(min(remaining, hedge_delay) if hedge else remaining, 0))
+            except queue.Empty:
+                if hedge:
+                    print(f"No answer after {hedge_delay}s; sending another request.")
+                    launch()
+                    continue
+                failures.append(f"round {attempt}: deadline of {deadline}s passed")
+                break
+            answered += 1
+            if error:
+                failures.append(f"round {attempt}, request {index + 1}: {error}")
+            else:
+                compose_yaml = strip_fences(content)
+                _, problems = validate(compose_yaml, expected_images)
+                if not problems:
+                    if attempt > 1 or failures:
+                        print(f"Using request {index + 1} of round {attempt} after {len(failures)} failed answers.")
+                    return compose_yaml
+                failures.append(f"round {attempt}, request {index + 1}: {'; '.join(problems)}")
+            # Replace a failed answer straight away while the round has requests left
+            if launched < candidates and give_up_at - time.monotonic() > 0:
+                launch()
+
+        if attempt < attempts and give_up_at - time.monotonic() > backoff:
+            print(f"No valid Docker Compose file in round {attempt}; retrying in {backoff}s.")
+            time.sleep(backoff)
+            backoff = min(backoff * 2, MAX_BACKOFF)
+        else:
+            break
+
+    raise GenerationError("No valid Docker Compose file was generated:\n" + "\n".join(f"  {failure}" for failure in failures))
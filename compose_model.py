@@ -0,0 +1,106 @@
+import ipaddress
+import re
+import yaml
+
+# Short port syntax: [host_ip:][host_port[-end]:]container_port[-end][/protocol]. The host IP may be an IPv6 address
+# in brackets; ports may be ranges.
+SHORT_PORT = re.compile(
+    r"^(?:(?P<host_ip>\[[^\]]+\]|[^:\[\]]*):)??(?:(?P<published>\d+(?:-\d+)?)?:)?(?P<target>\d+(?:-\d+)?)(?:/(?P<protocol>\w+))?$"
+)
+
+# Docker also accepts an IPv6 host address without brackets, taking everything before the last two colons as the
+# address, e.g. "::1:8080:80"
+UNBRACKETED_IPV6_PORT = re.compile(
+    r"^(?P<host_ip>[0-9A-Fa-f.]*:[0-9A-Fa-f:.]*):(?P<published>\d+(?:-\d+)?)?:(?P<target>\d+(?:-\d+)?)(?:/(?P<protocol>\w+))?$"
+)
+
+# ${VAR} or $VAR interpolation, which docker compose resolves on the server from its environment and .env file
+INTERPOLATION = re.compile(r"\$(?:\{[^}]*\}|[A-Za-z_])")
+
+# An unquoted "a:b" scalar that YAML 1.1 reads as a base-60 integer, e.g. 22:22 as 1342; docker compose reads it as
+# a string
+SEXAGESIMAL_INT = re.compile(r"^[-+]?[1-9][0-9_]*(?::[0-5]?[0-9])+$")
+
+# An integer YAML read from base-60 notation, remembering the text it was written as
+class SexagesimalInt(int):
+    def __new__(cls, value, text):
+        number = super().__new__(cls, value)
+        number.text = text
+        return number
+
+# Safe loader that keeps base-60 integers recognizable, so a port written as an unquoted "a:b" can be reported
+class ComposeLoader(yaml.SafeLoader):
+    def construct_yaml_int(self, node):
+        value = super().construct_yaml_int(node)
+        return SexagesimalInt(value, node.value) if SEXAGESIMAL_INT.match(node.value) else value
+
+ComposeLoader.add_constructor("tag:yaml.org,2002:int", ComposeLoader.construct_yaml_int)
+
+# Parse a compose file like yaml.safe_load
+def load(stream):
+    return yaml.load(stream, Loader=ComposeLoader)
+
+# Expand "8080" or "8080-8082" into a list of ints
+def port_range(value):
+    start, _, end = str(value).partition("-")
+    return list(range(int(start), int(end or start) + 1))
+
+# One published port as a dict with host_ip (None for all interfaces), published (the host port, or None when
+# Docker picks one at random), target (the container port) and protocol
+def port_mapping(host_ip, published, target, protocol):
+    return {"host_ip": host_ip or None, "published": published, "target": target, "protocol": (protocol or "tcp").lower()}
+
+# Parse one entry of a service's ports list, in the short string or integer syntax or the long mapping syntax,
+# into one mapping per port (ranges are expanded). Raises ValueError for entries that cannot be parsed, including
+# ones that use variable interpolation, since their ports are only known on the server, and unquoted "a:b" entries
+# that YAML read as a base-60 number (load the file with load() to catch those).
+def parse_port(entry):
+    if isinstance(entry, SexagesimalInt):
+        raise ValueError(f"Port {entry.text} was read by YAML as the number {int(entry)}; quote it as \"{entry.text}\"")
+    if any(INTERPOLATION.search(str(value)) for value in (entry.values() if isinstance(entry, dict) else [entry])):
+        raise ValueError(f"Port {entry!r} uses variable interpolation; write the port number to route it")
+    if isinstance(entry, dict):
+        targets = port_range(entry["target"])
+        published = port_range(entry["published"]) if entry.get("published") not in (None, "") else None
+        host_ip = entry.get("host_ip")
+        protocol = entry.get("protocol")
+    else:
+        match = SHORT_PORT.match(str(entry).strip()) or UNBRACKETED_IPV6_PORT.match(str(entry).strip())
+        if not match:
+            raise ValueError(f"Unrecognized port syntax: {entry!r}")
+        targets = port_range(match["target"])
+        published = port_range(match["published"]) if match["published"] else None
+        host_ip = (match["host_ip"] or "").strip("[]")
+        protocol = match["protocol"]
+
+    if host_ip:
+        try:
+            ipaddress.ip_address(host_ip)
+        except ValueError:
+            raise ValueError(f"Host IP {host_ip!r} of port {entry!r} is not an IP address")
+    if published is None:
+        return [port_mapping(host_ip, None, target, protocol) for target in targets]
+    if len(published) == len(targets):
+        return [port_mapping(host_ip, host_port, target, protocol) for host_port, target in zip(published, targets)]
+    if len(targets) == 1:
+        # A host port range for a single container port: Docker binds whichever port in the range is free
+        return [port_mapping(host_ip, None, targets[0], protocol)]
+    raise ValueError(f"Host and container port ranges differ in length: {entry!r}")
+
+# Published ports of every service as {service name: [mapping, ...]}, printing a warning for entries that cannot be parsed
+def service_ports(compose_data):
+    ports = {}
+    for service_name, service_details in (compose_data.get("services") or {}).items():
+        ports[service_name] = []
+        for entry in (service_details or {}).get("ports") or []:
+            try:
+                ports[service_name] += parse_port(entry)
+            except (ValueError, KeyError) as error:
+                print(f"Warning: Skipping port {entry!r} of service {service_name}: {error}")
+    return ports
+
+# Address cloudflared on the same host should connect to for a mapping
+def local_address(mapping):
+    if mapping["host_ip"] in (None, "0.0.0.0", "::"):
+        return "localhost"
+    return f"[{mapping['host_ip']}]" if ":" in mapping["host_ip"] else mapping["host_ip"]
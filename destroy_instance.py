@@ -1,79 +1,138 @@
-import subprocess
-import json
+import argparse
 import os
+import sys
+import gcp
+import gcp_cache
+import fleet
+import setup
+import tracing
+from gcp import fetch_project_id, firewall_rule_names, format_hostname, data_disk_name
+from task_graph import run_task_graph, print_task_report
 
-# Load global variables from a file
-def load_variables():
-    variables = {}
-    with open("variables.txt", "r") as file:
-        for line in file:
-            if "=" in line:
-                key, value = line.split("=", 1)
-                variables[key.strip()] = value.strip().strip('"')
-    return variables
-
-# Check if variables.txt exists
-if not os.path.exists("variables.txt"):
-    print("variables.txt file is required to run this script.")
-    exit(1)
-
-# Load variables from variables.txt
-vars = load_variables()
-
-# Get variables
-app_hostname = vars.get("app_hostname")
-region = vars.get("region")
-formatted_hostname = app_hostname.replace('.', '-')  # Format hostname for GCP
+# Resources to delete for each host: its instance and static IP (both named after the formatted hostname),
+# its firewall rules (shared by all hosts unless firewall_scope="host") and its data disk if it has one
+def host_resources(host):
+    formatted_hostname = format_hostname(host["app_hostname"])
+    return {
+        "instance": formatted_hostname,
+        "static_ip": formatted_hostname,
+        "firewall_rules": firewall_rule_names(formatted_hostname, host.get("firewall_scope")),
+        "data_disk": data_disk_name(formatted_hostname) if int(host.get("data_disk_size") or 0) else None,
+        "region": host["region"],
+    }
+
+# Build the teardown graph for task_graph.run_task_graph. Firewall rules and instances do not depend on each other
+# and are deleted concurrently; a static IP is released, and a data disk deleted (unless keep_data_disks), once the
+# instance using it is gone. Every task returns None on success or an error message.
+def teardown_tasks(hosts, project_id, keep_data_disks=True):
+    tasks = {}
+    for host in hosts:
+        resources = host_resources(host)
+        region = resources["region"]
+        instance_task = f"instance {resources['instance']}"
+
+        for rule in resources["firewall_rules"]:
+            # Shared rules appear once however many hosts use them
+            tasks[f"firewall {rule}"] = (lambda rule=rule: gcp.delete_firewall_rule(rule, project_id), [])
+        tasks[instance_task] = (lambda name=resources["instance"], region=region: gcp.delete_instance(name, f"{region}-a", project_id), [])
+
+        def delete_static_ip(name=resources["static_ip"], region=region, instance_task=instance_task, **dependencies):
+            if dependencies[instance_task]:
+                return "skipped because the instance could not be deleted"
+            error = gcp.delete_static_ip(name, region, project_id)
+            # Drop the cached address so the next setup.py run does not reuse it
+            if not error and project_id:
+                gcp_cache.invalidate(project_id, key=gcp_cache.address_key(region, name))
+            return error
+
+        tasks[f"static_ip {resources['static_ip']}"] = (delete_static_ip, [instance_task])
+
+        if resources["data_disk"] and not keep_data_disks:
+            def delete_data_disk(name=resources["data_disk"], region=region, instance_task=instance_task, **dependencies):
+                if dependencies[instance_task]:
+                    return "skipped because the instance could not be deleted"
+                return gcp.delete_disk(name, f"{region}-a", project_id)
+
+            tasks[f"disk {resources['data_disk']}"] = (delete_data_disk, [instance_task])
+    return tasks
 
 # Function to confirm deletion
-def confirm_deletion():
-    print(f"Instance to be deleted: {formatted_hostname}")
-    print(f"Static IP to be deleted: {formatted_hostname}")  # Assuming the static IP has the same name
-    print("The following firewall rules will also be deleted: http-ingress, https-ingress")
+def confirm_deletion(hosts, keep_data_disks=True):
+    for host in hosts:
+        resources = host_resources(host)
+        print(f"Instance to be deleted: {resources['instance']}")
+        print(f"Static IP to be deleted: {resources['static_ip']}")  # Assuming the static IP has the same name
+        print(f"The following firewall rules will also be deleted: {', '.join(resources['firewall_rules'])}")
+        if resources["data_disk"]:
+            print(f"Data disk {'to be kept' if keep_data_disks else 'to be deleted'}: {resources['data_disk']}")
     confirmation = input("Are you sure you want to delete the above resources? (yes/no): ")
     return confirmation.lower() == 'yes'
 
-# Function to delete firewall rules
-def delete_firewall_rules():
-    rules = ["http-ingress", "https-ingress"]
-    for rule in rules:
-        result = subprocess.run(
-            ["gcloud", "compute", "firewall-rules", "delete", rule, "--quiet"],
-            capture_output=True, text=True
-        )
-        if result.returncode != 0:
-            print(f"Error deleting firewall rule {rule}:", result.stderr)
-        else:
-            print(f"Firewall rule {rule} deleted successfully.")
-
-# Function to delete the GCP instance
-def delete_instance():
-    print(f"Deleting instance: {formatted_hostname}")
-    result = subprocess.run(
-        ["gcloud", "compute", "instances", "delete", formatted_hostname, "--zone", f"{region}-a", "--quiet"],
-        capture_output=True, text=True
-    )
-    if result.returncode != 0:
-        print("Error deleting instance:", result.stderr)
+# Ask whether to delete the hosts' data disks; keeping them is the default since they hold the services' data
+def ask_delete_data_disks(hosts):
+    if not any(host_resources(host)["data_disk"] for host in hosts):
+        return False
+    answer = input("Delete the data disks as well? Their data cannot be recovered. (yes/no) [no]: ")
+    return answer.lower() == 'yes'
+
+# Whether to keep the hosts' data disks: data_disk ("keep" or "delete") if given, otherwise keep them with assume_yes
+# and ask when not. Data disks outlive their instance unless deletion is asked for.
+def choose_keep_data_disks(hosts, data_disk=None, assume_yes=False):
+    if data_disk:
+        return data_disk == "keep"
+    return assume_yes or not ask_delete_data_disks(hosts)
+
+# Delete every host's resources, printing any errors and how long each deletion took. Returns True if all succeeded.
+def destroy(hosts, project_id, keep_data_disks=True):
+    results, durations, wall_time = run_task_graph(teardown_tasks(hosts, project_id, keep_data_disks))
+    for name in sorted(results):
+        if results[name]:
+            print(f"Error deleting {name}: {results[name]}")
+    print_task_report("Teardown", durations, wall_time)
+    return not any(results.values())
+
+# Main execution
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Delete the VM, static IP and firewall rules of one or more hosts.")
+    parser.add_argument("hostnames", nargs="*", help="hostnames to tear down (default: app_hostname from variables.txt)")
+    parser.add_argument("--manifest", help="tear down every host in a fleet.py manifest")
+    parser.add_argument("--yes", action="store_true", help="do not ask for confirmation")
+    parser.add_argument("--trace-dir", help="also write the trace of GCP calls (trace.jsonl and trace.json) to this directory")
+    parser.add_argument("--data-disk", choices=["keep", "delete"], help="keep or delete hosts' data disks (default: ask, or keep with --yes)")
+    args = parser.parse_args()
+
+    # Check if variables.txt exists
+    if not os.path.exists("variables.txt"):
+        print("variables.txt file is required to run this script.")
+        exit(1)
+
+    # Load variables from variables.txt
+    vars = setup.load_variables("variables.txt")
+
+    # Allow variables.txt to turn off the on-disk gcloud result cache
+    if vars.get("gcloud_cache", "on").lower() == "off":
+        gcp_cache.enabled = False
+
+    # Hosts come from the manifest, the command line or variables.txt; each inherits region and firewall_scope from variables.txt
+    if args.manifest:
+        hosts = fleet.load_manifest(args.manifest, vars)
     else:
-        print("Instance deleted successfully.")
-
-# Function to delete the static IP
-def delete_static_ip():
-    print(f"Deleting static IP: {formatted_hostname}")
-    result = subprocess.run(
-        ["gcloud", "compute", "addresses", "delete", formatted_hostname, "--region", region, "--quiet"],
-        capture_output=True, text=True
-    )
-    if result.returncode != 0:
-        print("Error deleting static IP:", result.stderr)
+        hosts = [{**vars, "app_hostname": hostname} for hostname in args.hostnames or [vars.get("app_hostname")]]
+
+    # Trace GCP calls unless trace="off", printing a summary at exit
+    if vars.get("trace") == "off":
+        tracing.enabled = False
     else:
-        print("Static IP deleted successfully.")
+        tracing.configure(args.trace_dir)
 
-# Main execution
-if confirm_deletion():
-    delete_firewall_rules()
-    delete_instance()
-    delete_static_ip()
-else:
-    print("Deletion canceled.")
\ No newline at end of file
+    # Call GCP through gcloud (default) or the REST API (gcp_backend="rest")
+    gcp.use_backend(vars.get("gcp_backend"), format_hostname(hosts[0]["app_hostname"]) if len(hosts) == 1 else ".")
+    project_id = vars.get("project_id") or fetch_project_id()
+
+    keep_data_disks = choose_keep_data_disks(hosts, args.data_disk, args.yes)
+
+    if args.yes or confirm_deletion(hosts, keep_data_disks):
+        tracing.start_phase("teardown")
+        sys.exit(0 if destroy(hosts, project_id, keep_data_disks) else 1)
+    else:
+        print("Deletion canceled.")
@@ -0,0 +1,214 @@
+import argparse
+import contextlib
+import contextvars
+import os
+import subprocess
+import sys
+import time
+import traceback
+import yaml
+from concurrent.futures import ThreadPoolExecutor
+import gcp_cache
+import gcp
+import tf_runner
+import tracing
+import setup
+from gcp import fetch_project_id, fetch_service_account_key, format_hostname
+
+# Per-host variables files and logs are written here
+FLEET_DIR = ".fleet"
+
+# Load the fleet manifest and return one variables dict per host.
+# The manifest is YAML with optional "defaults" and a list of "hosts"; each host is either a hostname
+# or a mapping of variables.txt keys. Host values override defaults, which override variables.txt.
+def load_manifest(manifest_path, base_variables):
+    with open(manifest_path, "r") as file:
+        manifest = yaml.safe_load(file) or {}
+
+    defaults = {**base_variables, **{key: str(value) for key, value in (manifest.get("defaults") or {}).items()}}
+    hosts = []
+    for entry in manifest.get("hosts") or []:
+        if isinstance(entry, str):
+            entry = {"app_hostname": entry}
+        host = {**defaults, **{key: str(value) for key, value in entry.items()}}
+        if not host.get("app_hostname"):
+            print(f"Error: Manifest entry {entry} has no app_hostname.")
+            sys.exit(1)
+        # Hosts in a fleet each get their own firewall rules so they can be torn down independently
+        host.setdefault("firewall_scope", "host")
+        hosts.append(host)
+
+    hostnames = [host["app_hostname"] for host in hosts]
+    duplicates = sorted({hostname for hostname in hostnames if hostnames.count(hostname) > 1})
+    if duplicates:
+        print(f"Error: Duplicate hostnames in manifest: {', '.join(duplicates)}")
+        sys.exit(1)
+    return hosts
+
+# Write a variables file that setup.py can read with --variables
+def write_variables(variables_path, variables):
+    with open(variables_path, "w") as file:
+        for key, value in variables.items():
+            file.write(f'{key}="{value}"\n')
+
+# Sends what each host prints to the file registered for it with redirect(), and everything else to the real stdout.
+# Hosts render on worker threads of one process, so their output is separated per context rather than per process.
+# The file is held in a context variable, so the task_graph workers and background threads a host's render starts
+# (which run in a copy of its context) print to the host's log as well.
+class ThreadOutput:
+    def __init__(self, stream):
+        self.stream = stream
+        self.file = contextvars.ContextVar(f"output_file_{id(self)}", default=None)
+
+    def target(self):
+        return self.file.get() or self.stream
+
+    def write(self, text):
+        return self.target().write(text)
+
+    def flush(self):
+        self.target().flush()
+
+    @contextlib.contextmanager
+    def redirect(self, file):
+        token = self.file.set(file)
+        try:
+            yield
+        finally:
+            self.file.reset(token)
+
+# Render one host's app_dir in this process with setup.py's preflight and render stages, logging its output.
+# Needs sys.stdout and sys.stderr to be ThreadOutputs, as they are while the fleet renders.
+# The variables file is still written so a host can be re-rendered by hand with setup.py --variables.
+def render_host(host):
+    app_dir = format_hostname(host["app_hostname"])
+    variables_path = os.path.join(FLEET_DIR, f"{app_dir}.variables.txt")
+    log_path = os.path.join(FLEET_DIR, f"{app_dir}.render.log")
+    write_variables(variables_path, host)
+
+    start = time.monotonic()
+    with open(log_path, "w") as log_file, sys.stdout.redirect(log_file), sys.stderr.redirect(log_file):
+        try:
+            setup_host = setup.Host(host)
+            setup.preflight(setup_host)
+            setup.render(setup_host)
+            ok = True
+        except SystemExit as error:
+            ok = not error.code
+        except ValueError as error:
+            print(f"Error: {error}")
+            ok = False
+        except Exception:
+            traceback.print_exc(file=log_file)
+            ok = False
+    return ok, time.monotonic() - start, log_path
+
+# Run terraform init (when needed) and apply (when the plan has changes) in a rendered app_dir, logging to terraform.log inside it
+def deploy_host(host):
+    app_dir = format_hostname(host["app_hostname"])
+    log_path = os.path.join(app_dir, "terraform.log")
+
+    start = time.monotonic()
+    with open(log_path, "w") as log_file:
+        run_kwargs = {"stdout": log_file, "stderr": subprocess.STDOUT, "stdin": subprocess.DEVNULL}
+        if not tf_runner.init(app_dir, **run_kwargs):
+            return False, time.monotonic() - start, log_path
+        status, _ = tf_runner.plan(app_dir, **run_kwargs)
+        if status != "changes":
+            return status == "unchanged", time.monotonic() - start, log_path
+
+        def log_event(event):
+            message = tf_runner.event_message(event)
+            if message is not None:
+                log_file.write(message + "\n")
+                log_file.flush()
+
+        returncode, timings = tf_runner.stream_apply(app_dir, on_event=log_event, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL)
+        for address, seconds in sorted(timings.items(), key=lambda item: item[1], reverse=True):
+            log_file.write(f"{address}: {seconds:.1f}s\n")
+    return returncode == 0, time.monotonic() - start, log_path
+
+# Print a per-host table of render and deploy results and return True if every step succeeded
+def print_summary(hosts, render_results, deploy_results):
+    print("\nFleet summary:")
+    print(f"  {'HOST':<40} {'RENDER':<8} {'DEPLOY':<8} {'TIME':>8}")
+    all_ok = True
+    for host in hosts:
+        hostname = host["app_hostname"]
+        render_ok, render_time, render_log = render_results[hostname]
+        deploy_status, deploy_time, log_path = "skipped", 0.0, render_log
+        if not render_ok:
+            all_ok = False
+        elif hostname in deploy_results:
+            deploy_ok, deploy_time, deploy_log = deploy_results[hostname]
+            deploy_status = "ok" if deploy_ok else "failed"
+            all_ok = all_ok and deploy_ok
+            log_path = deploy_log
+        failed = not render_ok or deploy_status == "failed"
+        note = f"  (see {log_path})" if failed else ""
+        print(f"  {hostname:<40} {'ok' if render_ok else 'failed':<8} {deploy_status:<8} {render_time + deploy_time:>7.1f}s{note}")
+    return all_ok
+
+# Main execution
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render and deploy many CloudTailor hosts from a manifest.")
+    parser.add_argument("manifest", help="YAML manifest with optional 'defaults' and a list of 'hosts'")
+    parser.add_argument("--variables", default="variables.txt", help="base variables file shared by every host (default: variables.txt)")
+    parser.add_argument("--workers", type=int, default=8, help="number of hosts rendered in parallel (default: 8)")
+    parser.add_argument("--deploy", action="store_true", help="run terraform init and apply for every host that rendered successfully")
+    parser.add_argument("--terraform-concurrency", type=int, default=4, help="maximum number of concurrent terraform runs (default: 4)")
+    args = parser.parse_args()
+
+    base_variables = setup.load_variables(args.variables) if os.path.exists(args.variables) else {}
+    if base_variables.get("gcloud_cache", "on").lower() == "off":
+        gcp_cache.enabled = False
+    if base_variables.get("terraform_plugin_cache", "on").lower() == "off":
+        tf_runner.plugin_cache_enabled = False
+    gcp.use_backend(base_variables.get("gcp_backend"))
+    hosts = load_manifest(args.manifest, base_variables)
+    if not hosts:
+        print("The manifest does not list any hosts.")
+        sys.exit(1)
+    os.makedirs(FLEET_DIR, exist_ok=True)
+
+    # Trace the fleet's commands, including every host's render, into FLEET_DIR
+    trace_mode = base_variables.get("trace") or "on"
+    if trace_mode == "off":
+        tracing.enabled = False
+    else:
+        tracing.configure(FLEET_DIR if trace_mode == "on" else None)
+    tracing.start_phase("preflight")
+
+    # Shared lookups are done once for the whole fleet: every host gets the project ID in its variables
+    # and setup.py copies the service account key from this directory instead of creating one per host
+    project_id = base_variables.get("project_id") or fetch_project_id()
+    if not project_id:
+        print("Error: Unable to determine the GCP project ID. Run `gcloud config set project <PROJECT_ID>`.")
+        sys.exit(1)
+    if fetch_service_account_key(project_id, ".") is None:
+        print("Error: Unable to fetch or create a service account key.")
+        sys.exit(1)
+    for host in hosts:
+        host["project_id"] = project_id
+
+    fleet_start = time.monotonic()
+    tracing.start_phase("render")
+    print(f"Rendering {len(hosts)} hosts with {args.workers} workers...")
+    sys.stdout, sys.stderr = ThreadOutput(sys.stdout), ThreadOutput(sys.stderr)
+    try:
+        with ThreadPoolExecutor(max_workers=args.workers) as pool:
+            render_results = dict(zip([host["app_hostname"] for host in hosts], pool.map(render_host, hosts)))
+    finally:
+        sys.stdout, sys.stderr = sys.stdout.stream, sys.stderr.stream
+
+    deploy_results = {}
+    if args.deploy:
+        rendered_hosts = [host for host in hosts if render_results[host["app_hostname"]][0]]
+        tracing.start_phase("deploy")
+        print(f"Deploying {len(rendered_hosts)} hosts with up to {args.terraform_concurrency} concurrent terraform runs...")
+        with ThreadPoolExecutor(max_workers=args.terraform_concurrency) as pool:
+            deploy_results = dict(zip([host["app_hostname"] for host in rendered_hosts], pool.map(deploy_host, rendered_hosts)))
+
+    all_ok = print_summary(hosts, render_results, deploy_results)
+    print(f"\nFleet run finished in {time.monotonic() - fleet_start:.1f}s.")
+    sys.exit(0 if all_ok else 1)
@@ -0,0 +1,223 @@
+import json
+import os
+import shutil
+import gcp_cache
+import gcp_rest
+import tracing
+
+# How GCP is called: "gcloud" runs the CLI for each call, "rest" calls the Compute and IAM APIs over one pooled
+# HTTP session (see use_backend)
+backend = "gcloud"
+
+# Select the backend. The REST backend authenticates with the service account key in app_dir or its parent
+# directory if there is one, or with Application Default Credentials; it falls back to gcloud if it cannot start.
+def use_backend(name, app_dir="."):
+    global backend
+    backend = "gcloud"
+    if name != "rest":
+        return backend
+    key_paths = [os.path.join(app_dir, "service-account-key.json"), os.path.join(os.path.dirname(app_dir), "service-account-key.json")]
+    if gcp_rest.configure(next((path for path in key_paths if os.path.exists(path)), None)):
+        backend = "rest"
+    else:
+        print("Falling back to the gcloud CLI.")
+    return backend
+
+# Fetch project ID using Google Cloud CLI, or from the REST backend's credentials
+def fetch_project_id():
+    if backend == "rest" and gcp_rest.project_id:
+        return gcp_rest.project_id
+
+    def query_project_id():
+        result = tracing.run(["gcloud", "config", "get-value", "project"], capture_output=True, text=True)
+        return result.stdout.strip() or None
+
+    return gcp_cache.cached(gcp_cache.CONFIG_SCOPE, gcp_cache.project_id_key(), query_project_id)
+
+# Format hostname to comply with GCP naming conventions
+def format_hostname(hostname):
+    return hostname.replace('.', '-')
+
+# Names of the HTTP and HTTPS firewall rules for a host.
+# The default "shared" scope uses one pair of rules for the whole project; "host" gives each host its own pair
+# so several hosts can be created and destroyed independently (fleet.py uses this).
+def firewall_rule_names(formatted_hostname, firewall_scope=None):
+    if firewall_scope == "host":
+        return f"{formatted_hostname}-http-ingress", f"{formatted_hostname}-https-ingress"
+    return "http-ingress", "https-ingress"
+
+# Name of a host's optional persistent data disk (data_disk_size)
+def data_disk_name(formatted_hostname):
+    return f"{formatted_hostname}-data"
+
+# Fetch or create a Google Cloud service account key
+def fetch_service_account_key(project_id, app_dir):
+    key_filename = os.path.join(app_dir, "service-account-key.json")  # Save in app_dir
+    parent_key_filename = os.path.join(os.path.dirname(app_dir), "service-account-key.json")  # Check in parent directory
+
+    # Check if the service account key file already exists in the app_dir
+    if os.path.exists(key_filename):
+        print(f"{key_filename} already exists. Skipping key generation.")
+        return key_filename
+
+    # Check if the service account key file exists in the parent directory
+    if os.path.exists(parent_key_filename):
+        print(f"Found service account key in parent directory: {parent_key_filename}. Copying to {app_dir}.")
+        shutil.copy(parent_key_filename, key_filename)
+        return key_filename
+
+    # Fetch service account details and look for the Compute Engine default service account
+    def find_compute_engine_service_account():
+        if backend == "rest":
+            accounts_json = gcp_rest.list_service_accounts(project_id)
+        else:
+            accounts = tracing.run(["gcloud", "iam", "service-accounts", "list", "--project", project_id, "--format=json"], capture_output=True, text=True)
+            accounts_json = json.loads(accounts.stdout)
+        for account in accounts_json:
+            if 'Compute Engine default service account' in account.get('displayName', ''):
+                return account["email"]
+        return None
+
+    try:
+        compute_engine_service_account = gcp_cache.cached(project_id, "service_accounts:compute_default", find_compute_engine_service_account)
+    except gcp_rest.GcpApiError as error:
+        print("Error listing service accounts:", error)
+        return None
+
+    if not compute_engine_service_account:
+        print("Compute Engine default service account not found.")
+        return None
+
+    if backend == "rest":
+        try:
+            key_data = gcp_rest.create_service_account_key(project_id, compute_engine_service_account)
+        except gcp_rest.GcpApiError as error:
+            print("Error creating service account key:", error)
+            return None
+        with open(key_filename, "wb") as file:
+            file.write(key_data)
+        return key_filename
+
+    # Creating a service account key
+    create_key_result = tracing.run(
+        ["gcloud", "iam", "service-accounts", "keys", "create", key_filename, "--iam-account", compute_engine_service_account, "--project", project_id],
+        capture_output=True, text=True
+    )
+
+    if create_key_result.returncode != 0:
+        # Handle error in key creation
+        print("Error creating service account key:", create_key_result.stderr)
+        return None
+
+    return key_filename
+
+# Check for or create a static IP in GCP
+def check_static_ip(hostname, region, project_id):
+    formatted_hostname = format_hostname(hostname)
+    cache_key = gcp_cache.address_key(region, formatted_hostname)
+
+    # Reuse the address from a previous run if it is still cached
+    cached_address = gcp_cache.get(project_id, cache_key)
+    if cached_address:
+        print(f"Using cached static IP {cached_address} for {formatted_hostname}.")
+        return cached_address, formatted_hostname
+
+    if backend == "rest":
+        return rest_static_ip(formatted_hostname, region, project_id, cache_key)
+
+    # Check if the static IP exists
+    result = tracing.run(["gcloud", "compute", "addresses", "list", "--project", project_id, "--filter=NAME=" + formatted_hostname + " AND region:" + region, "--format=json"], capture_output=True, text=True)
+
+    if result.returncode != 0:
+        # Handle error in listing IPs
+        print("Error listing static IPs:", result.stderr)
+        return None, None
+
+    addresses = json.loads(result.stdout)
+    for address in addresses:
+        if address["name"] == formatted_hostname:
+            # Return the IP address and the formatted hostname
+            gcp_cache.put(project_id, cache_key, address["address"])
+            return address["address"], formatted_hostname
+
+    # If no static IP, create one
+    create_result = tracing.run(["gcloud", "compute", "addresses", "create", formatted_hostname, "--project", project_id, "--region", region, "--network-tier", "STANDARD"], capture_output=True, text=True)
+    if create_result.returncode != 0:
+        # Handle error in creating IP
+        print("Error creating static IP:", create_result.stderr)
+        return None, None
+
+    new_address_result = tracing.run(["gcloud", "compute", "addresses", "describe", formatted_hostname, "--project", project_id, "--region", region, "--format=json"], capture_output=True, text=True)
+    if new_address_result.returncode != 0:
+        # Handle error in describing new IP
+        print("Error describing new static IP:", new_address_result.stderr)
+        return None, None
+
+    # The address was just created, so replace anything cached under its name
+    new_address = json.loads(new_address_result.stdout)
+    gcp_cache.put(project_id, cache_key, new_address["address"])
+    return new_address["address"], formatted_hostname
+
+# check_static_ip for the REST backend: one GET for the named address, and a create only if it is missing
+def rest_static_ip(formatted_hostname, region, project_id, cache_key):
+    try:
+        address = gcp_rest.get_address(project_id, region, formatted_hostname)
+        if address is None:
+            address = gcp_rest.create_address(project_id, region, formatted_hostname)
+    except gcp_rest.GcpApiError as error:
+        print("Error checking or creating static IP:", error)
+        return None, None
+
+    gcp_cache.put(project_id, cache_key, address["address"])
+    return address["address"], formatted_hostname
+
+# Delete an instance, static IP, disk or firewall rule and wait for it to be gone. Returns None on success, including
+# when the resource does not exist (it was never created or an earlier teardown removed it), or an error message.
+def delete_instance(name, zone, project_id):
+    if backend == "rest":
+        return rest_delete(gcp_rest.delete_instance, project_id, zone, name)
+    return gcloud_delete(["compute", "instances", "delete", name, "--zone", zone], project_id, ["--zone", zone])
+
+def delete_static_ip(name, region, project_id):
+    if backend == "rest":
+        return rest_delete(gcp_rest.delete_address, project_id, region, name)
+    return gcloud_delete(["compute", "addresses", "delete", name, "--region", region], project_id, ["--region", region])
+
+def delete_disk(name, zone, project_id):
+    if backend == "rest":
+        return rest_delete(gcp_rest.delete_disk, project_id, zone, name)
+    return gcloud_delete(["compute", "disks", "delete", name, "--zone", zone], project_id, ["--zone", zone])
+
+def delete_firewall_rule(name, project_id):
+    if backend == "rest":
+        return rest_delete(gcp_rest.delete_firewall, project_id, name)
+    return gcloud_delete(["compute", "firewall-rules", "delete", name], project_id)
+
+def rest_delete(delete, *args):
+    try:
+        gcp_rest.wait_for_operation(delete(*args))
+    except gcp_rest.GcpApiError as error:
+        return None if error.status == 404 else str(error)
+    return None
+
+# Whether a failed gcloud command only failed because the resource it acts on does not exist
+def gcloud_not_found(result):
+    return result.returncode != 0 and "was not found" in result.stderr
+
+# Run a gcloud delete command. Commands that take --async (those given the location flags of their operations in
+# operation_flags) return as soon as the deletion has started, and its operations are then waited on together with
+# `gcloud compute operations wait`; firewall rules have no --async, so their delete blocks until it is done.
+def gcloud_delete(command, project_id, operation_flags=None):
+    project_flags = ["--project", project_id] if project_id else []
+    if operation_flags is None:
+        result = tracing.run(["gcloud", *command, *project_flags, "--quiet"], capture_output=True, text=True)
+        return result.stderr if result.returncode != 0 and not gcloud_not_found(result) else None
+
+    result = tracing.run(["gcloud", *command, *project_flags, "--quiet", "--async", "--format=value(name)"], capture_output=True, text=True)
+    if result.returncode != 0:
+        return None if gcloud_not_found(result) else result.stderr
+    operations = result.stdout.split()
+    if not operations:
+        return None
+    wait_result = tracing.run(["gcloud", "compute", "operations", "wait", *operations, *operation_flags, *project_flags], capture_output=True, text=True)
+    return wait_result.stderr if wait_result.returncode != 0 else None
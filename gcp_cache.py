@@ -0,0 +1,126 @@
+import json
+import os
+import sys
+import threading
+import time
+
+# Cached gcloud results live in one JSON file per project under this directory
+CACHE_DIR = os.environ.get("CLOUDTAILOR_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "cloudtailor", "gcloud"))
+
+# Seconds each kind of result stays fresh; the key prefix before the first ":" selects the TTL
+DEFAULT_TTLS = {
+    "project_id": 24 * 60 * 60,
+    "service_accounts": 24 * 60 * 60,
+    "address": 7 * 24 * 60 * 60,
+}
+
+# Project IDs are looked up before the project is known, so they share this pseudo-project file
+CONFIG_SCOPE = "_gcloud_config"
+
+_lock = threading.Lock()
+
+# Set CLOUDTAILOR_GCLOUD_CACHE=off (or gcloud_cache="off" in variables.txt) to always query GCP
+enabled = os.environ.get("CLOUDTAILOR_GCLOUD_CACHE", "on").lower() not in ("off", "0", "no", "false")
+
+# Path of the cache file for a project
+def cache_path(project):
+    return os.path.join(CACHE_DIR, f"{project}.json")
+
+# Read all entries for a project, treating a missing or corrupt file as empty
+def _load(project):
+    try:
+        with open(cache_path(project), "r") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+# Atomically replace the cache file for a project
+def _save(project, entries):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    temp_path = f"{cache_path(project)}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, "w") as file:
+        json.dump(entries, file, indent=2, sort_keys=True)
+    os.replace(temp_path, cache_path(project))
+
+# Return the cached value for key, or None if it is missing or expired
+def get(project, key):
+    if not enabled or not project:
+        return None
+    entry = _load(project).get(key)
+    if entry is None or entry.get("expires_at", 0) < time.time():
+        return None
+    return entry["value"]
+
+# Store a value for key with the TTL for its kind
+def put(project, key, value, ttl=None):
+    if not enabled or not project:
+        return
+    if ttl is None:
+        ttl = DEFAULT_TTLS.get(key.split(":", 1)[0], 60 * 60)
+    with _lock:
+        entries = _load(project)
+        entries[key] = {"value": value, "expires_at": time.time() + ttl}
+        _save(project, entries)
+
+# Remove entries for a project: a single key, every key starting with prefix, or everything
+def invalidate(project, key=None, prefix=None):
+    with _lock:
+        if key is None and prefix is None:
+            if os.path.exists(cache_path(project)):
+                os.remove(cache_path(project))
+            return
+        entries = _load(project)
+        for cached_key in list(entries):
+            if cached_key == key or (prefix is not None and cached_key.startswith(prefix)):
+                del entries[cached_key]
+        _save(project, entries)
+
+# Return the cached value for key, calling fetch() and caching its result on a miss.
+# None results are never cached so failed lookups are retried on the next run.
+def cached(project, key, fetch, ttl=None):
+    value = get(project, key)
+    if value is not None:
+        print(f"Using cached gcloud result for {key}.")
+        return value
+    value = fetch()
+    if value is not None:
+        put(project, key, value, ttl)
+    return value
+
+# Key for the project ID of the active gcloud configuration.
+# The configuration file's mtime is part of the key so `gcloud config set project` invalidates it.
+def project_id_key():
+    config_dir = os.environ.get("CLOUDSDK_CONFIG", os.path.join(os.path.expanduser("~"), ".config", "gcloud"))
+    config_name = os.environ.get("CLOUDSDK_ACTIVE_CONFIG_NAME")
+    if not config_name:
+        try:
+            with open(os.path.join(config_dir, "active_config"), "r") as file:
+                config_name = file.read().strip()
+        except OSError:
+            config_name = "default"
+    try:
+        mtime = int(os.path.getmtime(os.path.join(config_dir, "configurations", f"config_{config_name}")))
+    except OSError:
+        mtime = 0
+    return f"project_id:{config_name}:{mtime}"
+
+# Key for a regional static IP address
+def address_key(region, name):
+    return f"address:{region}:{name}"
+
+# Command line entry point: python gcp_cache.py show|clear [project]
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in ("show", "clear"):
+        print("Usage: python gcp_cache.py show|clear [project]")
+        sys.exit(1)
+    projects = sys.argv[2:]
+    if not projects and os.path.isdir(CACHE_DIR):
+        projects = [name[:-len(".json")] for name in sorted(os.listdir(CACHE_DIR)) if name.endswith(".json")]
+    for project in projects:
+        if sys.argv[1] == "clear":
+            invalidate(project)
+            print(f"Cleared cached gcloud results for {project}.")
+        else:
+            for key, entry in sorted(_load(project).items()):
+                remaining = int(entry.get("expires_at", 0) - time.time())
+                print(f"{project} {key} (expires in {remaining}s): {json.dumps(entry['value'])}")
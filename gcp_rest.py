@@ -0,0 +1,121 @@
+import base64
+import os
+import time
+import tracing
+
+# Compute Engine and IAM REST endpoints. CLOUDTAILOR_GCP_API_ENDPOINT points both at another server
+# (e.g. a local fake API such as bench/gcp_stub.py), which is then called without credentials for the project in
+# GOOGLE_CLOUD_PROJECT.
+API_ENDPOINT = os.environ.get("CLOUDTAILOR_GCP_API_ENDPOINT")
+COMPUTE_URL = f"{API_ENDPOINT}/compute/v1" if API_ENDPOINT else "https://compute.googleapis.com/compute/v1"
+IAM_URL = f"{API_ENDPOINT}/v1" if API_ENDPOINT else "https://iam.googleapis.com/v1"
+SCOPES = ["https://www.googleapis.com/auth/cloud-platform"]
+
+# Give up on a long-running operation after this many seconds
+OPERATION_TIMEOUT = 300
+
+# Shared authorized session (a pooled, keep-alive requests.Session) and the project of its credentials,
+# set by configure()
+session = None
+project_id = None
+
+class GcpApiError(Exception):
+    def __init__(self, status, message):
+        super().__init__(f"HTTP {status}: {message}")
+        self.status = status
+
+# Create the shared session, authenticated with the service account key at credentials_path if it exists or with
+# Application Default Credentials otherwise. Returns False if google-auth is missing or no credentials are found.
+def configure(credentials_path=None):
+    global session, project_id
+    try:
+        import google.auth
+        from google.auth.credentials import AnonymousCredentials
+        from google.auth.exceptions import DefaultCredentialsError
+        from google.auth.transport.requests import AuthorizedSession
+        from google.oauth2 import service_account
+    except ImportError:
+        print("The REST backend needs google-auth and requests (pip install google-auth requests).")
+        return False
+
+    if API_ENDPOINT:
+        credentials = AnonymousCredentials()
+        project_id = os.environ.get("GOOGLE_CLOUD_PROJECT")
+    elif credentials_path and os.path.exists(credentials_path):
+        credentials = service_account.Credentials.from_service_account_file(credentials_path, scopes=SCOPES)
+        project_id = credentials.project_id
+    else:
+        try:
+            credentials, project_id = google.auth.default(scopes=SCOPES)
+        except DefaultCredentialsError as error:
+            print(f"No credentials for the REST backend: {error}")
+            return False
+
+    session = AuthorizedSession(credentials)
+    return True
+
+# Send a request through the shared session and return the decoded JSON body (None for 404 when allow_missing)
+def request(method, url, allow_missing=False, **kwargs):
+    with tracing.span(f"{method} {url.split('/', 3)[-1]}", "http", method=method, url=url) as attributes:
+        response = session.request(method, url, **kwargs)
+        attributes.update(status=response.status_code, output_bytes=len(response.content))
+    if allow_missing and response.status_code == 404:
+        return None
+    if response.status_code >= 400:
+        try:
+            message = response.json()["error"]["message"]
+        except (ValueError, KeyError, TypeError):
+            message = response.text
+        raise GcpApiError(response.status_code, message)
+    return response.json() if response.content else {}
+
+# Wait for a Compute Engine operation to finish, raising GcpApiError if it failed
+def wait_for_operation(operation):
+    deadline = time.monotonic() + OPERATION_TIMEOUT
+    while operation.get("status") != "DONE":
+        if time.monotonic() > deadline:
+            raise GcpApiError(504, f"Operation {operation.get('name')} did not finish within {OPERATION_TIMEOUT}s")
+        # The wait method blocks server-side until the operation is done or about two minutes have passed
+        operation = request("POST", f"{operation['selfLink']}/wait")
+    errors = (operation.get("error") or {}).get("errors")
+    if errors:
+        raise GcpApiError(operation.get("httpErrorStatusCode", 500), "; ".join(error.get("message", "") for error in errors))
+    return operation
+
+# List a project's service accounts
+def list_service_accounts(project_id):
+    accounts = []
+    params = {}
+    while True:
+        page = request("GET", f"{IAM_URL}/projects/{project_id}/serviceAccounts", params=params)
+        accounts += page.get("accounts", [])
+        if not page.get("nextPageToken"):
+            return accounts
+        params["pageToken"] = page["nextPageToken"]
+
+# Create a key for a service account and return the key file contents
+def create_service_account_key(project_id, email):
+    key = request("POST", f"{IAM_URL}/projects/{project_id}/serviceAccounts/{email}/keys", json={})
+    return base64.b64decode(key["privateKeyData"])
+
+# Return a regional address, or None if it does not exist
+def get_address(project_id, region, name):
+    return request("GET", f"{COMPUTE_URL}/projects/{project_id}/regions/{region}/addresses/{name}", allow_missing=True)
+
+# Create a regional address on the standard network tier and return it
+def create_address(project_id, region, name):
+    wait_for_operation(request("POST", f"{COMPUTE_URL}/projects/{project_id}/regions/{region}/addresses", json={"name": name, "networkTier": "STANDARD"}))
+    return get_address(project_id, region, name)
+
+# Start deleting a resource and return its operation; wait_for_operation() blocks until it is done
+def delete_instance(project_id, zone, name):
+    return request("DELETE", f"{COMPUTE_URL}/projects/{project_id}/zones/{zone}/instances/{name}")
+
+def delete_address(project_id, region, name):
+    return request("DELETE", f"{COMPUTE_URL}/projects/{project_id}/regions/{region}/addresses/{name}")
+
+def delete_disk(project_id, zone, name):
+    return request("DELETE", f"{COMPUTE_URL}/projects/{project_id}/zones/{zone}/disks/{name}")
+
+def delete_firewall(project_id, name):
+    return request("DELETE", f"{COMPUTE_URL}/projects/{project_id}/global/firewalls/{name}")
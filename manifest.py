@@ -0,0 +1,47 @@
+import hashlib
+import json
+import os
+
+# Hashes of the inputs and generated files of the last run are kept in this file inside app_dir
+MANIFEST_FILENAME = ".cloudtailor-manifest.json"
+
+# SHA-256 of a string or bytes
+def content_sha256(content):
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    return hashlib.sha256(content).hexdigest()
+
+# SHA-256 of a file's contents, or None if it does not exist
+def file_sha256(file_path):
+    if not os.path.exists(file_path):
+        return None
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for chunk in iter(lambda: file.read(65536), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Write text or bytes to a file by renaming a temporary file over it, so a concurrent reader (such as a terraform init
+# running in the background) sees either the old or the new content, never a partly written file
+def write_file_atomic(file_path, content):
+    temporary_path = os.path.join(os.path.dirname(file_path), f".{os.path.basename(file_path)}.tmp")
+    with open(temporary_path, "wb" if isinstance(content, bytes) else "w") as file:
+        file.write(content)
+    os.replace(temporary_path, file_path)
+
+# Load the manifest for an app directory, starting fresh if it is missing or unreadable
+def load_manifest(app_dir):
+    try:
+        with open(os.path.join(app_dir, MANIFEST_FILENAME), "r") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+# Save the manifest for an app directory
+def save_manifest(app_dir, manifest):
+    write_file_atomic(os.path.join(app_dir, MANIFEST_FILENAME), json.dumps(manifest, indent=2, sort_keys=True))
+
+# Hash of the run's inputs: the variables plus the contents of any local files they point to
+def inputs_sha256(variables, input_paths):
+    inputs = {"variables": variables, "files": {path: file_sha256(path) for path in input_paths if path}}
+    return content_sha256(json.dumps(inputs, sort_keys=True))
@@ -0,0 +1,368 @@
+import hashlib
+import json
+import os
+import compose_model
+
+# Shell commands that install Docker Engine and the Compose plugin from Docker's apt repository
+DOCKER_INSTALL_SCRIPT = """# Update and Install Dependencies
+sudo apt-get update
+sudo apt-get install -y ca-certificates curl gnupg lsb-release
+
+# Add Docker's official GPG key
+sudo install -m 0755 -d /etc/apt/keyrings
+curl -fsSL https://download.docker.com/linux/ubuntu/gpg | sudo gpg --batch --yes --dearmor -o /etc/apt/keyrings/docker.gpg
+sudo chmod a+r /etc/apt/keyrings/docker.gpg
+
+# Add the repository to Apt sources
+echo \\
+  "deb [arch=$(dpkg --print-architecture) signed-by=/etc/apt/keyrings/docker.gpg] https://download.docker.com/linux/ubuntu \\
+  $(lsb_release -cs) stable" | \\
+  sudo tee /etc/apt/sources.list.d/docker.list > /dev/null
+
+# Update apt repositories
+sudo apt-get update
+
+# Install Docker
+sudo apt-get install -y docker-ce docker-ce-cli containerd.io docker-buildx-plugin docker-compose-plugin
+"""
+
+# Shell commands that install cloudflared from Cloudflare's apt repository
+CLOUDFLARED_INSTALL_SCRIPT = """# Add cloudflare gpg key
+sudo mkdir -p --mode=0755 /usr/share/keyrings
+curl -fsSL https://pkg.cloudflare.com/cloudflare-main.gpg | sudo tee /usr/share/keyrings/cloudflare-main.gpg >/dev/null
+
+# Add this repo to your apt repositories
+echo 'deb [signed-by=/usr/share/keyrings/cloudflare-main.gpg] https://pkg.cloudflare.com/cloudflared jammy main' | sudo tee /etc/apt/sources.list.d/cloudflared.list
+
+# install cloudflared
+sudo apt-get update && sudo apt-get install -y cloudflared
+"""
+
+# Body of updater.sh. It pulls every image in parallel through `docker compose pull`, compares each service's
+# running image ID with the freshly pulled one and recreates only the services whose image changed, one at a time.
+# In rolling mode, services with a healthcheck and no published host ports get a new container that must become
+# healthy before the old one is removed, so they stay available throughout the update.
+UPDATER_SCRIPT_BODY = r"""
+# Re-run under bash when started with `sh updater.sh`
+if [ -z "$BASH_VERSION" ]; then exec bash "$0" "$@"; fi
+
+# Update the package index
+sudo apt update
+
+# Upgrade Docker and Cloudflared
+sudo apt upgrade -y docker-ce docker-ce-cli containerd.io docker-buildx-plugin docker-compose-plugin cloudflared
+
+cd /opt
+compose="sudo docker compose -f /opt/docker-compose.yml"
+
+# Image ID and readiness state of a container ("healthy", "running", ...)
+image_id() { sudo docker inspect --format '{{.Image}}' "$1"; }
+state() { sudo docker inspect --format '{{if .State.Health}}{{.State.Health.Status}}{{else}}{{.State.Status}}{{end}}' "$1" 2>/dev/null; }
+
+# Wait up to 120s for a container to be healthy, or running if it has no healthcheck
+wait_ready() {
+    for _ in $(seq 1 240); do
+        case "$(state "$1")" in
+            healthy) return 0 ;;
+            running) sudo docker inspect --format '{{if .State.Health}}x{{end}}' "$1" | grep -q x || return 0 ;;
+        esac
+        sleep 0.5
+    done
+    return 1
+}
+
+now_ms() { echo $(( $(date +%s%N) / 1000000 )); }
+
+# Services and the images they run, for services that use a pulled image
+service_images=$($compose config --format json | python3 -c 'import json, sys; [print(name, service.get("image", "")) for name, service in json.load(sys.stdin)["services"].items()]')
+
+# Remember what each service is running before pulling
+declare -A running_image
+while read -r service image; do
+    container=$($compose ps -q "$service" | head -n 1)
+    running_image[$service]=$([ -n "$container" ] && image_id "$container")
+done <<< "$service_images"
+
+# Pull all images concurrently
+$compose pull --quiet --ignore-pull-failures
+
+summary=()
+while read -r service image; do
+    [ -n "$image" ] || { summary+=("$service: built locally, skipped"); continue; }
+    new_image=$(sudo docker image inspect --format '{{.Id}}' "$image" 2>/dev/null)
+    if [ -n "${running_image[$service]}" ] && [ "${running_image[$service]}" = "$new_image" ]; then
+        summary+=("$service: unchanged")
+        continue
+    fi
+
+    old_container=$($compose ps -q "$service" | head -n 1)
+    has_healthcheck=$([ -n "$old_container" ] && sudo docker inspect --format '{{if .Config.Healthcheck}}yes{{end}}' "$old_container")
+    has_ports=$([ -n "$old_container" ] && sudo docker port "$old_container")
+
+    if [ "$UPDATE_MODE" = "rolling" ] && [ "$has_healthcheck" = "yes" ] && [ -z "$has_ports" ]; then
+        # Start the new container next to the old one and only remove the old one once the new one is healthy
+        $compose up -d --no-deps --no-recreate --scale "$service=2" "$service"
+        new_container=$($compose ps -q "$service" | grep -vx "$old_container" | head -n 1)
+        if [ -n "$new_container" ] && wait_ready "$new_container"; then
+            sudo docker stop "$old_container" >/dev/null && sudo docker rm "$old_container" >/dev/null
+            summary+=("$service: updated (rolling, downtime 0ms)")
+        else
+            [ -n "$new_container" ] && sudo docker stop "$new_container" >/dev/null && sudo docker rm "$new_container" >/dev/null
+            summary+=("$service: new container never became healthy, kept the old one")
+        fi
+        continue
+    fi
+
+    # Recreate the service and measure how long it is unavailable
+    start=$(now_ms)
+    $compose up -d --no-deps "$service"
+    new_container=$($compose ps -q "$service" | head -n 1)
+    if wait_ready "$new_container"; then
+        summary+=("$service: updated (downtime $(( $(now_ms) - start ))ms)")
+    else
+        summary+=("$service: updated but not ready after 120s (state: $(state "$new_container"))")
+    fi
+done <<< "$service_images"
+
+# Remove images no longer used by any container
+sudo docker image prune -f > /dev/null
+
+echo "Update summary:"
+printf '  %s\n' "${summary[@]}"
+"""
+
+# Generate updater.sh; update_mode is "recreate" or "rolling" and can be overridden with UPDATE_MODE=... on the server
+def updater_script(update_mode):
+    return f"""#!/bin/bash
+UPDATE_MODE="${{UPDATE_MODE:-{update_mode}}}"
+""" + UPDATER_SCRIPT_BODY
+
+# Boot-time script that enables swap: compressed RAM (zram) when the kernel has the module, otherwise a swap file
+# on disk, each sized to the machine's memory (at most 4 GB). Swappiness is high for zram, where swapping is cheap,
+# and low for a disk swap file. The mode is baked in when the script is generated.
+SWAP_SCRIPT_BODY = r"""
+if [ "$SWAP_MODE" = off ] || [ -n "$(swapon --show=NAME --noheadings)" ]; then exit 0; fi
+size_mb=$(awk '/MemTotal/ { size = int($2 / 1024); print (size > 4096 ? 4096 : size) }' /proc/meminfo)
+
+if [ "$SWAP_MODE" != swapfile ] && modprobe zram 2>/dev/null && device=$(zramctl --find --size "${size_mb}M" --algorithm zstd); then
+    mkswap "$device" >/dev/null && swapon --priority 100 "$device"
+    printf 'vm.swappiness = 100\nvm.page-cluster = 0\n' > /etc/sysctl.d/60-cloudtailor-swap.conf
+elif [ "$SWAP_MODE" != zram ]; then
+    if [ ! -f /swapfile ]; then
+        fallocate -l "${size_mb}M" /swapfile && chmod 600 /swapfile && mkswap /swapfile >/dev/null
+    fi
+    swapon /swapfile
+    printf 'vm.swappiness = 10\n' > /etc/sysctl.d/60-cloudtailor-swap.conf
+fi
+sysctl -q -p /etc/sysctl.d/60-cloudtailor-swap.conf 2>/dev/null || true
+"""
+
+# Shell commands for setup_server.sh that install the swap script and a unit running it on every boot.
+# swap_mode is "auto" (zram, falling back to a swap file), "zram", "swapfile" or "off".
+def swap_setup_script(swap_mode):
+    return f"""sudo tee /usr/local/sbin/cloudtailor-swap > /dev/null <<'SWAP_SCRIPT'
+#!/bin/sh
+SWAP_MODE={swap_mode}
+{SWAP_SCRIPT_BODY.lstrip()}SWAP_SCRIPT
+sudo chmod 755 /usr/local/sbin/cloudtailor-swap
+sudo tee /etc/systemd/system/cloudtailor-swap.service > /dev/null <<'SWAP_UNIT'
+[Unit]
+Description=Enable swap for the CloudTailor stack
+Before=docker.service
+
+[Service]
+Type=oneshot
+RemainAfterExit=yes
+ExecStart=/usr/local/sbin/cloudtailor-swap
+
+[Install]
+WantedBy=multi-user.target
+SWAP_UNIT
+sudo systemctl daemon-reload
+sudo systemctl enable --now cloudtailor-swap.service
+"""
+
+# Host tuning profiles selected with tuning_profile. Each sets kernel network parameters (BBR congestion control
+# with the fq qdisc, accept queue length and socket buffer sizes), the open file limit for the stack's containers and
+# the docker-compose unit, and Docker daemon settings: live-restore keeps containers running while dockerd restarts,
+# and the json-file log driver caps every container's logs at max-size x max-file.
+TUNING_PROFILES = {
+    "none": {"sysctl": {}, "nofile": None, "daemon": {}},
+    "balanced": {
+        "sysctl": {
+            "net.core.default_qdisc": "fq",
+            "net.ipv4.tcp_congestion_control": "bbr",
+            "net.core.somaxconn": 4096,
+            "net.ipv4.tcp_max_syn_backlog": 4096,
+            "net.core.rmem_max": 16777216,
+            "net.core.wmem_max": 16777216,
+            "net.ipv4.tcp_rmem": "4096 87380 16777216",
+            "net.ipv4.tcp_wmem": "4096 65536 16777216",
+            "net.ipv4.tcp_slow_start_after_idle": 0,
+        },
+        "nofile": 65536,
+        "daemon": {"live-restore": True, "log-driver": "json-file", "log-opts": {"max-size": "10m", "max-file": "3"}},
+    },
+    "throughput": {
+        "sysctl": {
+            "net.core.default_qdisc": "fq",
+            "net.ipv4.tcp_congestion_control": "bbr",
+            "net.core.somaxconn": 65535,
+            "net.ipv4.tcp_max_syn_backlog": 65535,
+            "net.core.netdev_max_backlog": 16384,
+            "net.core.rmem_max": 67108864,
+            "net.core.wmem_max": 67108864,
+            "net.ipv4.tcp_rmem": "4096 131072 67108864",
+            "net.ipv4.tcp_wmem": "4096 65536 67108864",
+            "net.ipv4.tcp_slow_start_after_idle": 0,
+            "net.ipv4.tcp_mtu_probing": 1,
+            "net.ipv4.tcp_fastopen": 3,
+            "net.ipv4.ip_local_port_range": "10240 65535",
+        },
+        "nofile": 1048576,
+        "daemon": {"live-restore": True, "log-driver": "json-file", "log-opts": {"max-size": "20m", "max-file": "5"}},
+    },
+}
+DEFAULT_TUNING_PROFILE = "balanced"
+
+# Return the named tuning profile. Raises ValueError listing the valid names for an unknown one.
+def tuning_profile(profile_name):
+    profile_name = profile_name or DEFAULT_TUNING_PROFILE
+    if profile_name not in TUNING_PROFILES:
+        raise ValueError(f"Unknown tuning_profile \"{profile_name}\". Choose one of: {', '.join(TUNING_PROFILES)}.")
+    return TUNING_PROFILES[profile_name]
+
+# Docker daemon.json settings for a tuning profile, including the containers' default open file limit
+def tuning_daemon_config(profile_name):
+    profile = tuning_profile(profile_name)
+    config = dict(profile["daemon"])
+    if profile["nofile"]:
+        config["default-ulimits"] = {"nofile": {"Name": "nofile", "Soft": profile["nofile"], "Hard": profile["nofile"]}}
+    return config
+
+# Shell commands for setup_server.sh that install the profile's kernel parameters and apply them only when they
+# changed, loading the BBR module first when the profile uses it
+def tuning_setup_script(profile_name):
+    settings = tuning_profile(profile_name)["sysctl"]
+    if not settings:
+        return ""
+    sysctl_conf = "".join(f"{key} = {value}\n" for key, value in settings.items())
+    load_bbr = """echo tcp_bbr | sudo tee /etc/modules-load.d/cloudtailor-bbr.conf > /dev/null
+sudo modprobe tcp_bbr
+""" if settings.get("net.ipv4.tcp_congestion_control") == "bbr" else ""
+    return f"""{load_bbr}cat > /tmp/cloudtailor-tuning.conf <<'SYSCTL_CONF'
+{sysctl_conf}SYSCTL_CONF
+if ! cmp -s /tmp/cloudtailor-tuning.conf /etc/sysctl.d/60-cloudtailor-tuning.conf; then
+    sudo install -m 0644 /tmp/cloudtailor-tuning.conf /etc/sysctl.d/60-cloudtailor-tuning.conf
+    sudo sysctl -q -p /etc/sysctl.d/60-cloudtailor-tuning.conf
+fi
+rm -f /tmp/cloudtailor-tuning.conf
+"""
+
+# Device name of the optional data disk; the guest sees it as /dev/disk/by-id/google-<name>
+DATA_DISK_DEVICE_NAME = "cloudtailor-data"
+DATA_DISK_MOUNT_POINT = "/mnt/data"
+DOCKER_DATA_ROOT = f"{DATA_DISK_MOUNT_POINT}/docker"
+
+# Shell commands for setup_server.sh that format the data disk on first use (with Google's recommended ext4 options),
+# mount it with noatime and discard, and copy any existing Docker data onto it before Docker switches data-root.
+# The mount is nofail so a missing disk does not stop the boot, and a docker.service drop-in requires it, so Docker
+# never starts on an empty data-root on the boot disk in its place. Sets data_disk_mounted=yes once it is mounted.
+DATA_DISK_SETUP_SCRIPT = f"""device=/dev/disk/by-id/google-{DATA_DISK_DEVICE_NAME}
+data_disk_mounted=no
+if [ -b "$device" ]; then
+    sudo blkid "$device" > /dev/null || sudo mkfs.ext4 -q -m 0 -E lazy_itable_init=0,lazy_journal_init=0,discard "$device"
+    sudo mkdir -p {DATA_DISK_MOUNT_POINT}
+    grep -q "google-{DATA_DISK_DEVICE_NAME} " /etc/fstab || echo "$device {DATA_DISK_MOUNT_POINT} ext4 defaults,noatime,discard,nofail,x-systemd.before=docker.service 0 2" | sudo tee -a /etc/fstab > /dev/null
+    if mountpoint -q {DATA_DISK_MOUNT_POINT} || sudo mount {DATA_DISK_MOUNT_POINT}; then
+        data_disk_mounted=yes
+        sudo mkdir -p /etc/systemd/system/docker.service.d
+        printf '[Unit]\\nRequiresMountsFor={DATA_DISK_MOUNT_POINT}\\n' | sudo tee /etc/systemd/system/docker.service.d/cloudtailor-data-disk.conf > /dev/null
+        sudo systemctl daemon-reload
+        if [ ! -d {DOCKER_DATA_ROOT} ] && [ -d /var/lib/docker ]; then
+            sudo systemctl stop docker.socket docker 2>/dev/null || true
+            sudo cp -a /var/lib/docker {DOCKER_DATA_ROOT}
+        fi
+    else
+        echo "Unable to mount the data disk at {DATA_DISK_MOUNT_POINT}; Docker data stays on the boot disk."
+    fi
+else
+    echo "Data disk $device not found; Docker data stays on the boot disk."
+fi
+"""
+
+# Golden images are created in this family and recorded in this file by build_image.py
+GOLDEN_IMAGE_FAMILY = "cloudtailor"
+GOLDEN_IMAGE_MANIFEST = "golden-image.json"
+
+# Printed by the image builder's startup script once everything is installed
+GOLDEN_IMAGE_BUILD_MARKER = "CLOUDTAILOR_IMAGE_BUILD_OK"
+
+# Wrap an install script so it only runs when the given command is missing (e.g. on a golden image)
+def install_unless_present(command, install_script):
+    return f"""if ! command -v {command} >/dev/null 2>&1; then
+{install_script}fi
+"""
+
+# Images used by the stack: the docker_images list plus any image referenced by the local compose file
+def stack_images(docker_images, compose_file_path):
+    images = set(docker_images)
+    if compose_file_path and os.path.exists(compose_file_path):
+        with open(compose_file_path, "r") as file:
+            compose_data = compose_model.load(file) or {}
+        for service_details in (compose_data.get("services") or {}).values():
+            if isinstance(service_details, dict) and service_details.get("image"):
+                images.add(service_details["image"])
+    return sorted(images)
+
+# Name of the golden image for a source image and set of prepulled images.
+# The name is a hash of everything baked into the image, so any change to the inputs yields a new image.
+def golden_image_name(os_type, prepull_images):
+    inputs = {
+        "os_type": os_type,
+        "docker_install": DOCKER_INSTALL_SCRIPT,
+        "cloudflared_install": CLOUDFLARED_INSTALL_SCRIPT,
+        "prepull_images": sorted(prepull_images),
+    }
+    digest = hashlib.sha256(json.dumps(inputs, sort_keys=True).encode("utf-8")).hexdigest()
+    return f"{GOLDEN_IMAGE_FAMILY}-{digest[:16]}"
+
+# Startup script for the temporary builder VM: install everything, prepull images, clean up and power off.
+# The VM powers off however the script exits, so a failed step ends the build right away instead of at the timeout.
+def golden_image_builder_script(prepull_images):
+    pull_commands = "".join(f"sudo docker pull {image}\n" for image in prepull_images)
+    return f"""#!/bin/bash
+set -euxo pipefail
+trap 'sudo shutdown -h now' EXIT
+
+{DOCKER_INSTALL_SCRIPT}
+{CLOUDFLARED_INSTALL_SCRIPT}
+# Prepull the stack's images
+{pull_commands}
+# Keep the image small
+sudo apt-get clean
+sudo rm -rf /var/lib/apt/lists/*
+
+echo "{GOLDEN_IMAGE_BUILD_MARKER}"
+"""
+
+# Return the self link of the golden image recorded under name, or None if it has not been built
+def load_golden_image(name, manifest_path=GOLDEN_IMAGE_MANIFEST):
+    try:
+        with open(manifest_path, "r") as file:
+            manifest = json.load(file)
+    except (OSError, ValueError):
+        return None
+    image = manifest.get("images", {}).get(name)
+    return image["self_link"] if image else None
+
+# Record a built golden image in the manifest
+def record_golden_image(name, self_link, inputs, manifest_path=GOLDEN_IMAGE_MANIFEST):
+    try:
+        with open(manifest_path, "r") as file:
+            manifest = json.load(file)
+    except (OSError, ValueError):
+        manifest = {}
+    manifest.setdefault("images", {})[name] = {"self_link": self_link, "inputs": inputs}
+    with open(manifest_path, "w") as file:
+        json.dump(manifest, file, indent=2, sort_keys=True)
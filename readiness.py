@@ -0,0 +1,284 @@
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import cloudflare
+import compose_model
+import tracing
+
+# Readiness phases in the order a new server passes them. Each phase's probes start once the previous phase is
+# ready and run concurrently; a phase is ready when all of its probes have passed.
+PHASES = ("vm_up", "docker_up", "services_healthy", "tunnel_up")
+
+# Give up on the whole stack after this many seconds
+DEFAULT_DEADLINE = 900
+
+# Each probe retries with exponential backoff from INITIAL_DELAY up to MAX_DELAY seconds between attempts
+INITIAL_DELAY = 1
+MAX_DELAY = 15
+
+# Seconds allowed for one attempt of a probe
+ATTEMPT_TIMEOUT = 20
+
+# Seconds a TCP probe waits to connect and an HTTP probe waits for an answer
+CONNECT_TIMEOUT = 5
+HTTP_TIMEOUT = 10
+
+# Where the stack lives on the server (see docker-compose.service)
+REMOTE_COMPOSE_DIR = "/opt"
+
+# Parent of the SSH control socket directory. A socket path (directory, 40-character %C hash and ssh's temporary
+# suffix) must fit the 104-byte Unix socket limit, which the default temporary directory on macOS
+# (/var/folders/...) exceeds.
+CONTROL_DIR_PARENT = "/tmp"
+SOCKET_PATH_LIMIT = 104
+CONTROL_SOCKET_NAME_LENGTH = 1 + 40 + 17
+
+# Statuses Cloudflare returns when the tunnel or the origin behind it cannot be reached
+TUNNEL_ERROR_STATUSES = {502, 521, 522, 523, 530}
+
+# Run a command on the server over SSH. Connections are multiplexed through one control socket per prober so
+# repeated probes do not pay for a new SSH handshake each time.
+class RemoteShell:
+    def __init__(self, ip_address, ssh_user, ssh_private_key_path, control_dir, ssh_port=22):
+        self.destination = f"{ssh_user}@{ip_address}"
+        self.options = [
+            "-i", ssh_private_key_path,
+            "-p", str(ssh_port),
+            "-o", "BatchMode=yes",
+            "-o", "ConnectTimeout=5",
+            # The static IP may have belonged to an earlier VM, so do not pin or record host keys while probing
+            "-o", "StrictHostKeyChecking=no",
+            "-o", "UserKnownHostsFile=/dev/null",
+            "-o", "LogLevel=ERROR",
+        ]
+        # Without room for the control socket, every probe opens its own connection
+        if len(control_dir) + CONTROL_SOCKET_NAME_LENGTH < SOCKET_PATH_LIMIT:
+            self.options += [
+                "-o", "ControlMaster=auto",
+                "-o", f"ControlPath={os.path.join(control_dir, '%C')}",
+                "-o", "ControlPersist=60",
+            ]
+
+    def run(self, command):
+        try:
+            return tracing.run(["ssh", *self.options, self.destination, command], capture_output=True, text=True, timeout=ATTEMPT_TIMEOUT, stdin=subprocess.DEVNULL)
+        except subprocess.TimeoutExpired:
+            return subprocess.CompletedProcess(command, 124, "", f"timed out after {ATTEMPT_TIMEOUT}s")
+
+    # Close the shared connection, if one was opened
+    def close(self):
+        if "ControlMaster=auto" not in self.options:
+            return
+        tracing.run(["ssh", *self.options, "-O", "exit", self.destination], capture_output=True, stdin=subprocess.DEVNULL)
+
+# Every probe returns (ready, detail), where detail says what was observed
+
+def tcp_probe(host, port):
+    def probe():
+        with tracing.span(f"connect {host}:{port}", "tcp", host=host, port=port) as attributes:
+            try:
+                with socket.create_connection((host, port), timeout=CONNECT_TIMEOUT):
+                    return True, f"port {port} open"
+            except OSError as error:
+                attributes["error"] = str(error)
+                return False, str(error)
+    return probe
+
+def ssh_probe(shell):
+    def probe():
+        result = shell.run("true")
+        return result.returncode == 0, result.stderr.strip() or "ssh ok"
+    return probe
+
+def docker_probe(shell):
+    def probe():
+        result = shell.run("sudo docker info --format '{{.ServerVersion}}'")
+        if result.returncode != 0:
+            return False, result.stderr.strip() or "docker info failed"
+        return True, f"Docker {result.stdout.strip()}"
+    return probe
+
+# Parse `docker compose ps --format json`, which prints a JSON array on older Compose releases and one object per line on newer ones
+def parse_compose_ps(output):
+    output = output.strip()
+    if output.startswith("["):
+        return json.loads(output)
+    return [json.loads(line) for line in output.splitlines() if line.strip()]
+
+# A service is healthy when its containers are running and pass their healthcheck (if they have one), or ran once
+# and exited cleanly
+def service_probe(shell, service_name):
+    def probe():
+        result = shell.run(f"cd {REMOTE_COMPOSE_DIR} && sudo docker compose ps --all --format json {service_name}")
+        if result.returncode != 0:
+            return False, result.stderr.strip() or "docker compose ps failed"
+        try:
+            containers = parse_compose_ps(result.stdout)
+        except ValueError:
+            return False, "unreadable docker compose ps output"
+        if not containers:
+            return False, "no container yet"
+        for container in containers:
+            state, health = container.get("State", ""), container.get("Health", "")
+            if state == "exited" and container.get("ExitCode") == 0:
+                continue
+            if state != "running" or health not in ("", "healthy"):
+                return False, f"{container.get('Name', service_name)} is {health or state}"
+        return True, "running"
+    return probe
+
+# A published port is up when something accepts connections on it on the server itself
+def port_probe(shell, mapping):
+    address = compose_model.local_address(mapping)
+    def probe():
+        result = shell.run(f"timeout 3 bash -c '</dev/tcp/{address.strip('[]')}/{mapping['published']}'")
+        return result.returncode == 0, f"port {mapping['published']} {'open' if result.returncode == 0 else 'closed'}"
+    return probe
+
+# The tunnel is up for a URL once Cloudflare answers with anything other than its tunnel and origin errors
+def http_probe(url):
+    def probe():
+        with tracing.span(f"GET {url}", "http", method="GET", url=url) as attributes:
+            try:
+                with urllib.request.urlopen(urllib.request.Request(url, method="GET"), timeout=HTTP_TIMEOUT) as response:
+                    attributes["status"] = response.status
+                    return True, f"HTTP {response.status}"
+            except urllib.error.HTTPError as error:
+                attributes["status"] = error.code
+                return error.code not in TUNNEL_ERROR_STATUSES, f"HTTP {error.code}"
+            except (urllib.error.URLError, OSError) as error:
+                attributes["error"] = str(getattr(error, "reason", error))
+                return False, attributes["error"]
+    return probe
+
+# Probes for a deployed stack as {phase: {probe name: probe}}. Services and ports come from the compose file;
+# tunnel URLs from the hostnames its ingress rules use, unless urls are given.
+def stack_probes(shell, ip_address, compose_data, app_hostname, routing=None, urls=None, ssh_port=22):
+    probes = {phase: {} for phase in PHASES}
+    probes["vm_up"][f"tcp {ip_address}:{ssh_port}"] = tcp_probe(ip_address, ssh_port)
+    probes["vm_up"]["ssh"] = ssh_probe(shell)
+    probes["docker_up"]["docker"] = docker_probe(shell)
+
+    for service_name in (compose_data.get("services") or {}):
+        probes["services_healthy"][f"service {service_name}"] = service_probe(shell, service_name)
+    for service_name, mappings in compose_model.service_ports(compose_data).items():
+        for mapping in mappings:
+            if mapping["protocol"] == "tcp" and mapping["published"] is not None:
+                probes["services_healthy"][f"port {service_name}:{mapping['published']}"] = port_probe(shell, mapping)
+
+    if urls is None:
+        rules = cloudflare.ingress_rules(compose_data, app_hostname, routing) if app_hostname else []
+        urls = [f"https://{hostname}/" for hostname in dict.fromkeys(rule["hostname"] for rule in rules)]
+    for url in urls:
+        probes["tunnel_up"][f"http {url}"] = http_probe(url)
+    return probes
+
+# Call probe until it passes or the deadline (a time.monotonic() value) passes, doubling the delay between attempts.
+# Returns (ready, attempts, detail).
+def poll(probe, deadline, initial_delay=INITIAL_DELAY, max_delay=MAX_DELAY):
+    delay = initial_delay
+    attempts = 0
+    while True:
+        attempts += 1
+        try:
+            ready, detail = probe()
+        except Exception as error:
+            ready, detail = False, f"{type(error).__name__}: {error}"
+        remaining = deadline - time.monotonic()
+        if ready or remaining <= 0:
+            return ready, attempts, detail
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, max_delay)
+
+# Run the probes phase by phase within one overall deadline and return the report: whether the stack became ready,
+# seconds from start until each phase was ready (None if it was not, absent if it had no probes) and each probe's
+# outcome. Phases after one that missed the deadline are not probed.
+def probe_stack(probes, deadline_seconds=DEFAULT_DEADLINE, initial_delay=INITIAL_DELAY, max_delay=MAX_DELAY):
+    start = time.monotonic()
+    deadline = start + deadline_seconds
+    report = {"ready": True, "deadline": deadline_seconds, "phases": {}, "probes": []}
+
+    for phase in PHASES:
+        if not probes.get(phase):
+            continue
+        if not report["ready"]:
+            report["phases"][phase] = None
+            continue
+
+        outcomes = {}
+        def run_probe(name, probe):
+            ready, attempts, detail = poll(probe, deadline, initial_delay, max_delay)
+            outcomes[name] = {"phase": phase, "name": name, "ready": ready, "seconds": round(time.monotonic() - start, 2) if ready else None, "attempts": attempts, "detail": detail}
+
+        threads = [threading.Thread(target=run_probe, args=item) for item in probes[phase].items()]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        report["probes"] += [outcomes[name] for name in probes[phase]]
+        phase_ready = all(outcome["ready"] for outcome in outcomes.values())
+        report["phases"][phase] = max(outcome["seconds"] for outcome in outcomes.values()) if phase_ready else None
+        report["ready"] = phase_ready
+
+    report["seconds"] = round(time.monotonic() - start, 2)
+    return report
+
+# Print each phase's time to ready and the probes that did not pass
+def print_report(report):
+    print(f"\nReadiness ({'ready' if report['ready'] else 'NOT ready'} after {report['seconds']:.1f}s, deadline {report['deadline']}s):")
+    for phase, seconds in report["phases"].items():
+        print(f"  {phase:<18} {f'{seconds:.1f}s' if seconds is not None else 'not ready':>10}")
+    for outcome in report["probes"]:
+        if not outcome["ready"]:
+            print(f"  {outcome['phase']}: {outcome['name']} failed after {outcome['attempts']} attempts: {outcome['detail']}")
+
+# Probe a deployed server and write the report as JSON to output_path (if given). Returns the report.
+def check_readiness(ip_address, ssh_user, ssh_private_key_path, compose_data, app_hostname, routing=None, urls=None, deadline_seconds=DEFAULT_DEADLINE, output_path=None, ssh_port=22):
+    with tempfile.TemporaryDirectory(prefix="ct-", dir=CONTROL_DIR_PARENT if os.path.isdir(CONTROL_DIR_PARENT) else None) as control_dir:
+        shell = RemoteShell(ip_address, ssh_user, ssh_private_key_path, control_dir, ssh_port)
+        try:
+            report = probe_stack(stack_probes(shell, ip_address, compose_data, app_hostname, routing, urls, ssh_port), deadline_seconds)
+        finally:
+            shell.close()
+
+    if output_path:
+        with open(output_path, "w") as file:
+            json.dump(report, file, indent=2)
+    print_report(report)
+    return report
+
+# Main execution
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Wait for a deployed server to serve traffic and report how long each phase took.")
+    parser.add_argument("ip_address", help="IP address of the server")
+    parser.add_argument("--ssh-user", required=True, help="user to SSH in as")
+    parser.add_argument("--ssh-key", required=True, help="private key to SSH in with")
+    parser.add_argument("--ssh-port", type=int, default=22, help="SSH port (default: 22)")
+    parser.add_argument("--compose", default="docker-compose.yml", help="compose file deployed to the server (default: docker-compose.yml)")
+    parser.add_argument("--hostname", help="app_hostname; its ingress hostnames are probed through the tunnel")
+    parser.add_argument("--routing", help="ingress_routing used when deploying (default: hostname)")
+    parser.add_argument("--url", action="append", help="probe this URL for tunnel_up instead of the ingress hostnames (repeatable)")
+    parser.add_argument("--deadline", type=int, default=DEFAULT_DEADLINE, help=f"seconds to wait for the whole stack (default: {DEFAULT_DEADLINE})")
+    parser.add_argument("--output", default="readiness.json", help="write the JSON report here (default: readiness.json)")
+    args = parser.parse_args()
+
+    compose_data = {}
+    if os.path.exists(args.compose):
+        with open(args.compose, "r") as file:
+            compose_data = compose_model.load(file) or {}
+
+    try:
+        report = check_readiness(args.ip_address, args.ssh_user, args.ssh_key, compose_data, args.hostname, args.routing, args.url, args.deadline, args.output, args.ssh_port)
+    except ValueError as error:
+        print(f"Error: {error}")
+        sys.exit(1)
+    sys.exit(0 if report["ready"] else 1)
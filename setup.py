@@ -1,102 +1,101 @@
 import subprocess
+import argparse
 import json
-import yaml
+import sys
 import os
-import shutil
-import openai  # Corrected import
-from openai import OpenAI
+import tarfile
+import gzip
+import io
+import base64
+import contextvars
+import threading
+from task_graph import run_task_graph, print_task_report
+import gcp_cache
+import gcp
+from gcp import fetch_project_id, fetch_service_account_key, check_static_ip, firewall_rule_names, data_disk_name
+import compose_cache
+import compose_model
+import compose_generator
+import cloudflare
+import sizing
+import tf_runner
+import tracing
+from manifest import content_sha256, file_sha256, load_manifest, save_manifest, inputs_sha256, write_file_atomic
+from provisioning import DOCKER_INSTALL_SCRIPT, CLOUDFLARED_INSTALL_SCRIPT, install_unless_present, stack_images, golden_image_name, load_golden_image, updater_script, swap_setup_script, DATA_DISK_DEVICE_NAME, DOCKER_DATA_ROOT, DATA_DISK_SETUP_SCRIPT, DEFAULT_TUNING_PROFILE, tuning_profile, tuning_daemon_config, tuning_setup_script
+
+# Importing this module has no side effects: the OpenAI client, readiness.py and destroy_instance.py are imported
+# where they are used, and nothing reads variables.txt, calls gcloud or prompts until main() or a stage function runs.
+
+# Archive holding every deployment artifact when upload_mode="bundle"
+BUNDLE_FILENAME = "cloudtailor-bundle.tar.gz"
+
+# Provisioning script passed as instance metadata when provision_mode="startup-script"
+STARTUP_SCRIPT_FILENAME = "startup.sh"
 
 # Load global variables from a file
-def load_variables():
+def load_variables(variables_path):
     variables = {}
-    with open("variables.txt", "r") as file:
+    with open(variables_path, "r") as file:
         for line in file:
             if "=" in line:
                 key, value = line.split("=", 1)
                 variables[key.strip()] = value.strip().strip('"')
-    # Setting default values if not found in variables.txt
-    variables["os_type"] = variables.get("os_type", "ubuntu-2204-lts-arm64")
-    variables["server_type"] = variables.get("server_type", "e2-micro")
     return variables
 
-# Check if variables.txt exists
-if not os.path.exists("variables.txt"):
-    print("variables.txt file is required to run this script.")
-    exit(1)
-
-# Load variables from variables.txt
-vars = load_variables()
-
-# Get variables
-app_hostname = vars.get("app_hostname")
-docker_images = vars.get("docker_images", "").split()
-compose_file_path = vars.get("compose_file_path")
-dockerfile_path = vars.get("dockerfile_path")
-region = vars.get("region")
-ssh_public_key_path = vars.get("ssh_public_key_path")
-OPENAI_API_KEY = vars.get("OPENAI_API_KEY")
-ssh_private_key_path = vars.get("ssh_private_key_path")
-
-# Create a directory for the app_hostname
-app_dir = app_hostname.replace('.', '-')  # Replace dots with hyphens for folder name
-os.makedirs(app_dir, exist_ok=True)  # Create the directory if it doesn't exist
-
-# After loading variables from variables.txt
-if dockerfile_path:
-    if os.path.exists(dockerfile_path):
-        shutil.copy2(dockerfile_path, os.path.join(app_dir, "Dockerfile"))
-        print(f"Copied Dockerfile from {dockerfile_path} to {app_dir}.")
-    else:
-        print(f"Warning: Dockerfile not found at {dockerfile_path}. It will not be included in the deployment.")
-
-# Fetch or create a Google Cloud service account key
-def fetch_service_account_key():
-    key_filename = os.path.join(app_dir, "service-account-key.json")  # Save in app_dir
-    parent_key_filename = os.path.join(os.path.dirname(app_dir), "service-account-key.json")  # Check in parent directory
-
-    # Check if the service account key file already exists in the app_dir
-    if os.path.exists(key_filename):
-        print(f"{key_filename} already exists. Skipping key generation.")
-        return key_filename
-
-    # Check if the service account key file exists in the parent directory
-    if os.path.exists(parent_key_filename):
-        print(f"Found service account key in parent directory: {parent_key_filename}. Copying to {app_dir}.")
-        shutil.copy(parent_key_filename, key_filename)
-        return key_filename
-
-    # Fetch service account details
-    accounts = subprocess.run(["gcloud", "iam", "service-accounts", "list", "--format=json"], capture_output=True, text=True)
-    accounts_json = json.loads(accounts.stdout)
-
-    # Look for the Compute Engine default service account
-    compute_engine_service_account = None
-    for account in accounts_json:
-        if 'Compute Engine default service account' in account.get('displayName', ''):
-            compute_engine_service_account = account["email"]
-            break
-
-    if not compute_engine_service_account:
-        print("Compute Engine default service account not found.")
-        return None
-
-    # Creating a service account key
-    create_key_result = subprocess.run(
-        ["gcloud", "iam", "service-accounts", "keys", "create", key_filename, "--iam-account", compute_engine_service_account],
-        capture_output=True, text=True
-    )
-
-    if create_key_result.returncode != 0:
-        # Handle error in key creation
-        print("Error creating service account key:", create_key_result.stderr)
-        return None
-
-    return key_filename
-
-# Now you can safely call fetch_service_account_key
-credentials_path = fetch_service_account_key()
-
-openai.api_key = OPENAI_API_KEY  # Corrected the OpenAI client initialization
+# One host's settings, read from its variables, and the state its stages build up: preflight() fills in the GCP
+# project, static IP, service account key and SSH key, render() the compose file and machine type to deploy
+class Host:
+    def __init__(self, variables):
+        self.vars = dict(variables)
+        # Setting default values if not found in variables.txt
+        self.vars.setdefault("os_type", "ubuntu-2204-lts-arm64")
+        self.vars.setdefault("server_type", "e2-micro")
+
+        self.app_hostname = self.vars.get("app_hostname")
+        self.docker_images = self.vars.get("docker_images", "").split()
+        self.compose_file_path = self.vars.get("compose_file_path")
+        self.dockerfile_path = self.vars.get("dockerfile_path")
+        self.region = self.vars.get("region")
+        self.ssh_public_key_path = self.vars.get("ssh_public_key_path")
+        self.openai_api_key = self.vars.get("OPENAI_API_KEY")
+        self.ssh_private_key_path = self.vars.get("ssh_private_key_path")
+        self.upload_mode = self.vars.get("upload_mode") or "files"
+        self.provision_mode = self.vars.get("provision_mode") or "ssh"
+        self.cloudflare_tunnel_token = self.vars.get("cloudflare_tunnel_token")
+        self.cloudflare_profile = self.vars.get("cloudflare_profile") or cloudflare.DEFAULT_PROFILE
+        self.tuning_profile_name = self.vars.get("tuning_profile") or DEFAULT_TUNING_PROFILE
+
+        # Boot disk, and an optional separate data disk (size in GB) that holds Docker's data
+        self.boot_disk_size = int(self.vars.get("boot_disk_size") or 60)
+        self.boot_disk_type = self.vars.get("boot_disk_type")
+        self.data_disk_size = int(self.vars.get("data_disk_size") or 0)
+        self.data_disk_type = self.vars.get("data_disk_type") or "pd-balanced"
+
+        # Directory for the app_hostname's generated files
+        self.app_dir = self.app_hostname.replace('.', '-')  # Replace dots with hyphens for folder name
+
+        # Set by preflight()
+        self.project_id = None
+        self.static_ip = None
+        self.formatted_hostname = None
+        self.credentials_path = None
+        self.credentials_filename = None
+        self.ssh_user = None
+        self.ssh_public_key = None
+
+        # Set by render()
+        self.docker_compose_yaml = None
+        self.server_type = self.vars.get("server_type")
+
+        # Manifest of the previous run's input and output hashes, and the files written or left unchanged by this run
+        self.artifact_manifest = {}
+        self.previous_inputs_hash = None
+        self.written_files = []
+        self.unchanged_files = []
+
+        # terraform init started by render() while it generates the files, and whether it succeeded
+        self.init_thread = None
+        self.init_ok = False
 
 # Determine the SSH username from the SSH public key file
 def get_ssh_user_from_key(ssh_public_key_path):
@@ -118,87 +117,36 @@ def read_ssh_public_key(ssh_public_key_path):
         print(f"Error reading SSH public key file: {e}")
         return None
 
-# Fetch project ID using Google Cloud CLI
-def fetch_project_id():
-    result = subprocess.run(["gcloud", "config", "get-value", "project"], capture_output=True, text=True)
-    return result.stdout.strip()
-
-# Format hostname to comply with GCP naming conventions
-def format_hostname(hostname):
-    return hostname.replace('.', '-')
-
-# Check for or create a static IP in GCP
-def check_static_ip(hostname, region):
-    formatted_hostname = format_hostname(hostname)
-    # Check if the static IP exists
-    result = subprocess.run(["gcloud", "compute", "addresses", "list", "--filter=NAME=" + formatted_hostname + " AND region:" + region, "--format=json"], capture_output=True, text=True)
-
-    if result.returncode != 0:
-        # Handle error in listing IPs
-        print("Error listing static IPs:", result.stderr)
-        return None, None
-
-    addresses = json.loads(result.stdout)
-    for address in addresses:
-        if address["name"] == formatted_hostname:
-            # Return the IP address and the formatted hostname
-            return address["address"], formatted_hostname
-
-    # If no static IP, create one
-    create_result = subprocess.run(["gcloud", "compute", "addresses", "create", formatted_hostname, "--region", region, "--network-tier", "STANDARD"], capture_output=True, text=True)
-    if create_result.returncode != 0:
-        # Handle error in creating IP
-        print("Error creating static IP:", create_result.stderr)
-        return None, None
-
-    new_address_result = subprocess.run(["gcloud", "compute", "addresses", "describe", formatted_hostname, "--region", region, "--format=json"], capture_output=True, text=True)
-    if new_address_result.returncode != 0:
-        # Handle error in describing new IP
-        print("Error describing new static IP:", new_address_result.stderr)
-        return None, None
-
-    new_address = json.loads(new_address_result.stdout)
-    return new_address["address"], formatted_hostname
+# Generate the connection and provisioners that upload the artifacts to the instance and install them
+def generate_upload_provisioners(host):
+    # SSH connection used by the file and remote-exec provisioners
+    connection_block = f"""    connection {{
+        type        = "ssh"
+        user        = "{host.ssh_user}"
+        private_key = file("{host.ssh_private_key_path}")
+        host        = google_compute_instance.{host.formatted_hostname}.network_interface[0].access_config[0].nat_ip
+    }}
+"""
 
-# Generate Terraform configuration for GCP instance
-def generate_terraform_config(project_id, static_ip, credentials_path, ssh_user, ssh_public_key, os_type, server_type, dockerfile_path, compose_file_path):
-    formatted_hostname = format_hostname(app_hostname)
-    ssh_metadata = f"{ssh_user}:{ssh_public_key}"
+    # Once the server has been set up, restart changed services after re-uploading the artifacts
+    reapply_command = "if systemctl is-enabled --quiet docker-compose.service 2>/dev/null; then cd /opt && sudo docker compose up -d; fi"
 
-    # Start the Terraform configuration
-    config = f"""# Terraform configuration for setting up an instance in GCP
-provider "google" {{
-    project     = "{project_id}"
-    region      = "{region}"
-    credentials = "{credentials_filename}"
-}}
-resource "google_compute_instance" "{formatted_hostname}" {{
-    name         = "{formatted_hostname}"
-    machine_type = "{server_type}"
-    zone         = "{region}-a"
-    boot_disk {{
-        initialize_params {{
-            image = "{os_type}"
-            size  = 60
-        }}
+    if host.upload_mode == "bundle":
+        # Upload every artifact as one archive and install it with a single remote command
+        provisioners = connection_block + f"""    provisioner "file" {{
+        source      = "{BUNDLE_FILENAME}"
+        destination = "/tmp/{BUNDLE_FILENAME}"
     }}
-    network_interface {{
-        network = "default"
-        access_config {{
-            nat_ip = "{static_ip}"
-            network_tier = "STANDARD"
-        }}
-    }}
-    metadata = {{
-        "ssh-keys" = "{ssh_metadata}"
-    }}
-    connection {{
-        type        = "ssh"
-        user        = "{ssh_user}"
-        private_key = file("{ssh_private_key_path}")
-        host        = self.network_interface[0].access_config[0].nat_ip
+    provisioner "remote-exec" {{
+        inline = [
+            "sudo tar -xzpf /tmp/{BUNDLE_FILENAME} --same-owner --no-overwrite-dir -C / && rm -f /tmp/{BUNDLE_FILENAME}",
+            "{reapply_command}"
+        ]
     }}
-    provisioner "file" {{
+}}
+"""
+    else:
+        provisioners = connection_block + f"""    provisioner "file" {{
         source      = "setup_server.sh"
         destination = "/tmp/setup_server.sh"
     }}
@@ -216,27 +164,27 @@ resource "google_compute_instance" "{formatted_hostname}" {{
     }}
 """
 
-    # Conditional inclusion based on compose_file_path and dockerfile_path
-    # Include the Docker Compose file if compose_file_path is provided or dockerfile_path is not provided
-    if compose_file_path or not dockerfile_path:
-        config += f"""
+        # Conditional inclusion based on compose_file_path and dockerfile_path
+        # Include the Docker Compose file if compose_file_path is provided or dockerfile_path is not provided
+        if host.compose_file_path or not host.dockerfile_path:
+            provisioners += f"""
     provisioner "file" {{
         source      = "docker-compose.yml"
         destination = "/tmp/docker-compose.yml"
     }}
 """
 
-    # Include the Dockerfile if dockerfile_path is provided
-    if dockerfile_path:
-        config += f"""
+        # Include the Dockerfile if dockerfile_path is provided
+        if host.dockerfile_path:
+            provisioners += f"""
     provisioner "file" {{
         source      = "Dockerfile"
         destination = "/tmp/Dockerfile"
     }}
 """
 
-    # Start remote-exec block
-    config += f"""
+        # Start remote-exec block
+        provisioners += f"""
     provisioner "remote-exec" {{
         inline = [
             "sudo mv /tmp/setup_server.sh /opt/setup_server.sh",
@@ -250,30 +198,110 @@ resource "google_compute_instance" "{formatted_hostname}" {{
             "sudo chmod +x /opt/updater.sh",
 """
 
-    # Conditionally move Docker Compose file
-    if compose_file_path or not dockerfile_path:
-        config += f"""
+        # Conditionally move Docker Compose file
+        if host.compose_file_path or not host.dockerfile_path:
+            provisioners += f"""
             "sudo mv /tmp/docker-compose.yml /opt/docker-compose.yml",
 """
 
-    # Conditionally move Dockerfile
-    if dockerfile_path:
-        config += f"""
+        # Conditionally move Dockerfile
+        if host.dockerfile_path:
+            provisioners += f"""
             "sudo mv /tmp/Dockerfile /opt/Dockerfile",
 """
 
-    # Continue with the rest of the commands
-    config += f"""
-            "echo pwd"
+        # Continue with the rest of the commands
+        provisioners += f"""
+            "{reapply_command}"
         ]
     }}
 }}
 """
 
+    return provisioners
+
+# Start of setup.tf: the provider block, which is all terraform init needs from it
+def provider_config(host):
+    return f"""# Terraform configuration for setting up an instance in GCP
+provider "google" {{
+    project     = "{host.project_id}"
+    region      = "{host.region}"
+    credentials = "{host.credentials_filename}"
+}}
+"""
+
+# Generate Terraform configuration for GCP instance
+def generate_terraform_config(host, os_type):
+    ssh_metadata = f"{host.ssh_user}:{host.ssh_public_key}"
+
+    # In startup-script mode the instance provisions itself on boot from its metadata. The script goes in the metadata
+    # map rather than metadata_startup_script, which would replace the VM (and its Docker volumes) whenever it changes.
+    startup_script_line = f'        "startup-script" = file("{STARTUP_SCRIPT_FILENAME}")\n' if host.provision_mode == "startup-script" else ""
+
+    # The boot disk type is only set when configured so existing instances keep the provider default (pd-standard)
+    boot_disk_type_line = f'            type  = "{host.boot_disk_type}"\n' if host.boot_disk_type else ""
+
+    # Optional persistent data disk for Docker's data, kept separate from the boot disk
+    data_disk = ""
+    data_disk_attachment = ""
+    if host.data_disk_size:
+        data_disk = f"""resource "google_compute_disk" "data" {{
+    name = "{data_disk_name(host.formatted_hostname)}"
+    type = "{host.data_disk_type}"
+    zone = "{host.region}-a"
+    size = {host.data_disk_size}
+}}
+"""
+        data_disk_attachment = f"""    attached_disk {{
+        source      = google_compute_disk.data.id
+        device_name = "{DATA_DISK_DEVICE_NAME}"
+    }}
+"""
+
+    # Start the Terraform configuration
+    config = provider_config(host) + f"""{data_disk}resource "google_compute_instance" "{host.formatted_hostname}" {{
+    name         = "{host.formatted_hostname}"
+    machine_type = "{host.server_type}"
+    zone         = "{host.region}-a"
+    boot_disk {{
+        initialize_params {{
+            image = "{os_type}"
+            size  = {host.boot_disk_size}
+{boot_disk_type_line}        }}
+    }}
+{data_disk_attachment}    network_interface {{
+        network = "default"
+        access_config {{
+            nat_ip = "{host.static_ip}"
+            network_tier = "STANDARD"
+        }}
+    }}
+    metadata = {{
+        "ssh-keys" = "{ssh_metadata}"
+{startup_script_line}    }}
+"""
+
+    if host.provision_mode == "startup-script":
+        # Provision from instance metadata, so Terraform never needs to SSH into the instance
+        config += """}
+"""
+    else:
+        # Upload the artifacts from a separate resource that is replaced whenever one of them changes,
+        # so edits are uploaded by the next apply without recreating the instance
+        uploaded_files = [BUNDLE_FILENAME] if host.upload_mode == "bundle" else [file_name for file_name, _, _ in deployment_artifacts(host)]
+        triggers = "".join(f'        filesha256("{file_name}"),\n' for file_name in uploaded_files)
+        config += f"""}}
+resource "terraform_data" "artifacts" {{
+    triggers_replace = [
+        google_compute_instance.{host.formatted_hostname}.id,
+{triggers}    ]
+""" + generate_upload_provisioners(host)
+
     # Adding firewall rules for HTTP and HTTPS
+    http_rule_name, https_rule_name = firewall_rule_names(host.formatted_hostname, host.vars.get("firewall_scope"))
     firewall_rules = f"""
 resource "google_compute_firewall" "http-ingress" {{
-    name    = "http-ingress"
+    name    = "{http_rule_name}"
     network = "default"
 
     allow {{
@@ -285,7 +313,7 @@ resource "google_compute_firewall" "http-ingress" {{
 }}
 
 resource "google_compute_firewall" "https-ingress" {{
-    name    = "https-ingress"
+    name    = "{https_rule_name}"
     network = "default"
 
     allow {{
@@ -302,56 +330,75 @@ resource "google_compute_firewall" "https-ingress" {{
     # Output the instance IP
     config += f"""
 output "instance_ip" {{
-    value = "{static_ip}"
+    value = "{host.static_ip}"
 }}
 """
 
     # Write the complete configuration to the Terraform file in the app directory
-    with open(os.path.join(app_dir, "setup.tf"), "w") as file:
-        file.write(config)
-
-# Pull Docker images as specified in variables.txt
-def install_docker_images():
-    for image in docker_images:
-        subprocess.run(["docker", "pull", image])
-
-# Function to copy local Docker Compose file
-def copy_compose_file(source_path):
-    destination_path = os.path.join(app_dir, "docker-compose.yml")  # Updated path
-    shutil.copy2(source_path, destination_path)
-    print(f"Copied Docker Compose file from {source_path} to {destination_path}")
-
-# Generate Docker Compose YAML using OpenAI API or use the provided file
-def generate_docker_compose_yaml(api_key, docker_images, ssh_user, compose_file_path):
-    if compose_file_path:
-        # If a compose file path is provided, copy it
-        copy_compose_file(compose_file_path)
-        with open(os.path.join(app_dir, "docker-compose.yml"), "r") as file:  # Updated path
-            return file.read()
-    elif docker_images:
+    create_file(host, "setup.tf", config)
+
+# Function to read the local Docker Compose file
+def read_compose_file(source_path):
+    with open(source_path, "r") as file:
+        print(f"Using Docker Compose file {source_path}")
+        return file.read()
+
+# Generate Docker Compose YAML using OpenAI API or use the provided file.
+# The caller writes it to docker-compose.yml once sizing has added resource limits.
+def generate_docker_compose_yaml(host):
+    if host.compose_file_path:
+        # If a compose file path is provided, use it
+        return read_compose_file(host.compose_file_path)
+    elif host.docker_images:
         try:
             system_message = "You are a helpful assistant designed to output a Docker Compose YAML configuration."
-            user_message = f"Generate a Docker Compose v3 YAML configuration for services with the following Docker images: {', '.join(docker_images)}. Ensure that ports are properly configured for each service. The configuration should be compatible with docker-compose-plugin. Assume files on disk will be saved in /home/{ssh_user}/."
+            user_message = f"Generate a Docker Compose v3 YAML configuration for services with the following Docker images: {', '.join(compose_cache.normalize_images(host.docker_images))}. Ensure that ports are properly configured for each service. The configuration should be compatible with docker-compose-plugin. Assume files on disk will be saved in /home/{host.ssh_user}/."
 
-            response = openai.ChatCompletion.create(
-                model="gpt-4-0613",
-                messages=[
+            request = {
+                "model": "gpt-4-0613",
+                "messages": [
                     {"role": "system", "content": system_message},
                     {"role": "user", "content": user_message}
                 ],
-                temperature=0.7,
-                max_tokens=1500,
-                n=1,
-                stop=None
-            )
-
-            # Extract the YAML content from the assistant's response
-            docker_compose_yaml = response['choices'][0]['message']['content']
+                "temperature": 0.7,
+                "max_tokens": 1500,
+                "n": 1,
+                "stop": None
+            }
+
+            # Reuse a previous response for the exact same request unless the cache is bypassed
+            # compose_cache="off" skips the cache entirely, "refresh" always asks OpenAI but stores the answer
+            cache_mode = host.vars.get("compose_cache", "on").lower() or "on"
+            cache_key = compose_cache.request_key(request)
+            docker_compose_yaml = compose_cache.get(cache_key) if cache_mode == "on" else None
+
+            # Cached answers from before validation existed may be fenced or broken; regenerate those
+            if docker_compose_yaml is not None:
+                _, problems = compose_generator.validate(compose_generator.strip_fences(docker_compose_yaml), host.docker_images)
+                if problems:
+                    print(f"Ignoring cached Docker Compose file {cache_key[:12]}: {'; '.join(problems)}")
+                    docker_compose_yaml = None
+
+            if docker_compose_yaml is not None:
+                print(f"Using cached Docker Compose file {cache_key[:12]} (pin it with: python compose_cache.py pin {cache_key}).")
+                docker_compose_yaml = compose_generator.strip_fences(docker_compose_yaml)
+            else:
+                # Send the request, hedging with another copy if it is slow or fails, and keep the first answer that passes local validation
+                docker_compose_yaml = compose_generator.generate(
+                    request, host.openai_api_key, host.docker_images,
+                    candidates=int(host.vars.get("compose_candidates") or compose_generator.DEFAULT_CANDIDATES),
+                    deadline=int(host.vars.get("compose_deadline") or compose_generator.DEFAULT_DEADLINE),
+                    attempts=int(host.vars.get("compose_attempts") or compose_generator.DEFAULT_ATTEMPTS),
+                    hedge_delay=float(host.vars.get("compose_hedge_delay") or compose_generator.DEFAULT_HEDGE_DELAY),
+                )
+                if cache_mode != "off":
+                    compose_cache.put(cache_key, docker_compose_yaml, description=" ".join(compose_cache.normalize_images(host.docker_images)))
 
-            # Write the YAML content to a file
-            create_file("docker-compose.yml", docker_compose_yaml)  # Updated path
             return docker_compose_yaml
 
+        except compose_generator.GenerationError as e:
+            print(f"Error generating Docker Compose YAML: {e}")
+            return None
         except Exception as e:
             print(f"Error generating Docker Compose YAML: {e}")
             import traceback
@@ -362,194 +409,388 @@ def generate_docker_compose_yaml(api_key, docker_images, ssh_user, compose_file_
         return None
 
 # Function to generate the Cloudflare setup script dynamically
-def generate_cloudflare_script(docker_compose_yaml, formatted_hostname, static_ip, app_hostname):
-    # Initialize the ingress entries list
-    ingress_entries = []
-
-    # Parse the YAML to find ports
-    compose_data = yaml.safe_load(docker_compose_yaml)
-    for service_name, service_details in compose_data.get('services', {}).items():
-        # Check if 'ports' are defined for the service
-        if 'ports' in service_details:
-            for port in service_details['ports']:
-                # Extract the container port
-                container_port = port.split(':')[1] if ':' in port else port
-                ingress_entries.append(f"echo \"    - hostname: {app_hostname}\\n      service: http://localhost:{container_port}\" >> /etc/cloudflared/config.yml")
-
-    # Generate the cloudflare script using the ingress entries
-    cloudflare_script = f"""#!/bin/bash
-# Add cloudflare gpg key
-sudo mkdir -p --mode=0755 /usr/share/keyrings
-curl -fsSL https://pkg.cloudflare.com/cloudflare-main.gpg | sudo tee /usr/share/keyrings/cloudflare-main.gpg >/dev/null
+def generate_cloudflare_script(host, docker_compose_yaml):
+    # Render the cloudflared config locally from the compose file's published ports
+    compose_data = compose_model.load(docker_compose_yaml)
+    rules = cloudflare.ingress_rules(compose_data, host.app_hostname, host.vars.get("ingress_routing"))
+    config_yaml = cloudflare.render_config(rules, host.cloudflare_profile)
 
-# Add this repo to your apt repositories
-echo 'deb [signed-by=/usr/share/keyrings/cloudflare-main.gpg] https://pkg.cloudflare.com/cloudflared jammy main' | sudo tee /etc/apt/sources.list.d/cloudflared.list
+    # Services on their own hostnames need a DNS record pointing at the tunnel
+    dns_routes = "".join(f"sudo cloudflared tunnel route dns {host.formatted_hostname} {hostname}\n" for hostname in cloudflare.extra_hostnames(rules, host.app_hostname))
 
-# install cloudflared
-sudo apt-get update && sudo apt-get install -y cloudflared
+    # Generate the cloudflare script; the tunnel ID is filled into the config once the tunnel exists
+    cloudflare_script = f"""#!/bin/bash
+# Install cloudflared unless it is already present (e.g. on a CloudTailor golden image)
+{install_unless_present("cloudflared", CLOUDFLARED_INSTALL_SCRIPT)}
 sudo cloudflared tunnel login
-sudo cloudflared tunnel create {formatted_hostname}
-sudo cloudflared tunnel route ip add {static_ip}/32 {formatted_hostname}
-tunnel_id=$(sudo cloudflared tunnel info {formatted_hostname} | grep -oP 'id:\\s*\\K[\\w-]+')
+sudo cloudflared tunnel create {host.formatted_hostname}
+sudo cloudflared tunnel route ip add {host.static_ip}/32 {host.formatted_hostname}
+{dns_routes}tunnel_id=$(sudo cloudflared tunnel info {host.formatted_hostname} | grep -oP 'id:\\s*\\K[\\w-]+')
+if [ -z "$tunnel_id" ]; then
+    echo "Unable to find the ID of tunnel {host.formatted_hostname}."
+    exit 1
+fi
 
 # Create config file
-sudo mkdir -p /etc/cloudflared
-echo "tunnel: {formatted_hostname}" | sudo tee /etc/cloudflared/config.yml
-echo "credentials-file: /root/.cloudflared/$tunnel_id.json" | sudo tee -a /etc/cloudflared/config.yml
-echo "protocol: quic" | sudo tee -a /etc/cloudflared/config.yml
-echo "logfile: /var/log/cloudflared.log" | sudo tee -a /etc/cloudflared/config.yml
-echo "loglevel: debug" | sudo tee -a /etc/cloudflared/config.yml
-echo "transport-loglevel: info" | sudo tee -a /etc/cloudflared/config.yml
-echo "ingress:" | sudo tee -a /etc/cloudflared/config.yml
-"""
-
-    # Add ingress entries
-    for entry in ingress_entries:
-        cloudflare_script += f"{entry}\n"
-
-    # Add the default 404 service and additional commands
-    cloudflare_script += """echo "    - service: http_status:404" | sudo tee -a /etc/cloudflared/config.yml
+{cloudflare.install_config_script(config_yaml)}
+# Rotate the cloudflared log
+{cloudflare.install_logrotate_script(host.cloudflare_profile)}
 sudo cloudflared service install
 sudo systemctl start cloudflared
 sudo systemctl status cloudflared
 """
 
     # Write the complete script to a file
-    create_file("setup_cloudflare.sh", cloudflare_script)
-
-# Create a file with specified content in the app directory
-def create_file(file_name, content):
-    file_path = os.path.join(app_dir, file_name)  # Create the full path
-    with open(file_path, "w") as file:
-        file.write(content)
-
-# Update the review_and_deploy function to reference the new paths
-def review_and_deploy():
-    print("\nSetup completed. The following files have been generated:")
-    generated_files = [
-        "setup.tf",
-        "setup_server.sh",
-        "setup_cloudflare.sh",
-        "docker-compose.yml",
-        "docker-compose.service",
-        "updater.sh"
+    create_file(host, "setup_cloudflare.sh", cloudflare_script)
+
+# Deployment artifacts as (file in app_dir, install path on the server, mode)
+def deployment_artifacts(host):
+    artifacts = [
+        ("setup_server.sh", "/opt/setup_server.sh", 0o755),
+        ("setup_cloudflare.sh", "/opt/setup_cloudflare.sh", 0o755),
+        ("docker-compose.service", "/etc/systemd/system/docker-compose.service", 0o644),
+        ("updater.sh", "/opt/updater.sh", 0o755),
     ]
+    if host.compose_file_path or not host.dockerfile_path:
+        artifacts.append(("docker-compose.yml", "/opt/docker-compose.yml", 0o644))
+    if host.dockerfile_path:
+        artifacts.append(("Dockerfile", "/opt/Dockerfile", 0o644))
+    return artifacts
+
+# Pack all deployment artifacts into one gzipped tarball owned by root with their final modes.
+# Timestamps are fixed so the archive only changes when an artifact does.
+def build_bundle(host):
+    buffer = io.BytesIO()
+    with gzip.GzipFile(filename="", mode="wb", fileobj=buffer, mtime=0) as gzip_file:
+        with tarfile.open(fileobj=gzip_file, mode="w", format=tarfile.PAX_FORMAT) as tar:
+            for file_name, install_path, mode in deployment_artifacts(host):
+                with open(os.path.join(host.app_dir, file_name), "rb") as file:
+                    data = file.read()
+                info = tarfile.TarInfo(install_path.lstrip("/"))
+                info.size = len(data)
+                info.mode = mode
+                info.uid = info.gid = 0
+                info.uname = info.gname = "root"
+                tar.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+# Write the artifact bundle to the app directory for upload_mode="bundle"
+def create_bundle(host):
+    create_file(host, BUNDLE_FILENAME, build_bundle(host))
+
+# Generate the startup script for provision_mode="startup-script".
+# It unpacks the artifact bundle embedded in the script, runs setup_server.sh to install Docker and start the stack,
+# and, when a Cloudflare tunnel token is configured, installs cloudflared as a service for that tunnel.
+# A marker file records the hash of the bundle that was installed, so later boots are a no-op until the artifacts
+# change; docker-compose.service restarts the stack on its own.
+def generate_startup_script(host):
+    bundle = build_bundle(host)
+    bundle_base64 = base64.b64encode(bundle).decode("ascii")
+
+    startup_script = f"""#!/bin/bash
+# CloudTailor first-boot provisioning, generated by setup.py
+set -euo pipefail
+exec > >(tee -a /var/log/cloudtailor-startup.log) 2>&1
+
+marker=/var/lib/cloudtailor/provisioned
+artifacts_hash={content_sha256(bundle)}
+if [ "$(cat "$marker" 2>/dev/null)" = "$artifacts_hash" ]; then
+    echo "Instance already provisioned with these artifacts, nothing to do."
+    exit 0
+fi
+
+# Install the deployment files with their final owners and modes
+base64 -d <<'BUNDLE' | tar -xzp --same-owner --no-overwrite-dir -C /
+{bundle_base64}
+BUNDLE
+systemctl daemon-reload
+
+# Install Docker and start the stack
+bash /opt/setup_server.sh
+"""
 
-    # Check if a Dockerfile was added
-    if dockerfile_path:
-        generated_files.append("Dockerfile")
-
-    for file in generated_files:
-        file_path = os.path.join(app_dir, file)  # Update to use the new path
-        if os.path.exists(file_path):
-            print(f"- {file}: {file_path}")
-
-    if not compose_file_path and docker_images:
-        print("\nWARNING: The Docker Compose file was generated by OpenAI. Please review it carefully before deployment.")
-
-    print("\nPlease review these files carefully before proceeding.")
-
-    while True:
-        choice = input("\nChoose an option:\n1. Exit script (to review files manually)\n2. Proceed with deployment\nEnter your choice (1 or 2): ")
+    if host.cloudflare_tunnel_token:
+        startup_script += f"""
+# Install cloudflared and run the token-managed tunnel as a service
+{install_unless_present("cloudflared", CLOUDFLARED_INSTALL_SCRIPT)}
+if ! systemctl cat cloudflared.service >/dev/null 2>&1; then
+    cloudflared service install {host.cloudflare_tunnel_token}
+fi
+"""
+    else:
+        startup_script += """
+echo "No cloudflare_tunnel_token configured; run 'sudo sh /opt/setup_cloudflare.sh' to create the tunnel."
+"""
 
-        if choice == "1":
-            print("Exiting script. To deploy later, run the following commands manually:")
-            print(f"cd {app_dir}")
-            print("terraform init")
-            print("terraform apply")
-            return
-        elif choice == "2":
-            print("Proceeding with deployment...")
-            try:
-                os.chdir(app_dir)  # Change to the app directory
-                subprocess.run(["terraform", "init"], check=True)
-                result = subprocess.run(["terraform", "apply", "-auto-approve"], capture_output=True, text=True, check=True)
-                print("Deployment completed successfully.")
-
-                # Extract the IP address from Terraform output
-                output_lines = result.stdout.split('\n')
-                ip_address = next((line.split('=')[1].strip() for line in output_lines if 'instance_ip' in line), None)
-
-                if ip_address:
-                    print(f"\nYour instance IP address is: {ip_address}")
-                    print("\nNext steps:")
-                    print(f"1. SSH into your new server:")
-                    print(f"   ssh -i {ssh_private_key_path} {ssh_user}@{ip_address}")
-                    print("2. Run the server setup script:")
-                    print("   sudo sh /opt/setup_server.sh")
-                    print("3. Configure Cloudflare Tunnel:")
-                    print("   sudo sh /opt/setup_cloudflare.sh")
-                    print("\nFollow the prompts in each script to complete the setup.")
-                else:
-                    print("Unable to retrieve the instance IP address. Please check the Terraform output manually.")
-            except subprocess.CalledProcessError as e:
-                print(f"An error occurred during deployment: {e}")
+    startup_script += """
+mkdir -p "$(dirname "$marker")"
+echo "$artifacts_hash" > "$marker"
+echo "CloudTailor provisioning finished."
+"""
+    create_file(host, STARTUP_SCRIPT_FILENAME, startup_script)
+
+# Create a file with specified content (text or bytes) in the app directory.
+# Files whose content is already up to date are left untouched; every output's hash is recorded in the manifest.
+def create_file(host, file_name, content):
+    file_path = os.path.join(host.app_dir, file_name)  # Create the full path
+    with tracing.span(f"write {file_name}", "file", path=file_path, bytes=len(content)) as attributes:
+        content_hash = content_sha256(content)
+        host.artifact_manifest.setdefault("outputs", {})[file_name] = content_hash
+        attributes["written"] = file_sha256(file_path) != content_hash
+        if not attributes["written"]:
+            host.unchanged_files.append(file_name)
             return
-        else:
-            print("Invalid choice. Please enter 1 or 2.")
-
-# Main script execution
-project_id = fetch_project_id()
-static_ip, formatted_hostname = check_static_ip(app_hostname, region)
-ssh_private_key_path = vars.get("ssh_private_key_path")
-
-if static_ip is None or formatted_hostname is None:
-    print("Error: Unable to obtain static IP or formatted hostname.")
-    exit(1)
-
-# Extract SSH user and public key from the public key file
-ssh_user = get_ssh_user_from_key(ssh_public_key_path)
-ssh_public_key = read_ssh_public_key(ssh_public_key_path)
-
-if ssh_user is None or ssh_public_key is None:
-    print("Error: Unable to extract SSH user or public key from the public key file.")
-    exit(1)
-
-# Fetch the service account key and get the filename only
-credentials_path = fetch_service_account_key()
-credentials_filename = os.path.basename(credentials_path)  # Get just the filename
-
-# Generate setup_server.sh
-docker_pull_commands = "\n".join([f"docker pull {image}" for image in docker_images])
-
-# Determine whether to include Docker pull commands based on conditions
-if compose_file_path or dockerfile_path:
-    docker_pull_commands = ""  # Do not include Docker pull commands
-
-create_file("setup_server.sh", f"""#!/bin/bash 
-# Update and Install Dependencies
-sudo apt-get update
-sudo apt-get install -y ca-certificates curl gnupg lsb-release
-
-# Add Docker's official GPG key
-sudo install -m 0755 -d /etc/apt/keyrings
-curl -fsSL https://download.docker.com/linux/ubuntu/gpg | sudo gpg --batch --yes --dearmor -o /etc/apt/keyrings/docker.gpg
-sudo chmod a+r /etc/apt/keyrings/docker.gpg
+        write_file_atomic(file_path, content)
+        host.written_files.append(file_name)
+
+# Probe the deployed server until the stack serves traffic or readiness_deadline passes, writing per-phase timings
+# to readiness.json in app_dir
+def check_readiness(host, ip_address):
+    import readiness
+    print("\nWaiting for the stack to become ready...")
+    # Without a tunnel token the startup script cannot create the tunnel; it only exists once setup_cloudflare.sh has
+    # been run by hand, so waiting for it would only run out the deadline
+    urls = None
+    if host.provision_mode == "startup-script" and not host.cloudflare_tunnel_token:
+        print("No cloudflare_tunnel_token is configured, so the tunnel is not checked (tunnel_up is skipped).")
+        urls = []
+    readiness.check_readiness(
+        ip_address, host.ssh_user, host.ssh_private_key_path, compose_model.load(host.docker_compose_yaml) or {}, host.app_hostname,
+        routing=host.vars.get("ingress_routing"),
+        urls=urls,
+        deadline_seconds=int(host.vars.get("readiness_deadline") or readiness.DEFAULT_DEADLINE),
+        output_path=os.path.join(host.app_dir, "readiness.json"),
+    )
 
-# Add the repository to Apt sources
-echo \
-  "deb [arch=$(dpkg --print-architecture) signed-by=/etc/apt/keyrings/docker.gpg] https://download.docker.com/linux/ubuntu \
-  $(lsb_release -cs) stable" | \
-  sudo tee /etc/apt/sources.list.d/docker.list > /dev/null
+# On a host's first render, start terraform init on a background thread as soon as the provider block is known, so
+# downloading providers overlaps generating the other files (the OpenAI call in particular). Until render writes the
+# full setup.tf, the file holds only the provider block; writes are atomic, so init never reads a partial file.
+# terraform_init="on-deploy" leaves init to deploy time.
+def start_background_init(host):
+    setup_tf_path = os.path.join(host.app_dir, "setup.tf")
+    if host.vars.get("terraform_init") == "on-deploy" or os.path.exists(setup_tf_path) or os.path.isdir(os.path.join(host.app_dir, ".terraform")):
+        return
+    write_file_atomic(setup_tf_path, provider_config(host))
+    log_path = os.path.join(host.app_dir, "terraform-init.log")
+
+    def run_init():
+        with open(log_path, "w") as log_file:
+            host.init_ok = tf_runner.init(host.app_dir, stdout=log_file, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL)
+
+    # Run in a copy of this context so anything init prints follows fleet.py's per-host output redirect. The thread is a
+    # daemon so a render that exits early does not wait for init; an init cut short records no fingerprint and runs
+    # again when deploying.
+    host.init_thread = threading.Thread(target=contextvars.copy_context().run, args=(run_init,), name=f"terraform init {host.app_dir}", daemon=True)
+    host.init_thread.start()
+    print(f"Running terraform init in the background (log: {log_path}).")
+
+# Wait for the background terraform init, if one was started, and keep the init fingerprint it recorded in the manifest
+def finish_background_init(host):
+    if host.init_thread is None:
+        return
+    host.init_thread.join()
+    host.init_thread = None
+    if host.init_ok:
+        host.artifact_manifest["terraform_init"] = load_manifest(host.app_dir).get("terraform_init")
+    else:
+        print(f"Background terraform init failed (see {os.path.join(host.app_dir, 'terraform-init.log')}); it will run again when deploying.")
+
+# Fetch the project ID (unless variables.txt pins one), exiting if gcloud has no project configured.
+# The exit propagates out of the preflight stage before any dependent lookup starts.
+def require_project_id(host):
+    project_id = host.vars.get("project_id") or fetch_project_id()
+    if not project_id:
+        print("Error: Unable to determine the GCP project ID. Run `gcloud config set project <PROJECT_ID>`.")
+        sys.exit(1)
+    return project_id
+
+# Image for the boot disk: os_type, or a golden image built by build_image.py when golden_image is set.
+# golden_image="auto" picks the image matching the current os_type and stack images, falling back to os_type if it
+# has not been built yet; any other value is used as the image name directly.
+def resolve_boot_image(host):
+    golden_image = host.vars.get("golden_image")
+    if not golden_image:
+        return host.vars.get("os_type")
+    if golden_image != "auto":
+        return golden_image
+
+    prepull_images = stack_images(host.docker_images, host.compose_file_path) if host.vars.get("golden_image_prepull") == "yes" else []
+    name = golden_image_name(host.vars.get("os_type"), prepull_images)
+    self_link = load_golden_image(name)
+    if self_link is None:
+        print(f"Warning: Golden image {name} has not been built for the current inputs; using {host.vars.get('os_type')}. Run `python build_image.py` to build it.")
+        return host.vars.get("os_type")
+    print(f"Using golden image {name}.")
+    return self_link
+
+# Settings for /etc/docker/daemon.json on the server.
+# max-concurrent-downloads matches pull_concurrency so parallel pulls are not throttled by the daemon's default of 3;
+# the tuning profile adds live-restore, capped json-file logs and the containers' open file limit.
+# data_root moves Docker's data to the data disk; setup_server.sh only uses that variant once the disk is mounted.
+def generate_docker_daemon_config(host, data_root=False):
+    return {
+        "max-concurrent-downloads": int(host.vars.get("pull_concurrency") or 4),
+        **tuning_daemon_config(host.tuning_profile_name),
+        **({"data-root": DOCKER_DATA_ROOT} if data_root else {}),
+    }
+
+# Estimate the stack's memory, check it fits server_type (choosing the smallest machine that fits when it is "auto")
+# and, unless sizing="off", add mem_limit and cpus to a generated compose file. A compose_file_path file is deployed
+# as written, with the limits it lacks printed as a recommendation. sizing="strict" stops when the stack does not fit.
+# Returns the compose YAML and the machine type to deploy.
+def size_stack(host, docker_compose_yaml, server_type):
+    sizing_mode = host.vars.get("sizing") or "auto"
+    if sizing_mode == "off":
+        return docker_compose_yaml, server_type
+
+    compose_data = compose_model.load(docker_compose_yaml) or {}
+    arm = sizing.is_arm(host.vars.get("os_type"))
+    if server_type == "auto":
+        required_mb = sizing.plan(compose_data, server_type, arm)["required_mb"]
+        server_type = sizing.recommend_machine_type(required_mb, arm)
+        if server_type is None:
+            print(f"Error: The stack needs about {required_mb}MB of memory; set server_type to a machine type large enough for it.")
+            sys.exit(1)
+        print(f"Using server_type {server_type} for an estimated {required_mb}MB of memory.")
+
+    sizing_plan = sizing.plan(compose_data, server_type, arm)
+    sizing.print_plan(sizing_plan)
+    if server_type not in sizing.MACHINE_TYPES:
+        print(f"Note: {server_type} is not in the sizing table, so its memory was not checked.")
+    elif not sizing_plan["fits"]:
+        recommendation = f'; consider server_type="{sizing_plan["recommended"]}"' if sizing_plan["recommended"] else ""
+        print(f"Warning: The stack needs about {sizing_plan['required_mb']}MB but {server_type} has about {sizing_plan['available_mb']}MB available{recommendation}.")
+        if sizing_mode == "strict":
+            sys.exit(1)
+
+    missing = sizing.missing_limits(compose_data, sizing_plan)
+    if not missing:
+        return docker_compose_yaml, server_type
+    sized_yaml = None if host.compose_file_path else sizing.apply_limits(docker_compose_yaml, compose_data, sizing_plan)
+    if sized_yaml is None:
+        print(f"Note: {host.compose_file_path or 'The compose file'} is deployed unchanged; consider adding these limits:")
+        for name, keys in missing.items():
+            print(f"  {name}: {', '.join(f'{key}: {value}' for key, value in keys.items())}")
+        return docker_compose_yaml, server_type
+    return sized_yaml, server_type
+
+# Run the gcloud lookups concurrently, each exactly once, as soon as the project ID they are scoped to is known
+def run_preflight(host):
+    preflight_tasks = {
+        "project_id": (lambda: require_project_id(host), []),
+        "static_ip": (lambda project_id: check_static_ip(host.app_hostname, host.region, project_id), ["project_id"]),
+        "credentials_path": (lambda project_id: fetch_service_account_key(project_id, host.app_dir), ["project_id"]),
+    }
+    results, durations, wall_time = run_task_graph(preflight_tasks)
+    print_task_report("Preflight", durations, wall_time)
+    return results
+
+# Create the app directory and look up everything rendering depends on: the GCP project, the static IP, a service
+# account key and the SSH user and key. Exits if any of them is unavailable.
+def preflight(host):
+    os.makedirs(host.app_dir, exist_ok=True)  # Create the directory if it doesn't exist
+    results = run_preflight(host)
+    host.project_id = results["project_id"]
+    host.static_ip, host.formatted_hostname = results["static_ip"]
+    host.credentials_path = results["credentials_path"]
+
+    if host.static_ip is None or host.formatted_hostname is None:
+        print("Error: Unable to obtain static IP or formatted hostname.")
+        sys.exit(1)
+
+    # Extract SSH user and public key from the public key file
+    host.ssh_user = get_ssh_user_from_key(host.ssh_public_key_path)
+    host.ssh_public_key = read_ssh_public_key(host.ssh_public_key_path)
+
+    if host.ssh_user is None or host.ssh_public_key is None:
+        print("Error: Unable to extract SSH user or public key from the public key file.")
+        sys.exit(1)
+
+    if host.credentials_path is None:
+        print("Error: Unable to fetch or create a service account key.")
+        sys.exit(1)
+
+    host.credentials_filename = os.path.basename(host.credentials_path)  # Get just the filename
+
+# Generate every deployment file in app_dir, rewriting only those whose content changed. Runs after preflight().
+def render(host):
+    host.artifact_manifest = load_manifest(host.app_dir)
+    host.previous_inputs_hash = host.artifact_manifest.get("inputs")
+    host.artifact_manifest["outputs"] = {}
+    host.written_files = []
+    host.unchanged_files = []
+    start_background_init(host)
+
+    if host.dockerfile_path:
+        if os.path.exists(host.dockerfile_path):
+            with open(host.dockerfile_path, "rb") as file:
+                create_file(host, "Dockerfile", file.read())
+            print(f"Copied Dockerfile from {host.dockerfile_path} to {host.app_dir}.")
+        else:
+            print(f"Warning: Dockerfile not found at {host.dockerfile_path}. It will not be included in the deployment.")
 
-# Update apt repositories
-sudo apt-get update
+    # Generate setup_server.sh
+    data_disk_setup = f"""# Mount the data disk and keep Docker's data on it
+{DATA_DISK_SETUP_SCRIPT}
+""" if host.data_disk_size else ""
+    pull_concurrency = int(host.vars.get("pull_concurrency") or 4)
+    pull_images = " ".join(host.docker_images)
 
-# Install Docker
-sudo apt-get install -y docker-ce docker-ce-cli containerd.io docker-buildx-plugin docker-compose-plugin
+    # Docker's configuration, pointing data-root at the data disk only if setup_server.sh managed to mount it
+    daemon_config = f"""daemon_config='{json.dumps(generate_docker_daemon_config(host), sort_keys=True)}'
+"""
+    if host.data_disk_size:
+        daemon_config += f"""if [ "$data_disk_mounted" = yes ]; then
+    daemon_config='{json.dumps(generate_docker_daemon_config(host, data_root=True), sort_keys=True)}'
+fi
+"""
 
-# Start and enable Docker service
-sudo systemctl start docker
+    # Determine whether to include Docker pull commands based on conditions
+    if host.compose_file_path or host.dockerfile_path:
+        pull_images = ""  # Do not include Docker pull commands
+
+    # Build only when a Dockerfile was uploaded; reuse the layer cache unless a clean rebuild is requested
+    build_flags = " --no-cache" if host.vars.get("rebuild_images") == "yes" else ""
+
+    create_file(host, "setup_server.sh", f"""#!/bin/bash 
+# Enable swap ({host.vars.get("swap") or "auto"}) now and on every boot so memory spikes do not get containers OOM-killed
+{swap_setup_script(host.vars.get("swap") or "auto")}
+{data_disk_setup}# Apply the {host.tuning_profile_name} host tuning profile (kernel network parameters)
+{tuning_setup_script(host.tuning_profile_name)}
+# Configure the Docker daemon, noting whether the configuration changed
+sudo mkdir -p /etc/docker
+{daemon_config}echo "$daemon_config" > /tmp/daemon.json
+if cmp -s /tmp/daemon.json /etc/docker/daemon.json; then
+    daemon_config_changed=no
+else
+    sudo install -m 0644 /tmp/daemon.json /etc/docker/daemon.json
+    daemon_config_changed=yes
+fi
+rm -f /tmp/daemon.json
+
+# Install Docker unless it is already present (e.g. on a CloudTailor golden image)
+{install_unless_present("docker", DOCKER_INSTALL_SCRIPT)}
+# Start and enable Docker service, restarting it if it was already running with an older configuration
+if [ "$daemon_config_changed" = yes ]; then
+    sudo systemctl restart docker
+else
+    sudo systemctl start docker
+fi
 sudo systemctl enable docker
 
-# Pull Docker images
-{docker_pull_commands}
+# Pull Docker images, up to {pull_concurrency} at a time
+images="{pull_images}"
+if [ -n "$images" ]; then
+    printf '%s\\n' $images | xargs -P {pull_concurrency} -n 1 sudo docker pull --quiet
+fi
 
 # Change to the working directory
 cd /opt
 
-# Rebuild Docker images without cache
-sudo docker compose build --no-cache
+# Build Docker images when a Dockerfile is present
+if [ -f /opt/Dockerfile ]; then
+    sudo docker compose build{build_flags}
+fi
 
 # Start Docker Compose
 sudo docker compose up -d
@@ -558,8 +799,9 @@ sudo docker compose up -d
 sudo systemctl enable docker-compose.service
 """)
 
-# Generate docker-compose.service
-create_file("docker-compose.service", """[Unit]
+    # Generate docker-compose.service
+    nofile = tuning_profile(host.tuning_profile_name)["nofile"]
+    create_file(host, "docker-compose.service", f"""[Unit]
 Description=Docker Compose Application Service
 Requires=docker.service
 After=docker.service
@@ -571,45 +813,238 @@ ExecStart=/usr/bin/docker compose -f /opt/docker-compose.yml up
 ExecStop=/usr/bin/docker compose -f /opt/docker-compose.yml down
 Restart=always
 RestartSec=5s
+{f"LimitNOFILE={nofile}" if nofile else ""}
 
 [Install]
 WantedBy=multi-user.target
 """)
 
-# Generate updater.sh
-docker_pull_commands = "\n".join([f"docker pull {image}" for image in docker_images])
-create_file("updater.sh", f"""#!/bin/bash
-# Update the package index
-sudo apt update
+    # Generate updater.sh
+    create_file(host, "updater.sh", updater_script(host.vars.get("update_mode") or "recreate"))
+
+    # Generate Docker Compose YAML
+    docker_compose_yaml = generate_docker_compose_yaml(host)
+
+    if docker_compose_yaml:
+        # Check the stack fits the machine type and give each service memory and CPU limits
+        host.docker_compose_yaml, host.server_type = size_stack(host, docker_compose_yaml, host.vars.get("server_type"))
+        create_file(host, "docker-compose.yml", host.docker_compose_yaml)
+
+        # Generate Cloudflare Script updating ports based on YAML
+        generate_cloudflare_script(host, host.docker_compose_yaml)
+    else:
+        print("Error: Failed to generate or copy Docker Compose YAML.")
+        sys.exit(1)
+
+    # Bundle the artifacts so Terraform uploads them in a single SSH session,
+    # or embed them in a startup script so the instance provisions itself without SSH
+    if host.provision_mode == "startup-script":
+        generate_startup_script(host)
+    elif host.upload_mode == "bundle":
+        create_bundle(host)
+
+    # Generate Terraform configuration
+    generate_terraform_config(host, resolve_boot_image(host))
+
+    # Record this run's input and output hashes so the next run can tell what changed
+    finish_background_init(host)
+    host.artifact_manifest["inputs"] = inputs_sha256(host.vars, [host.compose_file_path, host.dockerfile_path, host.ssh_public_key_path])
+    save_manifest(host.app_dir, host.artifact_manifest)
+    if host.artifact_manifest["inputs"] == host.previous_inputs_hash and not host.written_files:
+        print("Inputs are unchanged since the last run; all generated files are up to date.")
+    else:
+        print(f"Wrote {len(host.written_files)} changed files ({', '.join(host.written_files) or 'none'}); {len(host.unchanged_files)} files were already up to date.")
+
+# Apply the rendered configuration with Terraform, then check readiness (see the readiness variable) and print how to
+# reach the server. Returns the instance IP address, or None if the deployment failed.
+def deploy(host):
+    try:
+        # Initialize only when providers or backend changed, and apply only when the plan has changes
+        if not tf_runner.init(host.app_dir):
+            raise subprocess.CalledProcessError(1, "terraform init")
+        status, plan_result = tf_runner.plan(host.app_dir)
+        if status == "failed":
+            raise subprocess.CalledProcessError(plan_result.returncode, plan_result.args)
+
+        if status == "unchanged":
+            print("Your infrastructure is already up to date.")
+        else:
+            # Stream apply progress as Terraform reports it instead of waiting for the whole run
+            returncode, timings = tf_runner.stream_apply(host.app_dir)
+            tf_runner.print_apply_timings(timings)
+            if returncode != 0:
+                raise subprocess.CalledProcessError(returncode, "terraform apply")
+            print("Deployment completed successfully.")
+    except subprocess.CalledProcessError as e:
+        print(f"An error occurred during deployment: {e}")
+        return None
 
-# Upgrade Docker and Cloudflared
-sudo apt upgrade -y docker-ce docker-ce-cli containerd.io docker-buildx-plugin docker-compose-plugin cloudflared
+    # Read the IP address from the Terraform outputs
+    ip_address = tf_runner.outputs(host.app_dir).get("instance_ip") or host.static_ip
+
+    # Wait for the stack to serve traffic and record how long each phase took
+    readiness_mode = host.vars.get("readiness") or "auto"
+    if ip_address and (readiness_mode == "on" or (readiness_mode == "auto" and host.provision_mode == "startup-script")):
+        tracing.start_phase("readiness")
+        check_readiness(host, ip_address)
+
+    if ip_address and host.provision_mode == "startup-script":
+        print(f"\nYour instance IP address is: {ip_address}")
+        print("\nThe instance installs Docker and starts your stack on first boot; no SSH steps are needed.")
+        print("To follow provisioning progress:")
+        print(f"   ssh -i {host.ssh_private_key_path} {host.ssh_user}@{ip_address} tail -f /var/log/cloudtailor-startup.log")
+        print("A redeploy updates the startup script in place without replacing the instance; changed files are installed")
+        print("at its next boot, or right away with:")
+        print(f"   ssh -i {host.ssh_private_key_path} {host.ssh_user}@{ip_address} sudo google_metadata_script_runner startup")
+        if not host.cloudflare_tunnel_token:
+            print("Then configure Cloudflare Tunnel on the server:")
+            print("   sudo sh /opt/setup_cloudflare.sh")
+    elif ip_address:
+        print(f"\nYour instance IP address is: {ip_address}")
+        print("\nNext steps:")
+        print(f"1. SSH into your new server:")
+        print(f"   ssh -i {host.ssh_private_key_path} {host.ssh_user}@{ip_address}")
+        print("2. Run the server setup script:")
+        print("   sudo sh /opt/setup_server.sh")
+        print("3. Configure Cloudflare Tunnel:")
+        print("   sudo sh /opt/setup_cloudflare.sh")
+        routing_option = f" --routing {host.vars['ingress_routing']}" if host.vars.get("ingress_routing") else ""
+        print("4. Check that the stack serves traffic and how long each phase took:")
+        print(f"   python readiness.py {ip_address} --ssh-user {host.ssh_user} --ssh-key {host.ssh_private_key_path} --compose {os.path.join(host.app_dir, 'docker-compose.yml')} --hostname {host.app_hostname}{routing_option} --output {os.path.join(host.app_dir, 'readiness.json')}")
+        print("\nFollow the prompts in each script to complete the setup.")
+    else:
+        print("Unable to retrieve the instance IP address. Please check the Terraform output manually.")
+    return ip_address
 
-# Pull latest docker images
-{docker_pull_commands}
+# List the generated files and ask whether to deploy them now
+def review_and_deploy(host):
+    print("\nSetup completed. The following files have been generated:")
+    generated_files = [
+        "setup.tf",
+        "setup_server.sh",
+        "setup_cloudflare.sh",
+        "docker-compose.yml",
+        "docker-compose.service",
+        "updater.sh"
+    ]
 
-# Stop current setup
-sudo docker compose stop
+    # Check if a Dockerfile was added
+    if host.dockerfile_path:
+        generated_files.append("Dockerfile")
 
-# Delete docker-containers (data is stored separately)
-sudo docker compose rm -f
+    if host.provision_mode == "startup-script":
+        generated_files.append(STARTUP_SCRIPT_FILENAME)
+    elif host.upload_mode == "bundle":
+        generated_files.append(BUNDLE_FILENAME)
 
-# Start Docker again
-sudo docker compose -f /opt/docker-compose.yml up -d
-""")
+    for file in generated_files:
+        file_path = os.path.join(host.app_dir, file)  # Update to use the new path
+        if os.path.exists(file_path):
+            print(f"- {file}: {file_path}")
 
-# Generate Docker Compose YAML
-docker_compose_yaml = generate_docker_compose_yaml(OPENAI_API_KEY, docker_images, ssh_user, compose_file_path)
+    if not host.compose_file_path and host.docker_images:
+        print("\nWARNING: The Docker Compose file was generated by OpenAI. Please review it carefully before deployment.")
 
-if docker_compose_yaml:
-    # Generate Cloudflare Script updating ports based on YAML
-    generate_cloudflare_script(docker_compose_yaml, formatted_hostname, static_ip, app_hostname)
-else:
-    print("Error: Failed to generate or copy Docker Compose YAML.")
-    exit(1)
+    print("\nPlease review these files carefully before proceeding.")
+
+    # Time spent waiting for the user's choice is not part of any phase
+    tracing.end_phase()
+    while True:
+        choice = input("\nChoose an option:\n1. Exit script (to review files manually)\n2. Proceed with deployment\nEnter your choice (1 or 2): ")
 
-# Generate Terraform configuration
-generate_terraform_config(project_id, static_ip, credentials_path, ssh_user, ssh_public_key, vars.get("os_type"), vars.get("server_type"), dockerfile_path, compose_file_path)
+        if choice == "1":
+            print("Exiting script. To deploy later, run the following commands manually:")
+            print(f"cd {host.app_dir}")
+            print("terraform init")
+            print("terraform apply")
+            return
+        elif choice == "2":
+            print("Proceeding with deployment...")
+            tracing.start_phase("deploy")
+            deploy(host)
+            return
+        else:
+            print("Invalid choice. Please enter 1 or 2.")
+
+# Delete the host's VM, static IP and firewall rules (and its data disk if data_disk="delete"), asking first unless
+# assume_yes. Returns True if everything was deleted.
+def destroy(host, assume_yes=False, data_disk=None):
+    import destroy_instance
+    hosts = [host.vars]
+    keep_data_disks = destroy_instance.choose_keep_data_disks(hosts, data_disk, assume_yes)
+    if not (assume_yes or destroy_instance.confirm_deletion(hosts, keep_data_disks)):
+        print("Deletion canceled.")
+        return False
+    tracing.start_phase("teardown")
+    return destroy_instance.destroy(hosts, host.vars.get("project_id") or fetch_project_id(), keep_data_disks)
+
+# Command line: `render` only generates the files, `deploy` generates them and applies them without prompting and
+# `destroy` tears the host down. Without a subcommand the files are generated and you are asked whether to deploy.
+def main(argv=None):
+    # Options accepted both before and after the subcommand
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--variables", default=argparse.SUPPRESS, help="path to the variables file (default: variables.txt)")
+
+    parser = argparse.ArgumentParser(description="Generate Terraform and server setup files for a CloudTailor host.", parents=[common])
+    parser.add_argument("--render-only", action="store_true", help="same as the render subcommand; fleet.py and older scripts use it")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser("render", parents=[common], help="generate the files and exit without the deployment prompt")
+    subparsers.add_parser("deploy", parents=[common], help="generate the files and deploy them without prompting")
+    destroy_parser = subparsers.add_parser("destroy", parents=[common], help="delete the host's VM, static IP and firewall rules")
+    destroy_parser.add_argument("--yes", action="store_true", help="do not ask for confirmation")
+    destroy_parser.add_argument("--data-disk", choices=["keep", "delete"], help="keep or delete the data disk (default: ask, or keep with --yes)")
+    args = parser.parse_args(argv)
+    variables_path = getattr(args, "variables", "variables.txt")
+    command = args.command or ("render" if args.render_only else None)
+
+    # Check if variables.txt exists
+    if not os.path.exists(variables_path):
+        print(f"{variables_path} file is required to run this script.")
+        sys.exit(1)
+
+    # Load variables from variables.txt
+    host = Host(load_variables(variables_path))
+
+    # Allow variables.txt to turn off the on-disk gcloud result cache and the shared Terraform plugin cache
+    if host.vars.get("gcloud_cache", "on").lower() == "off":
+        gcp_cache.enabled = False
+    if host.vars.get("terraform_plugin_cache", "on").lower() == "off":
+        tf_runner.plugin_cache_enabled = False
+
+    # Trace external commands, API calls and generated files: trace="on" (default) prints a summary at exit and writes
+    # trace.jsonl and a Chrome trace (trace.json) to app_dir, "summary" only prints the summary and "off" records nothing
+    trace_mode = host.vars.get("trace") or "on"
+    if trace_mode == "off":
+        tracing.enabled = False
+    else:
+        tracing.configure(host.app_dir if trace_mode == "on" and command != "destroy" else None)
+    tracing.start_phase("startup")
+
+    # Call GCP through gcloud (default) or the REST API (gcp_backend="rest")
+    gcp.use_backend(host.vars.get("gcp_backend"), host.app_dir)
+
+    if command == "destroy":
+        sys.exit(0 if destroy(host, args.yes, args.data_disk) else 1)
+
+    # Unknown profile or routing names in variables.txt surface as ValueError while rendering
+    try:
+        tracing.start_phase("preflight")
+        preflight(host)
+        tracing.start_phase("render")
+        render(host)
+    except ValueError as error:
+        print(f"Error: {error}")
+        sys.exit(1)
+
+    if command == "render":
+        print(f"Generated deployment files in {host.app_dir}.")
+    elif command == "deploy":
+        tracing.start_phase("deploy")
+        sys.exit(0 if deploy(host) else 1)
+    else:
+        # Allow the user to review files before deployment
+        review_and_deploy(host)
 
-# Call the review_and_deploy function to allow the user to review files before deployment
-review_and_deploy()
+# Main execution
+if __name__ == "__main__":
+    main()
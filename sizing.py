@@ -0,0 +1,221 @@
+import re
+
+# vCPUs and memory (MB) of common machine types, smallest first within each family.
+# Shared-core types (e2-micro/small/medium, f1-micro, g1-small) can burst to their vCPU count.
+MACHINE_TYPES = {
+    "f1-micro": (1, 614),
+    "g1-small": (1, 1740),
+    "e2-micro": (2, 1024),
+    "e2-small": (2, 2048),
+    "e2-medium": (2, 4096),
+    "e2-standard-2": (2, 8192),
+    "e2-standard-4": (4, 16384),
+    "e2-highcpu-2": (2, 2048),
+    "e2-highmem-2": (2, 16384),
+    "n1-standard-1": (1, 3840),
+    "n2-standard-2": (2, 8192),
+    "n2d-standard-2": (2, 8192),
+    "t2a-standard-1": (1, 4096),
+    "t2a-standard-2": (2, 8192),
+    "t2a-standard-4": (4, 16384),
+    "t2d-standard-1": (1, 4096),
+    "t2d-standard-2": (2, 8192),
+}
+
+# Machine types server_type="auto" chooses from, cheapest first; Arm images (os_type containing arm64) need t2a
+RECOMMENDATION_ORDER = ["e2-micro", "e2-small", "e2-medium", "e2-standard-2", "e2-standard-4"]
+ARM_RECOMMENDATION_ORDER = ["t2a-standard-1", "t2a-standard-2", "t2a-standard-4"]
+
+# Memory used by the OS, dockerd, containerd and cloudflared before any container starts
+SYSTEM_RESERVED_MB = 300
+
+# Typical steady-state memory (MB) of popular images, used when a service sets no memory limit of its own
+IMAGE_MEMORY_HINTS = {
+    "nginx": 32,
+    "httpd": 32,
+    "caddy": 32,
+    "traefik": 64,
+    "redis": 64,
+    "memcached": 64,
+    "postgres": 256,
+    "mysql": 512,
+    "mariadb": 256,
+    "mongo": 512,
+    "rabbitmq": 256,
+    "elasticsearch": 2048,
+    "node": 128,
+    "python": 128,
+    "wordpress": 256,
+    "ghost": 256,
+    "nextcloud": 512,
+    "grafana/grafana": 128,
+    "prom/prometheus": 256,
+    "homebridge/homebridge": 256,
+    "n8nio/n8n": 256,
+    "gitea/gitea": 256,
+    "vaultwarden/server": 64,
+    "louislam/uptime-kuma": 128,
+    "pihole/pihole": 128,
+    "portainer/portainer-ce": 64,
+}
+DEFAULT_IMAGE_MEMORY_MB = 128
+
+# A service label that sets its memory estimate, e.g. cloudtailor.memory: "300m"
+MEMORY_LABEL = "cloudtailor.memory"
+
+# Most memory (MB) a scaled-up limit adds to a service's estimate, so one service cannot claim all the free memory
+LIMIT_HEADROOM_MB = 256
+
+# A block-style mapping key with no inline value (optionally with an anchor or comment), e.g. `  web:` or `  db: &db`
+BLOCK_KEY = re.compile(r"""^( *)(?:"([^"]+)"|'([^']+)'|([^\s#'"][^:#]*?))\s*:(?:\s+&\S+)?\s*(?:#.*)?$""")
+
+# Parse a compose memory value ("512m", "1.5g", "1024k", or a number of bytes) into MB
+def parse_memory_mb(value):
+    match = re.match(r"^\s*(\d+(?:\.\d+)?)\s*([bkmg]?)b?\s*$", str(value).lower())
+    if not match:
+        raise ValueError(f"Unrecognized memory size: {value!r}")
+    number, unit = float(match[1]), match[2]
+    return int(number * {"": 1 / 1048576, "b": 1 / 1048576, "k": 1 / 1024, "m": 1, "g": 1024}[unit])
+
+# Memory hint for an image reference, ignoring the registry, library/ prefix, tag and digest
+def image_memory_hint(image):
+    name = image.split("@")[0]
+    if ":" in name.rsplit("/", 1)[-1]:
+        name = name.rsplit(":", 1)[0]
+    parts = name.split("/")
+    if len(parts) > 1 and ("." in parts[0] or ":" in parts[0] or parts[0] == "localhost"):
+        parts = parts[1:]
+    if parts[0] == "library":
+        parts = parts[1:]
+    name = "/".join(parts)
+    return IMAGE_MEMORY_HINTS.get(name) or IMAGE_MEMORY_HINTS.get(parts[-1], DEFAULT_IMAGE_MEMORY_MB)
+
+# Memory limit a service already sets in the compose file, in MB, or None
+def compose_memory_limit(service_details):
+    limit = service_details.get("mem_limit") or (((service_details.get("deploy") or {}).get("resources") or {}).get("limits") or {}).get("memory")
+    return parse_memory_mb(limit) if limit else None
+
+# Estimate of a service's memory in MB and where it came from: its compose limit, its label or the image hint
+def service_memory(service_details):
+    limit = compose_memory_limit(service_details)
+    if limit:
+        return limit, "compose"
+    labels = service_details.get("labels") or {}
+    if isinstance(labels, list):
+        labels = dict(label.split("=", 1) for label in labels if "=" in label)
+    if labels.get(MEMORY_LABEL):
+        return parse_memory_mb(labels[MEMORY_LABEL]), "label"
+    if service_details.get("image"):
+        return image_memory_hint(service_details["image"]), "hint"
+    return DEFAULT_IMAGE_MEMORY_MB, "default"
+
+# Smallest machine type from the recommendation order with room for the stack, or None if none is large enough
+def recommend_machine_type(required_mb, arm=False):
+    for machine_type in ARM_RECOMMENDATION_ORDER if arm else RECOMMENDATION_ORDER:
+        if MACHINE_TYPES[machine_type][1] - SYSTEM_RESERVED_MB >= required_mb:
+            return machine_type
+    return None
+
+# Whether an os_type is an Arm image, e.g. "ubuntu-2204-lts-arm64" or "cos-cloud/cos-arm64-109-lts"
+def is_arm(os_type):
+    return "arm64" in (os_type or "")
+
+# Plan memory and CPU limits for every service on a machine type.
+# Services without a limit of their own get their estimate scaled up to share the machine's free memory, but by no
+# more than LIMIT_HEADROOM_MB, so the limits only cap runaway services; a CPU cap of twice each service's fair share keeps one busy service from
+# starving the rest. Returns a dict with the machine's resources, the total estimate, whether it fits, a
+# recommended machine type and per-service {"memory_mb", "cpus", "source"}.
+def plan(compose_data, server_type, arm=False):
+    services = {name: details or {} for name, details in (compose_data.get("services") or {}).items()}
+    estimates = {name: service_memory(details) for name, details in services.items()}
+    required_mb = sum(memory for memory, _ in estimates.values())
+
+    vcpus, memory_mb = MACHINE_TYPES.get(server_type, (None, None))
+    available_mb = memory_mb - SYSTEM_RESERVED_MB if memory_mb else None
+    scale = max(available_mb / required_mb, 1) if available_mb and required_mb else 1
+
+    limits = {}
+    for name, (memory, source) in estimates.items():
+        limits[name] = {
+            "memory_mb": memory if source == "compose" else min(int(memory * scale), memory + LIMIT_HEADROOM_MB),
+            "cpus": round(min(vcpus, max(0.25, vcpus * 2 / len(services))), 2) if vcpus else None,
+            "source": source,
+        }
+
+    return {
+        "server_type": server_type,
+        "available_mb": available_mb,
+        "required_mb": required_mb,
+        "fits": available_mb is None or required_mb <= available_mb,
+        "recommended": recommend_machine_type(required_mb, arm),
+        "services": limits,
+    }
+
+# Print the sizing plan as a table
+def print_plan(sizing_plan):
+    available = f"{sizing_plan['available_mb']}MB available" if sizing_plan["available_mb"] else "unknown memory"
+    print(f"\nSizing for {sizing_plan['server_type']} ({available}, {sizing_plan['required_mb']}MB estimated):")
+    for name, limits in sizing_plan["services"].items():
+        cpus = f"{limits['cpus']} cpus" if limits["cpus"] else ""
+        print(f"  {name:<30} {limits['memory_mb']:>6}MB {cpus:<10} ({limits['source']})")
+
+# mem_limit and cpus for every service that does not already set them, as {service: {key: value}}
+def missing_limits(compose_data, sizing_plan):
+    missing = {}
+    for name, details in (compose_data.get("services") or {}).items():
+        details = details or {}
+        limits = sizing_plan["services"][name]
+        resource_limits = ((details.get("deploy") or {}).get("resources") or {}).get("limits") or {}
+        keys = {}
+        if compose_memory_limit(details) is None:
+            keys["mem_limit"] = f"{limits['memory_mb']}m"
+        if limits["cpus"] and "cpus" not in details and "cpus" not in resource_limits:
+            keys["cpus"] = limits["cpus"]
+        if keys:
+            missing[name] = keys
+    return missing
+
+# Line index of each service under the top-level services key of a block-style compose file, or None for a service
+# that is not written as a block mapping
+def service_lines(lines):
+    services_index = next((index for index, line in enumerate(lines) if re.match(r"^services\s*:\s*(#.*)?$", line)), None)
+    if services_index is None:
+        return {}
+    found = {}
+    service_indent = None
+    for index in range(services_index + 1, len(lines)):
+        line = lines[index]
+        if not line.strip() or line.lstrip().startswith("#"):
+            continue
+        indent = len(line) - len(line.lstrip(" "))
+        if indent == 0:
+            break
+        if service_indent is None:
+            service_indent = indent
+        match = BLOCK_KEY.match(line.rstrip("\r\n"))
+        if indent == service_indent and match:
+            found[match[2] or match[3] or match[4]] = index
+    return found
+
+# Add mem_limit and cpus to every service that does not already set them by inserting lines into the compose text,
+# so comments, anchors and quoting stay as written (a YAML round trip would turn "22:22" into 1342).
+# Returns the compose YAML, or None if a service that needs limits is not written as a block mapping.
+def apply_limits(compose_yaml, compose_data, sizing_plan):
+    missing = missing_limits(compose_data, sizing_plan)
+    lines = compose_yaml.splitlines(keepends=True)
+    positions = service_lines(lines)
+    if any(name not in positions for name in missing):
+        return None
+
+    # Insert from the bottom up so earlier line indexes stay valid
+    for name in sorted(missing, key=positions.get, reverse=True):
+        index = positions[name]
+        indent = len(lines[index]) - len(lines[index].lstrip(" "))
+        child = next((line for line in lines[index + 1:] if line.strip() and not line.lstrip().startswith("#")), "")
+        child_indent = len(child) - len(child.lstrip(" "))
+        if child_indent <= indent:
+            child_indent = indent + (indent or 2)
+        if not lines[index].endswith("\n"):
+            lines[index] += "\n"
+        lines[index + 1:index + 1] = [f"{' ' * child_indent}{key}: {value}\n" for key, value in missing[name].items()]
+    return "".join(lines)
@@ -0,0 +1,49 @@
+import contextvars
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+# Run named tasks on a thread pool, starting each one as soon as the tasks it depends on have finished.
+# tasks maps a name to (function, [dependency names]); every function runs exactly once and is called
+# with the results of its dependencies as keyword arguments, in a copy of the caller's context (so context variables
+# such as fleet.py's per-host output redirect apply to it).
+# Returns (results, durations, wall_time) where durations holds the seconds spent in each task.
+def run_task_graph(tasks, max_workers=None):
+    results = {}
+    durations = {}
+    pending = dict(tasks)
+    running = {}
+    start = time.monotonic()
+
+    # Time each task inside its worker thread so queueing does not count against it
+    def timed(name, func, kwargs):
+        task_start = time.monotonic()
+        try:
+            return func(**kwargs)
+        finally:
+            durations[name] = time.monotonic() - task_start
+
+    with ThreadPoolExecutor(max_workers=max_workers or max(len(tasks), 1)) as pool:
+        while pending or running:
+            # Submit every task whose dependencies are satisfied
+            for name, (func, deps) in list(pending.items()):
+                if all(dep in results for dep in deps):
+                    kwargs = {dep: results[dep] for dep in deps}
+                    running[pool.submit(contextvars.copy_context().run, timed, name, func, kwargs)] = name
+                    del pending[name]
+
+            if not running:
+                raise ValueError(f"Unresolvable task dependencies: {', '.join(sorted(pending))}")
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                results[name] = future.result()
+
+    return results, durations, time.monotonic() - start
+
+# Print how long each task took and how much wall time running them concurrently saved
+def print_task_report(label, durations, wall_time):
+    sequential_time = sum(durations.values())
+    print(f"{label} finished in {wall_time:.2f}s (sequential: {sequential_time:.2f}s, saved: {max(sequential_time - wall_time, 0):.2f}s)")
+    for name, duration in sorted(durations.items(), key=lambda item: -item[1]):
+        print(f"  {name}: {duration:.2f}s")
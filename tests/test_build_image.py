@@ -0,0 +1,82 @@
+import json
+import os
+import subprocess
+import sys
+import pytest
+from provisioning import golden_image_name
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMAGE = golden_image_name("ubuntu-2204-lts-arm64", [])
+
+# A work directory with variables.txt, a bin directory with bench/fake_tool.py linked in as gcloud and a directory
+# for the images the fake gcloud creates
+@pytest.fixture
+def workdir(tmp_path):
+    bin_dir = tmp_path / "bin"
+    for directory in ("bin", "images", "tmp"):
+        (tmp_path / directory).mkdir()
+    os.symlink(os.path.join(REPO_DIR, "bench", "fake_tool.py"), bin_dir / "gcloud")
+    (tmp_path / "variables.txt").write_text('project_id="demo-project"\nregion="us-west1"\ngcloud_cache="off"\n')
+    return tmp_path
+
+# Run build_image.py in the work directory and return (exit code, gcloud commands it ran)
+def run_build(workdir, *args, fail=False):
+    env = dict(os.environ)
+    env.update({
+        "PATH": str(workdir / "bin") + os.pathsep + env.get("PATH", ""),
+        "BENCH_TOOL_LOG": str(workdir / "tools.jsonl"),
+        "BENCH_GCLOUD_IMAGE_DIR": str(workdir / "images"),
+        "TMPDIR": str(workdir / "tmp"),
+    })
+    env.pop("BENCH_GCLOUD_BUILD_FAILS", None)
+    if fail:
+        env["BENCH_GCLOUD_BUILD_FAILS"] = "1"
+    result = subprocess.run([sys.executable, os.path.join(REPO_DIR, "build_image.py"), *args], cwd=workdir, env=env, capture_output=True, text=True)
+    log_path = workdir / "tools.jsonl"
+    calls = [json.loads(line)["args"] for line in log_path.read_text().splitlines()] if log_path.exists() else []
+    log_path.unlink(missing_ok=True)
+    return result.returncode, calls
+
+def commands(calls, group, command):
+    return [call for call in calls if call[1:3] == [group, command]]
+
+def test_builds_the_image_on_a_matching_builder(workdir):
+    returncode, calls = run_build(workdir)
+    assert returncode == 0
+    create = commands(calls, "instances", "create")[0]
+    assert create[create.index("--machine-type") + 1] == "t2a-standard-1"
+    assert commands(calls, "images", "create")[0][3] == IMAGE
+    assert commands(calls, "instances", "delete")
+    manifest = json.loads((workdir / "golden-image.json").read_text())
+    assert manifest["images"][IMAGE]["self_link"].endswith(f"/images/{IMAGE}")
+    assert not os.listdir(workdir / "tmp")
+
+def test_existing_image_is_a_cache_hit(workdir):
+    assert run_build(workdir)[0] == 0
+    returncode, calls = run_build(workdir)
+    assert returncode == 0
+    assert [call[1:3] for call in calls] == [["images", "describe"]]
+
+def test_force_replaces_the_image_after_the_build(workdir):
+    assert run_build(workdir)[0] == 0
+    returncode, calls = run_build(workdir, "--force")
+    assert returncode == 0
+    kinds = [call[1:3] for call in calls]
+    assert kinds.index(["instances", "get-serial-port-output"]) < kinds.index(["images", "delete"]) < kinds.index(["images", "create"])
+    assert os.listdir(workdir / "images") == [IMAGE]
+
+def test_failed_build_cleans_up_and_keeps_the_old_image(workdir):
+    assert run_build(workdir)[0] == 0
+    returncode, calls = run_build(workdir, "--force", fail=True)
+    assert returncode == 1
+    assert commands(calls, "instances", "delete")
+    assert not commands(calls, "images", "delete") and not commands(calls, "images", "create")
+    assert os.listdir(workdir / "images") == [IMAGE]
+    assert not os.listdir(workdir / "tmp")
+
+def test_build_is_traced(workdir):
+    assert run_build(workdir, "--trace-dir", str(workdir))[0] == 0
+    spans = [json.loads(line) for line in (workdir / "trace.jsonl").read_text().splitlines()]
+    assert {span["name"] for span in spans if span["category"] == "phase"} == {"preflight", "build"}
+    assert any(span["name"] == "gcloud compute images create" for span in spans)
@@ -0,0 +1,40 @@
+import pytest
+import yaml
+import cloudflare
+
+COMPOSE_DATA = {
+    "services": {
+        "web": {"image": "nginx:latest", "ports": ["8080:80", "8443:443"]},
+        "grpc": {"image": "grpc-app", "ports": ["9000:9000"], "labels": {"cloudtailor.ingress.scheme": "h2c"}},
+        "admin": {"image": "admin", "ports": ["9443:8443"], "labels": ["cloudtailor.origin.noTLSVerify=false"]},
+    },
+}
+
+def rules_by_service(rules):
+    return {rule["service"]: rule.get("originRequest") for rule in rules}
+
+def test_derived_https_origins_skip_certificate_checks():
+    rules = rules_by_service(cloudflare.ingress_rules(COMPOSE_DATA, "app.example.com"))
+    assert rules["http://localhost:8080"] is None
+    assert rules["https://localhost:8443"] == {"noTLSVerify": True}
+    assert rules["https://localhost:9443"] == {"noTLSVerify": False}
+    assert rules["http://localhost:9000"] == {"http2Origin": True}
+
+def test_performance_profile_uses_http2_for_https_origins():
+    rules = cloudflare.ingress_rules(COMPOSE_DATA, "app.example.com")
+    config = yaml.safe_load(cloudflare.render_config(rules, "performance"))
+    origins = {rule["service"]: rule.get("originRequest") for rule in config["ingress"]}
+    assert origins["https://localhost:8443"] == {"http2Origin": True, "noTLSVerify": True}
+    assert origins["http://localhost:8080"] is None
+    assert "http2Origin" not in config["originRequest"]
+
+def test_balanced_profile_leaves_origins_alone():
+    rules = cloudflare.ingress_rules(COMPOSE_DATA, "app.example.com")
+    config = yaml.safe_load(cloudflare.render_config(rules, "balanced"))
+    assert {rule["service"]: rule.get("originRequest") for rule in config["ingress"]}["https://localhost:8443"] == {"noTLSVerify": True}
+
+def test_unknown_names_raise_value_error():
+    with pytest.raises(ValueError, match='Unknown cloudflare_profile "fast". Choose one of: '):
+        cloudflare.render_config([], "fast")
+    with pytest.raises(ValueError, match='Unknown ingress_routing "port"'):
+        cloudflare.ingress_rules(COMPOSE_DATA, "app.example.com", "port")
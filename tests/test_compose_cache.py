@@ -0,0 +1,68 @@
+import itertools
+import os
+import subprocess
+import sys
+import pytest
+import compose_cache
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# An empty cache in tmp_path holding at most three entries, with a clock that advances one second per call
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    clock = itertools.count(1000)
+    monkeypatch.setattr(compose_cache, "CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(compose_cache, "MAX_ENTRIES", 3)
+    monkeypatch.setattr(compose_cache, "MAX_BYTES", 1024)
+    monkeypatch.setattr(compose_cache.time, "time", lambda: next(clock))
+    return tmp_path
+
+def cached_keys():
+    return sorted(compose_cache._load_index())
+
+def test_evicts_least_recently_used_first(cache):
+    for key in ("a", "b", "c"):
+        compose_cache.put(key, f"services: {{}}  # {key}\n")
+    assert compose_cache.get("a") is not None
+    compose_cache.put("d", "services: {}\n")
+    assert cached_keys() == ["a", "c", "d"]
+    assert not (cache / "b.yml").exists()
+    assert compose_cache.get("b") is None
+
+def test_pinned_entries_survive_eviction(cache):
+    compose_cache.put("a", "services: {}\n")
+    assert compose_cache.set_pinned("a", True)
+    for key in ("b", "c", "d", "e"):
+        compose_cache.put(key, "services: {}\n")
+    assert cached_keys() == ["a", "d", "e"]
+    assert compose_cache.get("a") == "services: {}\n"
+
+def test_rewriting_a_pinned_entry_keeps_it_pinned(cache):
+    compose_cache.put("a", "services: {}\n")
+    compose_cache.set_pinned("a", True)
+    compose_cache.put("a", "services:\n  web: {}\n")
+    assert compose_cache._load_index()["a"]["pinned"]
+
+def test_size_cap_evicts_until_the_cache_fits(cache):
+    compose_cache.put("a", "x" * 400)
+    compose_cache.put("b", "x" * 400)
+    compose_cache.put("c", "x" * 400)
+    assert cached_keys() == ["b", "c"]
+    assert sum(entry["size"] for entry in compose_cache._load_index().values()) <= compose_cache.MAX_BYTES
+
+def test_pinned_entries_may_exceed_the_cap(cache):
+    compose_cache.put("a", "services: {}\n")
+    compose_cache.set_pinned("a", True)
+    compose_cache.put("a", "x" * 2000)
+    compose_cache.put("b", "x" * 10)
+    assert cached_keys() == ["a"]
+
+def test_limits_and_directory_come_from_the_environment(tmp_path):
+    env = {
+        **os.environ,
+        "CLOUDTAILOR_COMPOSE_CACHE_DIR": str(tmp_path),
+        "CLOUDTAILOR_COMPOSE_CACHE_MAX_ENTRIES": "7",
+        "CLOUDTAILOR_COMPOSE_CACHE_MAX_BYTES": "4096",
+    }
+    result = subprocess.run([sys.executable, "-c", "import compose_cache; print(compose_cache.CACHE_DIR, compose_cache.MAX_ENTRIES, compose_cache.MAX_BYTES)"], cwd=REPO_DIR, env=env, capture_output=True, text=True, check=True)
+    assert result.stdout.split() == [str(tmp_path), "7", "4096"]
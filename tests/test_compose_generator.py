@@ -0,0 +1,95 @@
+import threading
+import time
+import pytest
+import compose_generator
+
+pytest.importorskip("openai")
+
+VALID = """services:
+  web:
+    image: nginx:latest
+    ports:
+      - "8080:80"
+  cache:
+    image: redis:alpine
+"""
+
+REQUEST = {"model": "gpt-4-0613", "messages": [{"role": "user", "content": "nginx and redis"}]}
+
+@pytest.mark.parametrize("text", [
+    VALID,
+    f"Here is the configuration:\n\n```yaml\n{VALID}```\nLet me know if you need changes.",
+    f"```\n{VALID}```",
+    f"```docker-compose\n{VALID}",
+])
+def test_strip_fences(text):
+    assert compose_generator.strip_fences(text) == VALID
+
+def test_validate_accepts_a_valid_file():
+    data, problems = compose_generator.validate(VALID, ["nginx", "docker.io/library/redis:7"])
+    assert problems == []
+    assert set(data["services"]) == {"web", "cache"}
+
+@pytest.mark.parametrize("text, problem", [
+    ("services: [web", "not valid YAML"),
+    ("- web\n", "not a YAML mapping"),
+    ("version: '2'\nservices:\n  web:\n    image: nginx\n", "is not a Compose v3 file"),
+    ("services:\n  web:\n    image: nginx\n    restrat: always\n", "unknown key 'restrat'"),
+    ("services:\n  web:\n    image: nginx\n    restart: sometimes\n", "unknown restart policy"),
+    ("services:\n  web:\n    ports: ['80']\n", "has neither image nor build"),
+    ("services:\n  web:\n    image: nginx\n    ports: '80'\n", "ports should be a list"),
+    ("services:\n  web:\n    image: nginx\n    ports: ['70000:80']\n", "port 70000 is out of range"),
+    ("services:\n  web:\n    image: nginx\n    ports: ['80/icmp']\n", "unknown protocol 'icmp'"),
+    ("services:\n  a:\n    image: nginx\n    ports: ['8080:80']\n  b:\n    image: httpd\n    ports: ['127.0.0.1:8080:80']\n", "host port 8080/tcp is already published by a"),
+    ("services:\n  web:\n    image: nginx\n", "image redis is not used by any service"),
+    ("services:\n  web:\n    image: nginx\n    ports:\n      - 22:22\n", 'quote it as "22:22"'),
+])
+def test_validate_reports_problems(text, problem):
+    _, problems = compose_generator.validate(text, ["nginx", "redis"])
+    assert any(problem in message for message in problems), problems
+
+# Replace the chat completion call with scripted answers, one per request, each taking `seconds`
+def script_answers(monkeypatch, answers, seconds=0.0):
+    calls = []
+    def request_candidate(client, request, timeout):
+        calls.append(time.monotonic())
+        index = len(calls) - 1
+        time.sleep(seconds if index == 0 else 0)
+        return answers[min(index, len(answers) - 1)]
+    monkeypatch.setattr(compose_generator, "request_candidate", request_candidate)
+    return calls
+
+def test_generate_sends_one_request_when_it_is_valid(monkeypatch):
+    calls = script_answers(monkeypatch, [VALID])
+    assert compose_generator.generate(REQUEST, "sk-test", ["nginx", "redis"]) == VALID
+    assert len(calls) == 1
+
+def test_generate_hedges_after_an_invalid_answer(monkeypatch):
+    calls = script_answers(monkeypatch, ["services: [", VALID])
+    assert compose_generator.generate(REQUEST, "sk-test", ["nginx", "redis"]) == VALID
+    assert len(calls) == 2
+
+def test_generate_hedges_a_slow_request(monkeypatch):
+    calls = script_answers(monkeypatch, [VALID], seconds=1.0)
+    assert compose_generator.generate(REQUEST, "sk-test", ["nginx", "redis"], hedge_delay=0.1) == VALID
+    assert len(calls) == 2
+    assert calls[1] - calls[0] >= 0.1
+
+def test_generate_gives_up_after_its_attempts(monkeypatch):
+    monkeypatch.setattr(compose_generator, "INITIAL_BACKOFF", 0)
+    calls = script_answers(monkeypatch, ["services: ["])
+    with pytest.raises(compose_generator.GenerationError, match="not valid YAML"):
+        compose_generator.generate(REQUEST, "sk-test", attempts=2)
+    assert len(calls) == 4
+
+def test_identical_generations_share_one_request(monkeypatch):
+    calls = script_answers(monkeypatch, [VALID], seconds=0.3)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(compose_generator.generate(REQUEST, "sk-test", ["nginx", "redis"]))) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [VALID] * 3
+    assert len(calls) == 1
+    assert not compose_generator._in_flight
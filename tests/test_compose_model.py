@@ -0,0 +1,50 @@
+import pytest
+import compose_model
+
+def mapping(host_ip, published, target, protocol="tcp"):
+    return {"host_ip": host_ip, "published": published, "target": target, "protocol": protocol}
+
+@pytest.mark.parametrize("entry, expected", [
+    (80, [mapping(None, None, 80)]),
+    ("80", [mapping(None, None, 80)]),
+    ("8080:80", [mapping(None, 8080, 80)]),
+    ("53:53/udp", [mapping(None, 53, 53, "udp")]),
+    ("9000-9001:9000-9001", [mapping(None, 9000, 9000), mapping(None, 9001, 9001)]),
+    ("8000-8010:80", [mapping(None, None, 80)]),
+    ("127.0.0.1:8080:80", [mapping("127.0.0.1", 8080, 80)]),
+    ("127.0.0.1::80", [mapping("127.0.0.1", None, 80)]),
+    ("[::1]:8080:80", [mapping("::1", 8080, 80)]),
+    ("::1:8080:80", [mapping("::1", 8080, 80)]),
+    ("fe80::1:8443:443/tcp", [mapping("fe80::1", 8443, 443)]),
+    ({"target": 80, "published": "8080", "protocol": "TCP"}, [mapping(None, 8080, 80)]),
+    ({"target": 80, "host_ip": "127.0.0.1"}, [mapping("127.0.0.1", None, 80)]),
+    ({"target": "5000-5001", "published": "6000-6001", "protocol": "udp"}, [mapping(None, 6000, 5000, "udp"), mapping(None, 6001, 5001, "udp")]),
+])
+def test_parse_port(entry, expected):
+    assert compose_model.parse_port(entry) == expected
+
+@pytest.mark.parametrize("entry", ["${PORT}:80", "$PORT:80", "8080:${TARGET:-80}", {"target": 80, "published": "${PORT}"}])
+def test_interpolated_ports_are_rejected(entry):
+    with pytest.raises(ValueError, match="interpolation"):
+        compose_model.parse_port(entry)
+
+@pytest.mark.parametrize("entry", ["web:80", "1:2:3:4", "8000-8002:80-81", "zz::1:8080:80"])
+def test_unparseable_ports_are_rejected(entry):
+    with pytest.raises(ValueError):
+        compose_model.parse_port(entry)
+
+def test_service_ports_skips_interpolated_entries(capsys):
+    compose_data = {"services": {"web": {"ports": ["${PORT}:80", "8080:80"]}}}
+    assert compose_model.service_ports(compose_data) == {"web": [mapping(None, 8080, 80)]}
+    assert "uses variable interpolation" in capsys.readouterr().out
+
+def test_load_keeps_base_60_ports_recognizable():
+    ports = compose_model.load("services:\n  git:\n    image: gitea\n    ports:\n      - 22:22\n      - \"2222:22\"\n      - 3000\n")["services"]["git"]["ports"]
+    assert ports == [1342, "2222:22", 3000]
+    assert isinstance(ports[0], compose_model.SexagesimalInt) and ports[0].text == "22:22"
+    assert type(ports[2]) is int
+
+def test_unquoted_base_60_port_is_rejected():
+    entry = compose_model.load("- 22:22\n")[0]
+    with pytest.raises(ValueError, match='read by YAML as the number 1342; quote it as "22:22"'):
+        compose_model.parse_port(entry)
@@ -0,0 +1,33 @@
+import io
+import sys
+import cloudflare
+import fleet
+from task_graph import run_task_graph
+
+# Preflight lookups run on task_graph worker threads; what they print belongs in the log of the host that started them
+def test_task_graph_workers_print_to_the_hosts_log(monkeypatch):
+    output = fleet.ThreadOutput(io.StringIO())
+    monkeypatch.setattr(sys, "stdout", output)
+    logs = {"a": io.StringIO(), "b": io.StringIO()}
+
+    def render(name):
+        with output.redirect(logs[name]):
+            run_task_graph({"static_ip": (lambda: print(f"Error listing static IPs for {name}"), [])})
+
+    run_task_graph({name: (lambda name=name: render(name), []) for name in logs})
+    print("fleet summary")
+    assert logs["a"].getvalue() == "Error listing static IPs for a\n"
+    assert logs["b"].getvalue() == "Error listing static IPs for b\n"
+    assert output.stream.getvalue() == "fleet summary\n"
+
+# A host with an unknown setting fails with the error in its render log instead of a traceback
+def test_render_host_reports_invalid_settings(tmp_path, monkeypatch):
+    monkeypatch.setattr(fleet, "FLEET_DIR", str(tmp_path))
+    monkeypatch.setattr(sys, "stdout", fleet.ThreadOutput(io.StringIO()))
+    monkeypatch.setattr(sys, "stderr", fleet.ThreadOutput(io.StringIO()))
+    monkeypatch.setattr(fleet.setup, "preflight", lambda host: None)
+    monkeypatch.setattr(fleet.setup, "render", lambda host: cloudflare.profile_settings(host.cloudflare_profile))
+    ok, _, log_path = fleet.render_host({"app_hostname": "app.example.com", "cloudflare_profile": "fast"})
+    assert not ok
+    with open(log_path) as file:
+        assert file.read() == 'Error: Unknown cloudflare_profile "fast". Choose one of: debug, balanced, performance.\n'
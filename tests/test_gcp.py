@@ -0,0 +1,57 @@
+import subprocess
+import pytest
+import destroy_instance
+import gcp
+
+# gcloud's error for a delete of a resource that does not exist
+NOT_FOUND = "ERROR: (gcloud.compute.instances.delete) Could not fetch resource:\n - The resource 'projects/demo-project/zones/us-west1-a/instances/app-example-com' was not found\n"
+
+# gcloud commands run so far, and the resource names gcloud reports as not found
+class GcloudCalls(list):
+    def __init__(self):
+        super().__init__()
+        self.missing = set()
+
+# Record the gcloud commands gcp.py runs, answering async deletes with an operation name and deletes of the names in
+# missing with gcloud's not-found error
+@pytest.fixture
+def gcloud_calls(monkeypatch):
+    calls = GcloudCalls()
+
+    def run(command, **kwargs):
+        calls.append(command)
+        if "delete" in command and command[command.index("delete") + 1] in calls.missing:
+            return subprocess.CompletedProcess(command, 1, stdout="", stderr=NOT_FOUND)
+        stdout = "operation-1\n" if "--async" in command else ""
+        return subprocess.CompletedProcess(command, 0, stdout=stdout, stderr="")
+
+    monkeypatch.setattr(gcp, "backend", "gcloud")
+    monkeypatch.setattr(gcp.tracing, "run", run)
+    monkeypatch.setattr(destroy_instance.gcp_cache, "enabled", False)
+    return calls
+
+def test_async_delete_waits_for_its_operation(gcloud_calls):
+    assert gcp.delete_instance("app-example-com", "us-west1-a", "demo-project") is None
+    assert gcloud_calls == [
+        ["gcloud", "compute", "instances", "delete", "app-example-com", "--zone", "us-west1-a", "--project", "demo-project", "--quiet", "--async", "--format=value(name)"],
+        ["gcloud", "compute", "operations", "wait", "operation-1", "--zone", "us-west1-a", "--project", "demo-project"],
+    ]
+
+def test_firewall_rule_delete_blocks(gcloud_calls):
+    assert gcp.delete_firewall_rule("http-ingress", "demo-project") is None
+    assert gcloud_calls == [["gcloud", "compute", "firewall-rules", "delete", "http-ingress", "--project", "demo-project", "--quiet"]]
+
+def test_destroy_releases_the_ip_of_a_host_without_an_instance(gcloud_calls):
+    gcloud_calls.missing.add("app-example-com")
+    assert destroy_instance.destroy([{"app_hostname": "app.example.com", "region": "us-west1"}], "demo-project")
+    deleted = {tuple(command[1:4]) for command in gcloud_calls if "delete" in command}
+    assert deleted == {("compute", "instances", "delete"), ("compute", "addresses", "delete"), ("compute", "firewall-rules", "delete")}
+
+def test_failed_instance_delete_keeps_its_ip(gcloud_calls, monkeypatch):
+    def run(command, **kwargs):
+        gcloud_calls.append(command)
+        failed = "instances" in command
+        return subprocess.CompletedProcess(command, 1 if failed else 0, stdout="", stderr="ERROR: PERMISSION_DENIED\n" if failed else "")
+    monkeypatch.setattr(gcp.tracing, "run", run)
+    assert not destroy_instance.destroy([{"app_hostname": "app.example.com", "region": "us-west1"}], "demo-project")
+    assert not any("addresses" in command for command in gcloud_calls)
@@ -0,0 +1,66 @@
+import pytest
+import gcp_cache
+
+# An empty, enabled cache in tmp_path with a clock the test moves by hand
+@pytest.fixture
+def clock(tmp_path, monkeypatch):
+    now = [1_000_000.0]
+    monkeypatch.setattr(gcp_cache, "CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(gcp_cache, "enabled", True)
+    monkeypatch.setattr(gcp_cache.time, "time", lambda: now[0])
+    return now
+
+def test_entries_expire_after_their_kinds_ttl(clock):
+    gcp_cache.put("demo-project", "address:us-west1:app-example-com", ["203.0.113.10", "app-example-com"])
+    gcp_cache.put("demo-project", "service_accounts", ["1234-compute@developer.gserviceaccount.com"])
+    gcp_cache.put("demo-project", "firewall_rules", ["http-ingress"])
+    clock[0] += 60 * 60 + 1
+    assert gcp_cache.get("demo-project", "firewall_rules") is None
+    assert gcp_cache.get("demo-project", "service_accounts") == ["1234-compute@developer.gserviceaccount.com"]
+    clock[0] += 24 * 60 * 60
+    assert gcp_cache.get("demo-project", "service_accounts") is None
+    assert gcp_cache.get("demo-project", "address:us-west1:app-example-com") == ["203.0.113.10", "app-example-com"]
+    clock[0] += 7 * 24 * 60 * 60
+    assert gcp_cache.get("demo-project", "address:us-west1:app-example-com") is None
+
+def test_explicit_ttl_overrides_the_default(clock):
+    gcp_cache.put("demo-project", "project_id:default:0", "demo-project", ttl=10)
+    clock[0] += 9
+    assert gcp_cache.get("demo-project", "project_id:default:0") == "demo-project"
+    clock[0] += 2
+    assert gcp_cache.get("demo-project", "project_id:default:0") is None
+
+def test_cached_fetches_again_after_expiry_and_never_caches_none(clock):
+    calls = []
+    def fetch(value):
+        calls.append(value)
+        return value
+    assert gcp_cache.cached("demo-project", "zones", lambda: fetch(None)) is None
+    assert gcp_cache.cached("demo-project", "zones", lambda: fetch(["us-west1-a"])) == ["us-west1-a"]
+    assert gcp_cache.cached("demo-project", "zones", lambda: fetch(["us-west1-b"])) == ["us-west1-a"]
+    clock[0] += 60 * 60 + 1
+    assert gcp_cache.cached("demo-project", "zones", lambda: fetch(["us-west1-b"])) == ["us-west1-b"]
+    assert calls == [None, ["us-west1-a"], ["us-west1-b"]]
+
+def test_invalidate_a_key_a_prefix_or_a_project(clock):
+    for key in ("address:us-west1:a", "address:us-west1:b", "service_accounts"):
+        gcp_cache.put("demo-project", key, key)
+    gcp_cache.put("other-project", "service_accounts", "other")
+
+    gcp_cache.invalidate("demo-project", key="address:us-west1:a")
+    assert gcp_cache.get("demo-project", "address:us-west1:a") is None
+    assert gcp_cache.get("demo-project", "address:us-west1:b") == "address:us-west1:b"
+
+    gcp_cache.invalidate("demo-project", prefix="address:")
+    assert gcp_cache.get("demo-project", "address:us-west1:b") is None
+    assert gcp_cache.get("demo-project", "service_accounts") == "service_accounts"
+
+    gcp_cache.invalidate("demo-project")
+    assert gcp_cache.get("demo-project", "service_accounts") is None
+    assert gcp_cache.get("other-project", "service_accounts") == "other"
+
+def test_disabled_cache_stores_nothing(clock, monkeypatch):
+    monkeypatch.setattr(gcp_cache, "enabled", False)
+    gcp_cache.put("demo-project", "service_accounts", ["x"])
+    monkeypatch.setattr(gcp_cache, "enabled", True)
+    assert gcp_cache.get("demo-project", "service_accounts") is None
@@ -0,0 +1,61 @@
+import json
+import pytest
+import destroy_instance
+import gcp
+import gcp_cache
+import gcp_rest
+from bench import gcp_stub
+
+pytest.importorskip("google.auth")
+
+# Point the REST backend at a fresh fake API (bench/gcp_stub.py) with the gcloud cache off, so every lookup reaches it
+@pytest.fixture
+def fake_api(tmp_path, monkeypatch):
+    server, url = gcp_stub.start()
+    monkeypatch.setenv("GOOGLE_CLOUD_PROJECT", "demo-project")
+    monkeypatch.setattr(gcp_rest, "API_ENDPOINT", url)
+    monkeypatch.setattr(gcp_rest, "COMPUTE_URL", f"{url}/compute/v1")
+    monkeypatch.setattr(gcp_rest, "IAM_URL", f"{url}/v1")
+    monkeypatch.setattr(gcp_rest, "session", None)
+    monkeypatch.setattr(gcp_rest, "project_id", None)
+    monkeypatch.setattr(gcp, "backend", "gcloud")
+    monkeypatch.setattr(gcp_cache, "enabled", False)
+    assert gcp.use_backend("rest", str(tmp_path)) == "rest"
+    yield server.state
+    server.shutdown()
+
+def test_fetch_project_id_uses_rest_credentials(fake_api):
+    assert gcp.fetch_project_id() == "demo-project"
+
+def test_service_account_key_follows_pages(fake_api, tmp_path):
+    key_path = gcp.fetch_service_account_key("demo-project", str(tmp_path))
+    with open(key_path) as file:
+        assert json.load(file)["client_email"] == "1234-compute@developer.gserviceaccount.com"
+    assert [path for method, path in fake_api["calls"] if method == "GET"] == ["/v1/projects/demo-project/serviceAccounts"] * 2
+
+def test_check_static_ip_creates_missing_address_once(fake_api):
+    assert gcp.check_static_ip("app.example.com", "us-west1", "demo-project") == (gcp_stub.FAKE_IP, "app-example-com")
+    assert fake_api["addresses"][("demo-project", "us-west1", "app-example-com")]["networkTier"] == "STANDARD"
+    calls = len(fake_api["calls"])
+    assert gcp.check_static_ip("app.example.com", "us-west1", "demo-project") == (gcp_stub.FAKE_IP, "app-example-com")
+    assert fake_api["calls"][calls:] == [("GET", "/compute/v1/projects/demo-project/regions/us-west1/addresses/app-example-com")]
+
+def test_deletes_wait_for_their_operations(fake_api):
+    gcp.check_static_ip("app.example.com", "us-west1", "demo-project")
+    assert gcp.delete_instance("app-example-com", "us-west1-a", "demo-project") is None
+    assert gcp.delete_static_ip("app-example-com", "us-west1", "demo-project") is None
+    assert gcp.delete_disk("app-example-com-data", "us-west1-a", "demo-project") is None
+    assert gcp.delete_firewall_rule("http-ingress", "demo-project") is None
+    assert not fake_api["addresses"]
+    assert all(operation["status"] == "DONE" for operation in fake_api["operations"].values())
+    assert len(fake_api["operations"]) == 5
+
+def test_delete_of_missing_resource_succeeds(fake_api):
+    assert gcp.delete_instance("app-example-com", "us-west1-a", "demo-project") is None
+    assert gcp.delete_instance("app-example-com", "us-west1-a", "demo-project") is None
+
+def test_destroy_releases_the_ip_of_a_host_without_an_instance(fake_api):
+    gcp.check_static_ip("app.example.com", "us-west1", "demo-project")
+    fake_api["deleted"].add(("instances", ("demo-project", "us-west1-a", "app-example-com")))
+    assert destroy_instance.destroy([{"app_hostname": "app.example.com", "region": "us-west1"}], "demo-project")
+    assert not fake_api["addresses"]
@@ -0,0 +1,9 @@
+import pytest
+import provisioning
+
+def test_tuning_profile_defaults_to_balanced():
+    assert provisioning.tuning_profile(None) is provisioning.TUNING_PROFILES[provisioning.DEFAULT_TUNING_PROFILE]
+
+def test_unknown_tuning_profile_raises_value_error():
+    with pytest.raises(ValueError, match='Unknown tuning_profile "fast". Choose one of: '):
+        provisioning.tuning_daemon_config("fast")
@@ -0,0 +1,158 @@
+import os
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+import readiness
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# `docker compose ps --all --format json` from Compose v2.21 and later: one object per container and line
+PS_LINES = """{"Command":"\\"/docker-entrypoint.…\\"","CreatedAt":"2024-05-02 09:14:03 +0000 UTC","ExitCode":0,"Health":"healthy","ID":"5b1e0c6f7a2d","Image":"nginx:latest","Labels":"com.docker.compose.project=opt,com.docker.compose.service=web","LocalVolumes":"0","Mounts":"","Name":"opt-web-1","Names":"opt-web-1","Networks":"opt_default","Ports":"0.0.0.0:8080->80/tcp","Project":"opt","Publishers":[{"URL":"0.0.0.0","TargetPort":80,"PublishedPort":8080,"Protocol":"tcp"}],"RunningFor":"2 minutes ago","Service":"web","Size":"0B","State":"running","Status":"Up 2 minutes (healthy)"}
+{"Command":"\\"/bin/sh -c 'migrate'\\"","CreatedAt":"2024-05-02 09:14:03 +0000 UTC","ExitCode":0,"Health":"","ID":"9c4d2a1b8e3f","Image":"app:latest","Labels":"com.docker.compose.project=opt,com.docker.compose.service=migrate","LocalVolumes":"0","Mounts":"","Name":"opt-migrate-1","Names":"opt-migrate-1","Networks":"opt_default","Ports":"","Project":"opt","Publishers":null,"RunningFor":"2 minutes ago","Service":"migrate","Size":"0B","State":"exited","Status":"Exited (0) About a minute ago"}
+"""
+
+# The same containers from Compose v2.20 and earlier, which print one JSON array
+PS_ARRAY = """[{"ID":"5b1e0c6f7a2d","Name":"opt-web-1","Image":"nginx:latest","Command":"/docker-entrypoint.sh nginx -g 'daemon off;'","Project":"opt","Service":"web","Created":1714641243,"State":"running","Status":"Up 2 minutes (health: starting)","Health":"starting","ExitCode":0,"Publishers":[{"URL":"0.0.0.0","TargetPort":80,"PublishedPort":8080,"Protocol":"tcp"}]},{"ID":"9c4d2a1b8e3f","Name":"opt-migrate-1","Image":"app:latest","Command":"/bin/sh -c 'migrate'","Project":"opt","Service":"migrate","Created":1714641243,"State":"exited","Status":"Exited (0) About a minute ago","Health":"","ExitCode":0,"Publishers":[]}]
+"""
+
+# Shell whose every command prints output
+class FakeShell:
+    def __init__(self, output):
+        self.output = output
+
+    def run(self, command):
+        return readiness.subprocess.CompletedProcess(command, 0, self.output, "")
+
+# Serve `status` for every GET on a local port and return the server's URL
+@pytest.fixture
+def http_server():
+    servers = []
+
+    def start(status):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return f"http://127.0.0.1:{server.server_address[1]}/"
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+# A port nothing listens on
+@pytest.fixture
+def closed_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+# A listening socket that never accepts, with its one-connection backlog already taken, so further connections hang
+@pytest.fixture
+def full_listener():
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(0)
+    port = listener.getsockname()[1]
+    waiting = socket.create_connection(("127.0.0.1", port))
+    yield port
+    waiting.close()
+    listener.close()
+
+# bench/fake_tool.py linked in as ssh and put first on PATH
+@pytest.fixture
+def fake_ssh(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    os.symlink(os.path.join(REPO_DIR, "bench", "fake_tool.py"), bin_dir / "ssh")
+    monkeypatch.setenv("PATH", str(bin_dir) + os.pathsep + os.environ.get("PATH", ""))
+    monkeypatch.delenv("BENCH_SSH_FAILS", raising=False)
+    monkeypatch.delenv("BENCH_LATENCY_SSH", raising=False)
+    monkeypatch.delenv("BENCH_TOOL_LOG", raising=False)
+    return readiness.RemoteShell("203.0.113.10", "ubuntu", str(tmp_path / "key"), str(tmp_path))
+
+@pytest.mark.parametrize("status, ready", [(200, True), (404, True), (502, False), (530, False)])
+def test_http_probe_status(http_server, status, ready):
+    assert readiness.http_probe(http_server(status))() == (ready, f"HTTP {status}")
+
+def test_http_probe_refused(closed_port):
+    ready, detail = readiness.http_probe(f"http://127.0.0.1:{closed_port}/")()
+    assert not ready
+    assert "refused" in detail.lower()
+
+def test_http_probe_timeout(full_listener, monkeypatch):
+    monkeypatch.setattr(readiness, "HTTP_TIMEOUT", 0.2)
+    start = time.monotonic()
+    ready, detail = readiness.http_probe(f"http://127.0.0.1:{full_listener}/")()
+    assert not ready
+    assert "timed out" in detail
+    assert time.monotonic() - start < 2
+
+def test_tcp_probe_open(http_server):
+    port = int(http_server(200).rsplit(":", 1)[1].strip("/"))
+    assert readiness.tcp_probe("127.0.0.1", port)() == (True, f"port {port} open")
+
+def test_tcp_probe_refused(closed_port):
+    ready, detail = readiness.tcp_probe("127.0.0.1", closed_port)()
+    assert not ready
+    assert "refused" in detail.lower()
+
+def test_tcp_probe_timeout(full_listener, monkeypatch):
+    monkeypatch.setattr(readiness, "CONNECT_TIMEOUT", 0.2)
+    start = time.monotonic()
+    ready, detail = readiness.tcp_probe("127.0.0.1", full_listener)()
+    assert not ready
+    assert "timed out" in detail
+    assert time.monotonic() - start < 2
+
+@pytest.mark.parametrize("output", [PS_LINES, PS_ARRAY])
+def test_parse_compose_ps(output):
+    containers = readiness.parse_compose_ps(output)
+    assert [(container["Service"], container["State"]) for container in containers] == [("web", "running"), ("migrate", "exited")]
+
+def test_parse_compose_ps_without_containers():
+    assert readiness.parse_compose_ps("") == []
+    assert readiness.parse_compose_ps("[]\n") == []
+
+def test_service_probe_reads_both_formats():
+    assert readiness.service_probe(FakeShell(PS_LINES), "web")() == (True, "running")
+    assert readiness.service_probe(FakeShell(PS_ARRAY), "web")() == (False, "opt-web-1 is starting")
+
+def test_poll_passes_once_ssh_answers(fake_ssh):
+    assert readiness.poll(readiness.ssh_probe(fake_ssh), time.monotonic() + 5, initial_delay=0.05) == (True, 1, "ssh ok")
+
+def test_poll_gives_up_at_the_deadline(fake_ssh, monkeypatch):
+    monkeypatch.setenv("BENCH_SSH_FAILS", "1")
+    start = time.monotonic()
+    ready, attempts, detail = readiness.poll(readiness.ssh_probe(fake_ssh), start + 1.0, initial_delay=0.1, max_delay=0.2)
+    elapsed = time.monotonic() - start
+    assert not ready
+    assert "Connection refused" in detail
+    assert attempts >= 3
+    assert 1.0 <= elapsed < 2.0
+
+def test_poll_stops_after_an_attempt_that_overruns_the_deadline(fake_ssh, monkeypatch):
+    monkeypatch.setenv("BENCH_LATENCY_SSH", "1")
+    monkeypatch.setattr(readiness, "ATTEMPT_TIMEOUT", 0.3)
+    start = time.monotonic()
+    ready, attempts, detail = readiness.poll(readiness.ssh_probe(fake_ssh), start + 0.2)
+    assert (ready, attempts, detail) == (False, 1, "timed out after 0.3s")
+    assert time.monotonic() - start < 1.0
+
+def test_probes_are_traced(http_server, closed_port):
+    readiness.http_probe(http_server(502))()
+    readiness.tcp_probe("127.0.0.1", closed_port)()
+    http_span, tcp_span = readiness.tracing.finished_spans()[-2:]
+    assert (http_span["category"], http_span["attributes"]["status"]) == ("http", 502)
+    assert (tcp_span["name"], tcp_span["category"]) == (f"connect 127.0.0.1:{closed_port}", "tcp")
+    assert "refused" in tcp_span["attributes"]["error"].lower()
@@ -0,0 +1,145 @@
+import base64
+import io
+import os
+import re
+import subprocess
+import sys
+import tarfile
+import time
+import pytest
+import setup
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+COMPOSE_FILE = """services:
+  web:
+    image: nginx:latest
+    ports:
+      - "8080:80"
+"""
+
+# Render a host offline: the preflight results gcloud would provide are filled in by hand and the compose file is
+# supplied, so neither gcloud nor OpenAI is called
+@pytest.fixture
+def render_host(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "docker-compose.yml").write_text(COMPOSE_FILE)
+
+    def render(**variables):
+        host = setup.Host({
+            "app_hostname": "app.example.com",
+            "region": "us-west1",
+            "os_type": "ubuntu-os-cloud/ubuntu-2204-lts",
+            "compose_file_path": "docker-compose.yml",
+            "ssh_private_key_path": "/home/demo/.ssh/id_ed25519",
+            "terraform_init": "on-deploy",
+            **variables,
+        })
+        host.project_id = "demo-project"
+        host.static_ip = "203.0.113.7"
+        host.formatted_hostname = "app-example-com"
+        host.credentials_filename = "service-account-key.json"
+        host.ssh_user = "demo"
+        host.ssh_public_key = "ssh-ed25519 AAAAC3Nza demo"
+        (tmp_path / host.app_dir).mkdir(exist_ok=True)
+        setup.render(host)
+        return host, lambda file_name: (tmp_path / host.app_dir / file_name).read_text()
+
+    return render
+
+# Text of the Terraform block starting with header
+def block(config, header):
+    start = config.index(header)
+    return setup.tf_runner.terraform_block(config, start)
+
+def test_startup_script_mode_updates_metadata_in_place(render_host):
+    host, read = render_host(provision_mode="startup-script")
+    config = read("setup.tf")
+    instance = block(config, 'resource "google_compute_instance" "app-example-com"')
+
+    # metadata_startup_script would force a new instance whenever the script changes
+    assert "metadata_startup_script" not in config
+    assert '"startup-script" = file("startup.sh")' in block(instance, "metadata = {")
+    assert '"ssh-keys" = "demo:ssh-ed25519 AAAAC3Nza demo"' in instance
+    assert 'resource "terraform_data" "artifacts"' not in config
+    assert "provisioner" not in config
+
+def test_startup_script_installs_bundle_keyed_on_its_hash(render_host):
+    host, read = render_host(provision_mode="startup-script")
+    script = read("startup.sh")
+
+    bundle = base64.b64decode(re.search(r"<<'BUNDLE'[^\n]*\n(.*?)\nBUNDLE\n", script, re.S)[1])
+    assert f"artifacts_hash={setup.content_sha256(bundle)}" in script
+    assert 'echo "$artifacts_hash" > "$marker"' in script
+    with tarfile.open(fileobj=io.BytesIO(bundle), mode="r:gz") as tar:
+        members = {member.name: member for member in tar.getmembers()}
+    assert set(members) == {"opt/setup_server.sh", "opt/setup_cloudflare.sh", "etc/systemd/system/docker-compose.service", "opt/updater.sh", "opt/docker-compose.yml"}
+    assert members["opt/setup_server.sh"].mode == 0o755
+    assert members["opt/docker-compose.yml"].uid == 0
+    assert "bash /opt/setup_server.sh" in script
+    assert "cloudflared service install" not in script
+
+def test_startup_script_hash_changes_with_the_artifacts(render_host):
+    _, read = render_host(provision_mode="startup-script")
+    first = re.search(r"artifacts_hash=(\w+)", read("startup.sh"))[1]
+    _, read = render_host(provision_mode="startup-script", pull_concurrency="8")
+    second = re.search(r"artifacts_hash=(\w+)", read("startup.sh"))[1]
+    assert first != second
+
+def test_startup_script_starts_token_tunnel(render_host):
+    _, read = render_host(provision_mode="startup-script", cloudflare_tunnel_token="token123")
+    assert "cloudflared service install token123" in read("startup.sh")
+
+def test_ssh_mode_uploads_artifacts_from_separate_resource(render_host):
+    _, read = render_host(upload_mode="bundle")
+    config = read("setup.tf")
+    artifacts = block(config, 'resource "terraform_data" "artifacts"')
+
+    assert "startup-script" not in config
+    assert "google_compute_instance.app-example-com.id," in artifacts
+    assert 'filesha256("cloudtailor-bundle.tar.gz")' in artifacts
+    assert 'source      = "cloudtailor-bundle.tar.gz"' in artifacts
+    assert "sudo tar -xzpf /tmp/cloudtailor-bundle.tar.gz" in artifacts
+
+def test_data_root_only_set_once_the_data_disk_is_mounted(render_host):
+    _, read = render_host(data_disk_size="30")
+    script = read("setup_server.sh")
+    config = read("setup.tf")
+
+    assert 'resource "google_compute_disk" "data"' in config
+    assert "x-systemd.before=docker.service" in script
+    assert "RequiresMountsFor=/mnt/data" in script
+    default_config, mounted_config = re.findall(r"daemon_config='(\{.*?\})'", script)
+    assert "data-root" not in default_config
+    assert '"data-root": "/mnt/data/docker"' in mounted_config
+    assert script.index("data_disk_mounted=yes") < script.index('if [ "$data_disk_mounted" = yes ]')
+
+def test_no_data_disk_leaves_data_root_alone(render_host):
+    _, read = render_host()
+    script = read("setup_server.sh")
+    assert "data-root" not in script
+    assert "data_disk_mounted" not in script
+
+# A render that exits while terraform init is still running in the background must not wait for it
+def test_exit_does_not_wait_for_background_init(tmp_path):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    os.symlink(os.path.join(REPO_DIR, "bench", "fake_tool.py"), bin_dir / "terraform")
+    env = {**os.environ, "PATH": str(bin_dir) + os.pathsep + os.environ.get("PATH", ""), "TF_PLUGIN_CACHE_DIR": str(tmp_path / "plugins"), "BENCH_LATENCY_TERRAFORM_PROVIDER": "10"}
+    env.pop("BENCH_TOOL_LOG", None)
+    script = f"""
+import sys
+sys.path.insert(0, {REPO_DIR!r})
+import setup
+host = setup.Host({{"app_hostname": "app.example.com", "region": "us-west1", "trace": "off"}})
+host.project_id = "demo-project"
+host.credentials_filename = "service-account-key.json"
+setup.os.makedirs(host.app_dir)
+setup.start_background_init(host)
+assert host.init_thread.is_alive()
+sys.exit(1)
+"""
+    start = time.monotonic()
+    result = subprocess.run([sys.executable, "-c", script], cwd=tmp_path, env=env, capture_output=True, text=True, timeout=30)
+    assert result.returncode == 1, result.stderr
+    assert time.monotonic() - start < 5
@@ -0,0 +1,46 @@
+import yaml
+import sizing
+
+COMPOSE_FILE = """# Comments, anchors and quoting survive
+x-restart: &restart unless-stopped
+services:
+  web:   # the proxy
+    image: nginx:latest
+    restart: *restart
+    ports:
+      - "22:22"
+      - "8080:80"
+  "db":
+    image: postgres:16
+    mem_limit: 1g
+  cache: &cache
+    image: redis:alpine
+    cpus: 0.5
+volumes:
+  data:
+"""
+
+def sized(compose_yaml, server_type="e2-medium"):
+    compose_data = yaml.safe_load(compose_yaml)
+    return sizing.apply_limits(compose_yaml, compose_data, sizing.plan(compose_data, server_type))
+
+def test_apply_limits_only_inserts_lines():
+    result = sized(COMPOSE_FILE)
+    added = [line for line in result.splitlines() if line not in COMPOSE_FILE.splitlines()]
+    assert added == ["    mem_limit: 108m", "    cpus: 1.33", "    cpus: 1.33", "    mem_limit: 216m"]
+    assert '      - "22:22"' in result
+    services = yaml.safe_load(result)["services"]
+    assert services["db"] == {"image": "postgres:16", "mem_limit": "1g", "cpus": 1.33}
+    assert services["cache"]["cpus"] == 0.5
+
+def test_apply_limits_gives_up_on_flow_style_services():
+    assert sized("services:\n  web: {image: nginx:latest}\n") is None
+
+def test_scaled_limits_are_capped():
+    compose_data = {"services": {"web": {"image": "nginx:latest"}}}
+    assert sizing.plan(compose_data, "e2-standard-4")["services"]["web"]["memory_mb"] == 32 + sizing.LIMIT_HEADROOM_MB
+
+def test_is_arm():
+    assert sizing.is_arm("cos-cloud/cos-arm64-109-lts")
+    assert sizing.is_arm("ubuntu-2204-lts-arm64")
+    assert not sizing.is_arm("ubuntu-os-cloud/ubuntu-2204-lts")
@@ -0,0 +1,59 @@
+import threading
+import time
+import pytest
+from task_graph import run_task_graph
+
+def test_tasks_run_after_their_dependencies_with_their_results():
+    order = []
+
+    def task(name, value):
+        def run(**results):
+            order.append(name)
+            return value + sum(results.values())
+        return run
+
+    results, durations, _ = run_task_graph({
+        "deploy": (task("deploy", 100), ["render", "static_ip"]),
+        "render": (task("render", 10), ["project_id"]),
+        "static_ip": (task("static_ip", 20), ["project_id"]),
+        "project_id": (task("project_id", 1), []),
+    })
+    assert results == {"project_id": 1, "render": 11, "static_ip": 21, "deploy": 132}
+    assert order[0] == "project_id" and order[-1] == "deploy"
+    assert set(durations) == set(results)
+
+def test_independent_tasks_run_concurrently():
+    barrier = threading.Barrier(3, timeout=5)
+    results, _, wall_time = run_task_graph({name: (barrier.wait, []) for name in ("a", "b", "c")})
+    assert sorted(results.values()) == [0, 1, 2]
+    assert wall_time < 5
+
+def test_a_failed_task_raises_and_its_dependents_do_not_run():
+    ran = []
+
+    def fail():
+        time.sleep(0.05)
+        raise RuntimeError("gcloud failed")
+
+    with pytest.raises(RuntimeError, match="gcloud failed"):
+        run_task_graph({
+            "static_ip": (fail, []),
+            "render": (lambda static_ip: ran.append("render"), ["static_ip"]),
+            "project_id": (lambda: ran.append("project_id"), []),
+        })
+    assert ran == ["project_id"]
+
+@pytest.mark.parametrize("tasks", [
+    {"a": (lambda b: b, ["b"]), "b": (lambda a: a, ["a"])},
+    {"a": (lambda a: a, ["a"])},
+    {"a": (lambda missing: missing, ["missing"])},
+])
+def test_cycles_and_missing_dependencies_are_rejected(tasks):
+    with pytest.raises(ValueError, match="Unresolvable task dependencies: a"):
+        run_task_graph(tasks)
+
+def test_tasks_after_a_cycle_is_found_are_not_started():
+    ran = []
+    with pytest.raises(ValueError, match="Unresolvable task dependencies: b, c"):
+        run_task_graph({"a": (lambda: ran.append("a"), []), "b": (lambda c: c, ["c"]), "c": (lambda b: b, ["b"])})
+    assert ran == ["a"]
@@ -0,0 +1,144 @@
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+import tf_runner
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# `terraform apply -json tfplan` output recorded from a deploy that succeeded
+APPLY_OK = """{"@level":"info","@message":"Terraform 1.7.5","@module":"terraform.ui","@timestamp":"2024-05-02T09:20:01.120348Z","terraform":"1.7.5","type":"version","ui":"1.2"}
+{"@level":"info","@message":"google_compute_firewall.http-ingress: Plan to create","@module":"terraform.ui","@timestamp":"2024-05-02T09:20:01.511204Z","change":{"resource":{"addr":"google_compute_firewall.http-ingress","module":"","resource":"google_compute_firewall.http-ingress","implied_provider":"google","resource_type":"google_compute_firewall","resource_name":"http-ingress","resource_key":null},"action":"create"},"type":"planned_change"}
+{"@level":"info","@message":"google_compute_firewall.http-ingress: Creating...","@module":"terraform.ui","@timestamp":"2024-05-02T09:20:02.002117Z","hook":{"resource":{"addr":"google_compute_firewall.http-ingress","module":"","resource":"google_compute_firewall.http-ingress","implied_provider":"google","resource_type":"google_compute_firewall","resource_name":"http-ingress","resource_key":null},"action":"create"},"type":"apply_start"}
+{"@level":"info","@message":"google_compute_instance.vm: Creating...","@module":"terraform.ui","@timestamp":"2024-05-02T09:20:02.003481Z","hook":{"resource":{"addr":"google_compute_instance.vm","module":"","resource":"google_compute_instance.vm","implied_provider":"google","resource_type":"google_compute_instance","resource_name":"vm","resource_key":null},"action":"create"},"type":"apply_start"}
+{"@level":"info","@message":"google_compute_firewall.http-ingress: Creation complete after 12s [id=projects/demo-project/global/firewalls/http-ingress]","@module":"terraform.ui","@timestamp":"2024-05-02T09:20:14.221930Z","hook":{"resource":{"addr":"google_compute_firewall.http-ingress","module":"","resource":"google_compute_firewall.http-ingress","implied_provider":"google","resource_type":"google_compute_firewall","resource_name":"http-ingress","resource_key":null},"action":"create","id_key":"id","id_value":"projects/demo-project/global/firewalls/http-ingress","elapsed_seconds":12},"type":"apply_complete"}
+{"@level":"info","@message":"google_compute_instance.vm: Creation complete after 24s [id=projects/demo-project/zones/us-west1-a/instances/app-example-com]","@module":"terraform.ui","@timestamp":"2024-05-02T09:20:26.402775Z","hook":{"resource":{"addr":"google_compute_instance.vm","module":"","resource":"google_compute_instance.vm","implied_provider":"google","resource_type":"google_compute_instance","resource_name":"vm","resource_key":null},"action":"create","id_key":"id","id_value":"projects/demo-project/zones/us-west1-a/instances/app-example-com","elapsed_seconds":24},"type":"apply_complete"}
+{"@level":"info","@message":"Apply complete! Resources: 2 added, 0 changed, 0 destroyed.","@module":"terraform.ui","@timestamp":"2024-05-02T09:20:26.431066Z","changes":{"add":2,"change":0,"import":0,"remove":0,"operation":"apply"},"type":"change_summary"}
+{"@level":"info","@message":"Outputs: 1","@module":"terraform.ui","@timestamp":"2024-05-02T09:20:26.431102Z","outputs":{"instance_ip":{"sensitive":false,"type":"string","value":"203.0.113.10"}},"type":"outputs"}
+"""
+
+# The same deploy failing on the instance, with a provider message that is not a JSON event
+APPLY_FAILED = """{"@level":"info","@message":"Terraform 1.7.5","@module":"terraform.ui","@timestamp":"2024-05-02T09:30:01.120348Z","terraform":"1.7.5","type":"version","ui":"1.2"}
+{"@level":"info","@message":"google_compute_firewall.http-ingress: Creating...","@module":"terraform.ui","@timestamp":"2024-05-02T09:30:02.002117Z","hook":{"resource":{"addr":"google_compute_firewall.http-ingress","module":"","resource":"google_compute_firewall.http-ingress","implied_provider":"google","resource_type":"google_compute_firewall","resource_name":"http-ingress","resource_key":null},"action":"create"},"type":"apply_start"}
+{"@level":"info","@message":"google_compute_instance.vm: Creating...","@module":"terraform.ui","@timestamp":"2024-05-02T09:30:02.003481Z","hook":{"resource":{"addr":"google_compute_instance.vm","module":"","resource":"google_compute_instance.vm","implied_provider":"google","resource_type":"google_compute_instance","resource_name":"vm","resource_key":null},"action":"create"},"type":"apply_start"}
+{"@level":"info","@message":"google_compute_firewall.http-ingress: Creation complete after 11s [id=projects/demo-project/global/firewalls/http-ingress]","@module":"terraform.ui","@timestamp":"2024-05-02T09:30:13.221930Z","hook":{"resource":{"addr":"google_compute_firewall.http-ingress","module":"","resource":"google_compute_firewall.http-ingress","implied_provider":"google","resource_type":"google_compute_firewall","resource_name":"http-ingress","resource_key":null},"action":"create","id_key":"id","id_value":"projects/demo-project/global/firewalls/http-ingress","elapsed_seconds":11},"type":"apply_complete"}
+{"@level":"info","@message":"google_compute_instance.vm: Creation errored after 3s","@module":"terraform.ui","@timestamp":"2024-05-02T09:30:05.118204Z","hook":{"resource":{"addr":"google_compute_instance.vm","module":"","resource":"google_compute_instance.vm","implied_provider":"google","resource_type":"google_compute_instance","resource_name":"vm","resource_key":null},"action":"create","elapsed_seconds":3},"type":"apply_errored"}
+2024/05/02 09:30:05 [WARN] Provider "registry.terraform.io/hashicorp/google" produced an unexpected new value
+{"@level":"error","@message":"Error: Error creating instance: googleapi: Error 403: Quota 'CPUS' exceeded.  Limit: 8.0 in region us-west1., quotaExceeded","@module":"terraform.ui","@timestamp":"2024-05-02T09:30:05.120991Z","diagnostic":{"severity":"error","summary":"Error creating instance: googleapi: Error 403: Quota 'CPUS' exceeded.  Limit: 8.0 in region us-west1., quotaExceeded","detail":"","address":"google_compute_instance.vm","range":{"filename":"setup.tf","start":{"line":40,"column":39,"byte":1203},"end":{"line":40,"column":40,"byte":1204}},"snippet":{"context":"resource \\"google_compute_instance\\" \\"vm\\"","code":"resource \\"google_compute_instance\\" \\"vm\\" {","start_line":40,"highlight_start_offset":38,"highlight_end_offset":39,"values":[]}},"type":"diagnostic"}
+"""
+
+# Run stream_apply in an app_dir with a saved plan, against bench/fake_tool.py as terraform replaying `recording`.
+# Returns (exit code, timings, events passed to on_event).
+@pytest.fixture
+def replay_apply(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    os.symlink(os.path.join(REPO_DIR, "bench", "fake_tool.py"), bin_dir / "terraform")
+    monkeypatch.setenv("PATH", str(bin_dir) + os.pathsep + os.environ.get("PATH", ""))
+    monkeypatch.delenv("BENCH_TOOL_LOG", raising=False)
+    monkeypatch.delenv("BENCH_LATENCY_TERRAFORM", raising=False)
+
+    def replay(recording):
+        (tmp_path / "apply.jsonl").write_text(recording)
+        (tmp_path / tf_runner.PLAN_FILENAME).write_text("")
+        monkeypatch.setenv("BENCH_TERRAFORM_APPLY_EVENTS", str(tmp_path / "apply.jsonl"))
+        events = []
+        returncode, timings = tf_runner.stream_apply(str(tmp_path), on_event=events.append)
+        assert not (tmp_path / tf_runner.PLAN_FILENAME).exists()
+        return returncode, timings, events
+    return replay
+
+def test_stream_apply_passes_on_every_event(replay_apply):
+    returncode, _, events = replay_apply(APPLY_OK)
+    assert returncode == 0
+    assert [event["type"] for event in events] == ["version", "planned_change", "apply_start", "apply_start", "apply_complete", "apply_complete", "change_summary", "outputs"]
+    assert [message for message in map(tf_runner.event_message, events) if message] == [
+        "google_compute_firewall.http-ingress: Creating...",
+        "google_compute_instance.vm: Creating...",
+        "google_compute_firewall.http-ingress: Creation complete after 12s [id=projects/demo-project/global/firewalls/http-ingress]",
+        "google_compute_instance.vm: Creation complete after 24s [id=projects/demo-project/zones/us-west1-a/instances/app-example-com]",
+        "Apply complete! Resources: 2 added, 0 changed, 0 destroyed.",
+    ]
+
+def test_stream_apply_times_each_resource(replay_apply):
+    _, timings, _ = replay_apply(APPLY_OK)
+    assert timings == {"google_compute_firewall.http-ingress": 12, "google_compute_instance.vm": 24}
+
+def test_stream_apply_times_resources_without_elapsed_seconds(replay_apply):
+    recording = "".join(line.replace(',"elapsed_seconds":12', "") + "\n" for line in APPLY_OK.splitlines())
+    _, timings, _ = replay_apply(recording)
+    assert 0 <= timings["google_compute_firewall.http-ingress"] < 5
+
+def test_stream_apply_summarizes_errors_on_failure(replay_apply):
+    returncode, timings, events = replay_apply(APPLY_FAILED)
+    assert returncode == 1
+    assert timings == {"google_compute_firewall.http-ingress": 11, "google_compute_instance.vm": 3}
+    assert {"type": "text", "@message": '2024/05/02 09:30:05 [WARN] Provider "registry.terraform.io/hashicorp/google" produced an unexpected new value'} in events
+    assert events[-1]["type"] == "error_summary"
+    assert tf_runner.event_message(events[-1]) == (
+        "Terraform apply failed with exit code 1.\n"
+        "Failed resources: google_compute_instance.vm\n"
+        "  Error: Error creating instance: googleapi: Error 403: Quota 'CPUS' exceeded.  Limit: 8.0 in region us-west1., quotaExceeded (google_compute_instance.vm)"
+    )
+
+def test_stream_apply_does_not_summarize_success(replay_apply):
+    _, _, events = replay_apply(APPLY_OK)
+    assert not any(event["type"] == "error_summary" for event in events)
+
+# App directories declaring the google provider, with bench/fake_tool.py as terraform taking `download` seconds to
+# download a provider that is not in the plugin cache in tmp_path/plugins
+@pytest.fixture
+def app_dirs(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    os.symlink(os.path.join(REPO_DIR, "bench", "fake_tool.py"), bin_dir / "terraform")
+    monkeypatch.setenv("PATH", str(bin_dir) + os.pathsep + os.environ.get("PATH", ""))
+    monkeypatch.setenv("BENCH_LATENCY_TERRAFORM_PROVIDER", "1.0")
+    monkeypatch.setenv("BENCH_TOOL_LOG", str(tmp_path / "tools.jsonl"))
+    monkeypatch.delenv("BENCH_LATENCY_TERRAFORM", raising=False)
+    monkeypatch.setattr(tf_runner, "PLUGIN_CACHE_DIR", str(tmp_path / "plugins"))
+    monkeypatch.setattr(tf_runner, "plugin_cache_enabled", True)
+    monkeypatch.setattr(tf_runner.tracing, "enabled", False)
+    directories = []
+    for index in range(4):
+        app_dir = tmp_path / f"host-{index}"
+        app_dir.mkdir()
+        (app_dir / "setup.tf").write_text('provider "google" {\n  project = "demo-project"\n}\n')
+        directories.append(str(app_dir))
+    return directories
+
+# Seconds each terraform init took, from the fake tool's log
+def init_durations(app_dirs):
+    with open(os.path.join(os.path.dirname(app_dirs[0]), "tools.jsonl")) as file:
+        calls = [json.loads(line) for line in file]
+    return [call["end"] - call["start"] for call in calls if call["args"][:1] == ["init"]]
+
+def test_concurrent_inits_download_each_provider_once(app_dirs):
+    with ThreadPoolExecutor(max_workers=len(app_dirs)) as pool:
+        assert all(pool.map(tf_runner.init, app_dirs))
+    # One init downloads the provider while the rest wait for the lock, then install it from the cache
+    durations = init_durations(app_dirs)
+    assert len(durations) == len(app_dirs)
+    assert len([seconds for seconds in durations if seconds >= 1.0]) == 1
+    with open(os.path.join(tf_runner.PLUGIN_CACHE_DIR, tf_runner.LOCK_FILENAME)) as file:
+        shared_lock_file = file.read()
+    for app_dir in app_dirs:
+        with open(os.path.join(app_dir, tf_runner.LOCK_FILENAME)) as file:
+            assert file.read() == shared_lock_file
+
+def test_inits_after_the_cache_is_filled_hold_a_shared_lock(app_dirs, monkeypatch):
+    assert tf_runner.init(app_dirs[0])
+    monkeypatch.setattr(tf_runner.tracing, "enabled", True)
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=len(app_dirs)) as pool:
+        assert all(pool.map(tf_runner.init, app_dirs[1:]))
+    assert time.monotonic() - start < 1.0
+    assert all(seconds < 1.0 for seconds in init_durations(app_dirs)[1:])
+    waits = [span for span in tf_runner.tracing.finished_spans() if span["name"] == "wait for plugin cache" and span["start"] >= time.time() - 5]
+    assert len(waits) == 3 and all(span["attributes"]["shared"] for span in waits)
+
+def test_unchanged_app_dir_skips_init(app_dirs, capsys):
+    assert tf_runner.init(app_dirs[0])
+    assert tf_runner.init(app_dirs[0])
+    assert "skipping terraform init" in capsys.readouterr().out
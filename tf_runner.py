@@ -0,0 +1,212 @@
+import contextlib
+import fcntl
+import json
+import os
+import re
+import subprocess
+import time
+import tracing
+from manifest import content_sha256, load_manifest, save_manifest, write_file_atomic
+
+# Plan file written by plan and applied by stream_apply when the plan has changes
+PLAN_FILENAME = "tfplan"
+
+# Providers downloaded by terraform init are kept in Terraform's plugin cache in this directory (TF_PLUGIN_CACHE_DIR if
+# it is already set), which every app_dir shares, so each provider is downloaded once per machine instead of once per
+# host. Set plugin_cache_enabled to False to let each app_dir download its own.
+PLUGIN_CACHE_DIR = os.environ.get("TF_PLUGIN_CACHE_DIR") or os.path.join(os.path.expanduser("~"), ".cache", "cloudtailor", "terraform-plugins")
+plugin_cache_enabled = True
+
+# Dependency lock file Terraform writes to each app_dir. The first init that fills the cache also copies its lock
+# file into the cache directory; app_dirs without a lock file start from that copy, so they pin the same provider
+# versions and Terraform can verify the cached providers against its checksums without downloading them again.
+LOCK_FILENAME = ".terraform.lock.hcl"
+
+# Terraform does not guarantee the plugin cache is safe to fill from concurrent inits, so inits hold this file lock:
+# exclusively until the shared lock file exists (the cache is still being filled), shared after that
+CACHE_LOCK_FILENAME = ".cloudtailor.lock"
+
+# Fingerprint of everything `terraform init` depends on: provider and module declarations and any terraform block
+# (required_providers, backend). Provider arguments such as project or region do not affect init.
+def init_fingerprint(app_dir):
+    declarations = []
+    for file_name in sorted(os.listdir(app_dir)):
+        if not file_name.endswith(".tf"):
+            continue
+        with open(os.path.join(app_dir, file_name), "r") as file:
+            text = file.read()
+        declarations += re.findall(r'^\s*(?:provider|module)\s+"[^"]+"', text, re.MULTILINE)
+        declarations += [terraform_block(text, match.start()) for match in re.finditer(r"^terraform\s*\{", text, re.MULTILINE)]
+    if os.path.exists(os.path.join(app_dir, ".terraform.lock.hcl")):
+        with open(os.path.join(app_dir, ".terraform.lock.hcl"), "r") as file:
+            declarations.append(file.read())
+    return content_sha256("\n".join(declarations))
+
+# Text of the block starting at start, up to its matching closing brace
+def terraform_block(text, start):
+    depth = 0
+    for index in range(text.index("{", start), len(text)):
+        if text[index] == "{":
+            depth += 1
+        elif text[index] == "}":
+            depth -= 1
+            if depth == 0:
+                return text[start:index + 1]
+    return text[start:]
+
+# Hold the plugin cache's file lock (see CACHE_LOCK_FILENAME) while the block runs
+@contextlib.contextmanager
+def plugin_cache_lock():
+    os.makedirs(PLUGIN_CACHE_DIR, exist_ok=True)
+    shared_lock_file = os.path.join(PLUGIN_CACHE_DIR, LOCK_FILENAME)
+    shared = os.path.exists(shared_lock_file)
+    with open(os.path.join(PLUGIN_CACHE_DIR, CACHE_LOCK_FILENAME), "a") as lock_file:
+        with tracing.span("wait for plugin cache", "lock", shared=shared):
+            fcntl.flock(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        # Another init may have filled the cache while this one waited; let the inits after it run concurrently
+        if not shared and os.path.exists(shared_lock_file):
+            fcntl.flock(lock_file, fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+# Copy the lock file from source_dir to target_dir unless target_dir already has one
+def copy_lock_file(source_dir, target_dir):
+    source_path, target_path = os.path.join(source_dir, LOCK_FILENAME), os.path.join(target_dir, LOCK_FILENAME)
+    if os.path.exists(source_path) and not os.path.exists(target_path):
+        with open(source_path, "r") as file:
+            write_file_atomic(target_path, file.read())
+
+# Run terraform init unless the providers, modules and backend are unchanged since the last successful init, using
+# the shared plugin cache unless it is disabled. Extra keyword arguments are passed to subprocess.run.
+# Returns True on success.
+def init(app_dir, **run_kwargs):
+    if plugin_cache_enabled:
+        copy_lock_file(PLUGIN_CACHE_DIR, app_dir)
+    manifest = load_manifest(app_dir)
+    fingerprint = init_fingerprint(app_dir)
+    if os.path.isdir(os.path.join(app_dir, ".terraform")) and manifest.get("terraform_init") == fingerprint:
+        print("Terraform providers and backend are unchanged; skipping terraform init.")
+        return True
+
+    argv = ["terraform", "init", "-input=false"]
+    if plugin_cache_enabled:
+        with plugin_cache_lock():
+            copy_lock_file(PLUGIN_CACHE_DIR, app_dir)
+            result = tracing.run(argv, cwd=app_dir, env={**os.environ, "TF_PLUGIN_CACHE_DIR": PLUGIN_CACHE_DIR}, **run_kwargs)
+            if result.returncode == 0:
+                copy_lock_file(app_dir, PLUGIN_CACHE_DIR)
+    else:
+        result = tracing.run(argv, cwd=app_dir, **run_kwargs)
+    if result.returncode != 0:
+        return False
+
+    # init may have written the lock file, so fingerprint again before recording it
+    manifest = load_manifest(app_dir)
+    manifest["terraform_init"] = init_fingerprint(app_dir)
+    save_manifest(app_dir, manifest)
+    return True
+
+# Remove the saved plan so a stale plan is never applied by hand
+def remove_plan(app_dir):
+    plan_path = os.path.join(app_dir, PLAN_FILENAME)
+    if os.path.exists(plan_path):
+        os.remove(plan_path)
+
+# Run terraform plan and save it to PLAN_FILENAME. Returns "unchanged", "changes" or "failed", and the plan result.
+def plan(app_dir, **run_kwargs):
+    plan_result = tracing.run(["terraform", "plan", "-input=false", "-detailed-exitcode", f"-out={PLAN_FILENAME}"], cwd=app_dir, **run_kwargs)
+    if plan_result.returncode == 0:
+        print("Terraform plan has no changes; skipping terraform apply.")
+        remove_plan(app_dir)
+        return "unchanged", plan_result
+    return ("changes" if plan_result.returncode == 2 else "failed"), plan_result
+
+# Event types from Terraform's JSON UI that are not worth showing while applying
+QUIET_EVENTS = {"version", "planned_change", "resource_drift", "outputs"}
+
+# Human-readable text for a JSON UI event, or None for events that are not worth showing
+def event_message(event):
+    if event.get("type") in QUIET_EVENTS:
+        return None
+    if event.get("type") == "provision_progress":
+        return f"  {event['hook']['resource']['addr']}: {event['hook'].get('output', '')}"
+    message = event.get("@message", "")
+    diagnostic = event.get("diagnostic") or {}
+    if diagnostic.get("detail"):
+        message += f"\n  {diagnostic['detail']}"
+    return message
+
+# Default event handler for stream_apply: print each event's message as it arrives
+def print_event(event):
+    message = event_message(event)
+    if message is not None:
+        print(message, flush=True)
+
+# Event summarizing a failed apply: the resources that failed and every error diagnostic, which may have scrolled far
+# out of view by the time the apply ends
+def error_summary_event(returncode, failed_addresses, diagnostics):
+    lines = [f"Terraform apply failed with exit code {returncode}."]
+    if failed_addresses:
+        lines.append(f"Failed resources: {', '.join(failed_addresses)}")
+    for diagnostic in diagnostics:
+        lines.append(f"  Error: {diagnostic.get('summary', '')}" + (f" ({diagnostic['address']})" if diagnostic.get("address") else ""))
+    return {"@level": "error", "type": "error_summary", "@message": "\n".join(lines)}
+
+# Apply the saved plan with Terraform's machine-readable UI (-json), passing each event to on_event as soon as
+# Terraform writes it, followed by an error_summary event (see error_summary_event()) if Terraform fails.
+# Extra keyword arguments (e.g. stderr) are passed to subprocess.Popen.
+# Returns the exit code and a dict of resource address -> seconds taken to apply it.
+def stream_apply(app_dir, on_event=print_event, **popen_kwargs):
+    timings = {}
+    started = {}
+    failed_addresses = []
+    diagnostics = []
+    argv = ["terraform", "apply", "-input=false", "-json", PLAN_FILENAME]
+    with tracing.span(tracing.command_name(argv), "subprocess", argv=argv) as attributes:
+        process = subprocess.Popen(argv, cwd=app_dir, stdout=subprocess.PIPE, text=True, bufsize=1, **popen_kwargs)
+        output_bytes = 0
+        for line in process.stdout:
+            output_bytes += len(line.encode())
+            try:
+                event = json.loads(line)
+            except ValueError:
+                # Anything that is not a JSON event (e.g. provider crash output) is passed on as a plain message
+                event = {"type": "text", "@message": line.rstrip("\n")}
+
+            address = ((event.get("hook") or {}).get("resource") or {}).get("addr")
+            if event.get("type") == "apply_start":
+                started[address] = time.monotonic()
+            elif event.get("type") in ("apply_complete", "apply_errored"):
+                timings[address] = event["hook"].get("elapsed_seconds", time.monotonic() - started.get(address, time.monotonic()))
+            if event.get("type") == "apply_errored":
+                failed_addresses.append(address)
+            elif event.get("type") == "diagnostic" and (event.get("diagnostic") or {}).get("severity") == "error":
+                diagnostics.append(event["diagnostic"])
+            on_event(event)
+
+        returncode = process.wait()
+        if returncode != 0:
+            on_event(error_summary_event(returncode, failed_addresses, diagnostics))
+        attributes.update(exit_code=returncode, output_bytes=output_bytes, resources=len(timings))
+    remove_plan(app_dir)
+    return returncode, timings
+
+# Print per-resource apply times, slowest first
+def print_apply_timings(timings):
+    if not timings:
+        return
+    print("\nApply time per resource:")
+    for address, seconds in sorted(timings.items(), key=lambda item: item[1], reverse=True):
+        print(f"  {address:<60} {seconds:>6.1f}s")
+
+# Return the root module outputs as a dict of name -> value, or an empty dict if they cannot be read
+def outputs(app_dir):
+    result = tracing.run(["terraform", "output", "-json"], cwd=app_dir, capture_output=True, text=True)
+    if result.returncode != 0:
+        return {}
+    try:
+        return {name: output.get("value") for name, output in json.loads(result.stdout or "{}").items()}
+    except (ValueError, AttributeError):
+        return {}
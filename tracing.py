@@ -0,0 +1,172 @@
+import atexit
+import contextlib
+import itertools
+import json
+import os
+import subprocess
+import threading
+import time
+
+# Spans record how long each external command, API call and generated file took. Spans opened on a thread nest under
+# the span that thread has open, or under the current phase (a top-level span started with start_phase()).
+enabled = True
+spans = []
+current_phase = None
+
+# Trace timestamps are relative to this point, so the Chrome trace starts at zero
+origin = time.time()
+
+span_ids = itertools.count(1)
+spans_lock = threading.Lock()
+thread_state = threading.local()
+
+# Files written at exit by configure()
+JSONL_FILENAME = "trace.jsonl"
+CHROME_TRACE_FILENAME = "trace.json"
+
+# Number of slowest spans listed in the summary
+SUMMARY_SLOWEST = 5
+
+def new_span(name, category, parent, attributes):
+    return {
+        "id": next(span_ids),
+        "parent": parent["id"] if parent else None,
+        "name": name,
+        "category": category,
+        "thread": threading.get_ident(),
+        "thread_name": threading.current_thread().name,
+        "start": time.time(),
+        "duration": None,
+        "attributes": attributes,
+    }
+
+def finish_span(record, started):
+    record["duration"] = time.perf_counter() - started
+    with spans_lock:
+        spans.append(record)
+
+# Time the enclosed block as a span. Yields the span's attributes dict so the block can add to it (exit codes, sizes);
+# an exception escaping the block is recorded as the span's error.
+@contextlib.contextmanager
+def span(name, category, **attributes):
+    if not enabled:
+        yield attributes
+        return
+    stack = thread_state.__dict__.setdefault("stack", [])
+    record = new_span(name, category, stack[-1] if stack else current_phase, attributes)
+    stack.append(record)
+    started = time.perf_counter()
+    try:
+        yield attributes
+    except Exception as error:
+        attributes["error"] = f"{type(error).__name__}: {error}"
+        raise
+    finally:
+        stack.pop()
+        finish_span(record, started)
+
+# End the current phase (if any) and start the next one. Phases run one after another at the top level of a script.
+def start_phase(name):
+    global current_phase
+    end_phase()
+    if enabled:
+        current_phase = new_span(name, "phase", None, {})
+        current_phase["started"] = time.perf_counter()
+
+def end_phase():
+    global current_phase
+    if current_phase:
+        finish_span(current_phase, current_phase.pop("started"))
+        current_phase = None
+
+# Short name for a command: the program and its leading subcommands, e.g. "gcloud compute addresses list"
+def command_name(argv):
+    words = []
+    for arg in argv:
+        if arg.startswith("-") or len(words) == 4:
+            break
+        words.append(os.path.basename(arg) if not words else arg)
+    return " ".join(words)
+
+def output_size(output):
+    if output is None:
+        return 0
+    return len(output) if isinstance(output, bytes) else len(output.encode())
+
+# subprocess.run() inside a span recording the command line, exit code and bytes of captured output
+def run(argv, **kwargs):
+    with span(command_name(argv), "subprocess", argv=[str(arg) for arg in argv]) as attributes:
+        result = subprocess.run(argv, **kwargs)
+        attributes["exit_code"] = result.returncode
+        attributes["output_bytes"] = output_size(result.stdout) + output_size(result.stderr)
+        return result
+
+def finished_spans():
+    with spans_lock:
+        return sorted(spans, key=lambda record: record["start"])
+
+# Write one JSON object per span, in start order
+def write_jsonl(path):
+    with open(path, "w") as file:
+        for record in finished_spans():
+            file.write(json.dumps(record, default=str) + "\n")
+
+# Write the spans in the Chrome trace event format, which chrome://tracing and ui.perfetto.dev open
+def write_chrome_trace(path):
+    pid = os.getpid()
+    records = finished_spans()
+    events = [
+        {"name": "thread_name", "ph": "M", "pid": pid, "tid": thread, "args": {"name": thread_name}}
+        for thread, thread_name in {record["thread"]: record["thread_name"] for record in records}.items()
+    ]
+    for record in records:
+        events.append({
+            "name": record["name"],
+            "cat": record["category"],
+            "ph": "X",
+            "ts": round((record["start"] - origin) * 1e6),
+            "dur": round(record["duration"] * 1e6),
+            "pid": pid,
+            "tid": record["thread"],
+            "args": record["attributes"],
+        })
+    with open(path, "w") as file:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, file, default=str)
+
+# Print each phase's duration, the count and total time of every other category, and the slowest spans
+def print_summary():
+    records = finished_spans()
+    if not records:
+        return
+    print(f"\nTrace summary ({time.time() - origin:.2f}s, {len(records)} spans):")
+    for record in records:
+        if record["category"] == "phase":
+            print(f"  phase {record['name']:<24} {record['duration']:>8.2f}s")
+    categories = {}
+    for record in records:
+        if record["category"] != "phase":
+            count, total = categories.get(record["category"], (0, 0.0))
+            categories[record["category"]] = (count + 1, total + record["duration"])
+    for category, (count, total) in sorted(categories.items()):
+        print(f"  {category:<12} {count:>4} spans {total:>12.2f}s")
+
+    slowest = sorted((record for record in records if record["category"] != "phase"), key=lambda record: -record["duration"])[:SUMMARY_SLOWEST]
+    if slowest:
+        print("  Slowest:")
+    for record in slowest:
+        attributes = record["attributes"]
+        outcome = attributes.get("error") or (f"exit {attributes['exit_code']}" if "exit_code" in attributes else attributes.get("status", ""))
+        print(f"    {record['name']:<40} {record['duration']:>8.2f}s  {outcome}")
+
+# Export the trace to output_dir (if given) and print the summary (if summary) when the process exits
+def configure(output_dir=None, summary=True):
+    def finish():
+        end_phase()
+        if output_dir and finished_spans():
+            write_jsonl(os.path.join(output_dir, JSONL_FILENAME))
+            write_chrome_trace(os.path.join(output_dir, CHROME_TRACE_FILENAME))
+        if summary:
+            print_summary()
+        if output_dir and finished_spans():
+            print(f"Trace written to {os.path.join(output_dir, JSONL_FILENAME)} and {os.path.join(output_dir, CHROME_TRACE_FILENAME)} (open the latter in ui.perfetto.dev or chrome://tracing).")
+    atexit.register(finish)